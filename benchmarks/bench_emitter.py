@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The micro-benchmarks of the DSC/INF emitter: platform_dsc() and component_inf() for 10k+ components
+with large PcdsFixedAtBuild/LibraryClasses override tables.
+
+For each component count, the report shows the time, the time per component (flat when the runtime is linear)
+and the peak of the memory allocated during the generation (tracemalloc), of:
+- platform_dsc(): the streaming emitter,
+- legacy: the former list-building platform_dsc(), as the baseline,
+- component_inf(): the components' INF files, for the smaller counts, serially and by a pool of --inf-jobs workers.
+
+Usage:
+    python benchmarks/bench_emitter.py [--components 10000,20000,40000] [--pcds 40] [--libs 20] [--infs 2000] [--inf-jobs 0]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import hashlib
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ipug import ipug      # pylint: disable=wrong-import-position
+
+
+def make_components(n, pcds, libs):
+    """n components, each with pcds PcdsFixedAtBuild and libs LibraryClasses overrides."""
+    return [{
+        'path': 'Bench/C%d/C%d.inf' % (i, i),
+        'update': True,
+        'Defines': {'INF_VERSION': '0x00010005', 'BASE_NAME': 'C%d' % i, 'FILE_GUID': '00000000-0000-0000-0000-%012d' % i, 'MODULE_TYPE': 'UEFI_DRIVER', 'ENTRY_POINT': 'Main'},
+        'Sources': ['C%d.c' % i],
+        'Packages': ['MdePkg/MdePkg.dec'],
+        'PcdsFixedAtBuild': [['gBenchTokenSpaceGuid.Pcd%d' % j, '0x%08x' % (i * j)] for j in range(pcds)],
+        'LibraryClasses': [['Lib%d' % j, 'Bench/Library/Lib%d/Lib%d.inf' % (j, j)] for j in range(libs)],
+    } for i in range(n)]
+
+
+def legacy_platform_dsc(platform, components, workspace):
+    """the former platform_dsc(): the inputs serialized at once, the whole file built as a list, then joined and written."""
+    dsc_path = ipug.abs_path(platform['path'], workspace)
+    sections = ['Defines', 'Components']
+    overrides = {'LibraryClasses', 'PcdsFixedAtBuild'}
+    hashlib.sha256(json.dumps([1, [platform, [[c['path'], {ov: c[ov] for ov in overrides if ov in c}] for c in components]]], sort_keys=True, default=repr).encode('utf-8')).hexdigest()
+    pfile = []
+    for s in sections:
+        if s == 'Components':
+            pfile += ipug.gen_section(None, section=s)
+            for compc in components:
+                pfile += ['  %s' % compc['path']]
+                in_override = False
+                ovs = overrides.intersection(set(compc.keys()))
+                for ov in ovs:
+                    if not in_override:
+                        pfile[-1] += ' {'
+                        in_override = True
+                    pfile += ['    <%s>' % ov]
+                    sep = '|' if ov in {'LibraryClasses', 'PcdsFixedAtBuild'} else '='
+                    for d in compc[ov]:
+                        if d and d[0]:
+                            pfile += ['      %s %s %s' % (d[0], sep, d[1])]
+                if in_override:
+                    pfile += ['  }']
+        else:
+            pfile += ipug.gen_section(platform[s], section=s)
+    content = ipug.default_pug_signature + '\n'.join(pfile) + '\n'
+    if not os.path.exists(os.path.dirname(dsc_path)):
+        os.makedirs(os.path.dirname(dsc_path))
+    with open(dsc_path, 'w') as fout:
+        fout.write(content)
+
+
+def measure(func):
+    """(seconds, the peak of the memory allocated in MiB) of the calls, each in a new workspace.
+    the time and the memory are measured by two calls, since tracemalloc slows a call down."""
+    ret = []
+    for traced in (False, True):
+        ws = tempfile.mkdtemp(prefix='pug-bench-')
+        try:
+            if traced:
+                tracemalloc.start()
+            start = time.perf_counter()
+            func(ws)
+            ret.append(time.perf_counter() - start)
+            if traced:
+                ret[-1] = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+                tracemalloc.stop()
+        finally:
+            shutil.rmtree(ws, ignore_errors=True)
+    return tuple(ret)
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description='the micro-benchmarks of the DSC/INF emitter.')
+    parser.add_argument('--components', default='10000,20000,40000', help='the component counts, comma-separated')
+    parser.add_argument('--pcds', type=int, default=40, help='the PcdsFixedAtBuild overrides per component')
+    parser.add_argument('--libs', type=int, default=20, help='the LibraryClasses overrides per component')
+    parser.add_argument('--infs', type=int, default=2000, help='the largest component count of the INF generation')
+    parser.add_argument('--inf-jobs', type=int, default=0, help='the workers of the pooled INF generation, 0: cpu_count()')
+    opts = parser.parse_args()
+
+    ipug.VERBOSE_THRESHOLD = 99        # quiet
+    platform = {'path': 'Bench/Bench.dsc', 'update': True, 'Defines': {'PLATFORM_NAME': 'Bench', 'SUPPORTED_ARCHITECTURES': 'X64'}}
+    print('%-16s %10s %10s %14s %12s' % ('', 'components', 'seconds', 'us/component', 'peak MiB'))
+    for n in [int(x) for x in opts.components.split(',')]:
+        components = make_components(n, opts.pcds, opts.libs)
+        rows = [
+            ('platform_dsc()', lambda ws: ipug.platform_dsc(platform, components, ws, {})),
+            ('legacy', lambda ws: legacy_platform_dsc(platform, components, ws)),
+        ]
+        if n <= opts.infs:
+            rows += [
+                ('component_inf()', lambda ws: ipug.component_inf(components, ws, {})),
+                ('  process pool', lambda ws: ipug.component_inf(components, ws, {}, opts.inf_jobs, 'process')),
+                ('  thread pool', lambda ws: ipug.component_inf(components, ws, {}, opts.inf_jobs, 'thread')),
+            ]
+        for name, func in rows:
+            seconds, peak = measure(func)
+            print('%-16s %10d %10.3f %14.1f %12.1f' % (name, n, seconds, seconds / n * 1e6, peak))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The end-to-end benchmark of pug's orchestration, with the fake tool chain stand-ins.
+
+A synthetic workspace is built in a temporary folder:
+- a local bare git repo standing in for edk2 (BaseTools/Conf templates, a BaseTools C source, MdePkg.dec),
+- M extra CODETREE nodes, each a local bare git repo,
+- a project.py with N components,
+- the fake 'git' (the real one after a latency), 'make' and 'build' (a latency and an output volume) on PATH.
+
+Then 'ipug setup' (cold and warm) and 'ipug build' run with '--pug:trace', and for each run the report shows
+the wall time, pug's own overhead per phase (the phase's time not covered by its commands), pug's peak RSS,
+and the output-handling throughput of the EDK2 build command.
+
+Usage:
+    python benchmarks/bench_orchestration.py [--components N] [--codetrees M] [--build-lines L] ... [--json out.json] [--compare old.json]
+"""
+
+from __future__ import print_function
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+root_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# run ipug's CLI in-process, then record the process' own peak RSS.
+runner_py = r'''
+import os, sys, json, resource
+sys.argv = ['ipug'] + sys.argv[1:]
+from ipug import cli
+rc = 1
+try:
+    rc = cli.main()
+finally:
+    with open(os.environ['BENCH_RUSAGE'], 'w') as fout:
+        json.dump({'rc': rc, 'maxrss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}, fout)
+sys.exit(rc)
+'''
+
+fake_git = '''#!/bin/sh
+[ -n "$FAKE_GIT_LATENCY" ] && sleep "$FAKE_GIT_LATENCY"
+exec "%s" "$@"
+'''
+
+# make and build: a latency, then FAKE_<TOOL>_LINES lines of FAKE_<TOOL>_LINE_BYTES bytes; every 10th to stderr.
+fake_tool = '''#!%s
+import os, sys, time
+tool = os.path.basename(sys.argv[0]).upper()
+time.sleep(float(os.environ.get('FAKE_%%s_LATENCY' %% tool, 0)))
+if tool == 'MAKE' and 'clean' not in sys.argv[1:]:
+    os.makedirs(os.path.join('Source', 'C', 'bin'), exist_ok=True)
+    with open(os.path.join('Source', 'C', 'bin', 'Tool'), 'w') as fout:
+        fout.write('tool')
+lines, width = int(os.environ.get('FAKE_%%s_LINES' %% tool, 0)), int(os.environ.get('FAKE_%%s_LINE_BYTES' %% tool, 80))
+modules = max(1, int(os.environ.get('FAKE_MODULES', 1)))
+out, err = sys.stdout, sys.stderr
+for i in range(lines):
+    step = max(1, lines // modules)
+    if tool == 'BUILD' and i %% step == 0:
+        line = 'Building ... %%s/Bench/C%%d/C%%d.inf [X64]' %% (os.environ.get('WORKSPACE', ''), i // step, i // step)
+    else:
+        line = ('"gcc" -c -o /ws/Build/OUTPUT/%%d.obj %%d.c ' %% (i, i) + '.' * width)[:width]
+    (err if i %% 10 == 9 else out).write(line + '\\n')
+out.flush()
+sys.exit(int(os.environ.get('FAKE_%%s_RC' %% tool, 0)))
+'''
+
+
+def make_repo(root, name, files, tag='v1'):
+    """create a bare git repo with one commit and one tag. returns its file:// url."""
+    src = os.path.join(root, '%s.src' % name)
+    bare = os.path.join(root, '%s.git' % name)
+    for f, content in files.items():
+        fpath = os.path.join(src, f)
+        if not os.path.exists(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, 'w') as fout:
+            fout.write(content)
+    git = ['git', '-c', 'user.name=pug', '-c', 'user.email=pug@localhost', '-c', 'init.defaultBranch=master']
+    for cmd in (['init', '-q'], ['add', '-A'], ['commit', '-q', '-m', 'init'], ['tag', tag]):
+        subprocess.check_call(git + cmd, cwd=src)
+    subprocess.check_call(git + ['clone', '-q', '--bare', src, bare])
+    shutil.rmtree(src)
+    return 'file://' + bare
+
+
+def project_py(opts, edk2_url, node_urls, cache_dir, codetree_dir):
+    """the content of the synthetic project.py."""
+    lines = [
+        '# generated by benchmarks/bench_orchestration.py',
+        'DEFAULT_EDK2_REPO = %r' % edk2_url,
+        'DEFAULT_EDK2_TAG = %r' % 'edk2-bench',
+        'DEFAULT_PUG_CACHE_DIR = %r' % cache_dir,
+        'DEFAULT_UDK_DIR = %r' % os.path.join(codetree_dir, 'edk2'),
+        'DEFAULT_ACTIVE_PLATFORM = %r' % 'Bench/Bench.dsc',
+        'CODETREE = {',
+    ]
+    for i, url in enumerate(node_urls):
+        lines += ['    %r: {"path": %r, "source": {"url": %r, "signature": "v1"}, "multiworkspace": True},' % ('node%d' % i, os.path.join(codetree_dir, 'node%d' % i), url)]
+    lines += [
+        '}',
+        'PLATFORM = {',
+        '    "path": "Bench/Bench.dsc",',
+        '    "update": True,',
+        '    "Defines": {"PLATFORM_NAME": "Bench", "PLATFORM_GUID": "00000000-0000-0000-0000-000000000000", "PLATFORM_VERSION": "0.1",',
+        '                "DSC_SPECIFICATION": "0x00010005", "SUPPORTED_ARCHITECTURES": "X64", "BUILD_TARGETS": "RELEASE"},',
+        '}',
+        'COMPONENT = [',
+    ]
+    for i in range(opts.components):
+        lines += [
+            '    {"path": "Bench/C%d/C%d.inf", "update": True,' % (i, i),
+            '     "Defines": {"INF_VERSION": "0x00010005", "BASE_NAME": "C%d", "FILE_GUID": "00000000-0000-0000-0000-%012d", "MODULE_TYPE": "UEFI_DRIVER", "ENTRY_POINT": "Main"},' % (i, i),
+            '     "Sources": ["C%d.c"], "Packages": ["MdePkg/MdePkg.dec"],' % i,
+            '     "LibraryClasses": [["UefiDriverEntryPoint", "MdePkg/Library/UefiDriverEntryPoint/UefiDriverEntryPoint.inf"], ["UefiLib", "MdePkg/Library/UefiLib/UefiLib.inf"]],',
+            '     "PcdsFixedAtBuild": [["gEfiMdePkgTokenSpaceGuid.PcdDebugPropertyMask", "0x%02x"]]},' % (i % 256),
+        ]
+    lines += [']', '']
+    return '\n'.join(lines)
+
+
+def setup_workspace(opts, top):
+    """build the synthetic workspace and the fake tools. returns (the workspace, the environment of the runs)."""
+    real_git = shutil.which('git')
+    if not real_git:
+        raise SystemExit('git is required.')
+    repos, ws, bin_dir = os.path.join(top, 'repos'), os.path.join(top, 'ws'), os.path.join(top, 'bin')
+    for d in (repos, ws, bin_dir):
+        os.makedirs(d)
+    edk2_url = make_repo(repos, 'edk2', {
+        'BaseTools/Conf/build_rule.template': '# build_rule\n',
+        'BaseTools/Conf/tools_def.template': '*_GCC5_X64_CC_PATH = gcc\n',
+        'BaseTools/Conf/target.template': '# target\n',
+        'BaseTools/Source/C/Tool.c': 'int main(void) { return 0; }\n',
+        'BaseTools/GNUmakefile': 'all:\n',
+        'MdePkg/MdePkg.dec': '[Defines]\n  PACKAGE_NAME = MdePkg\n',
+    }, tag='edk2-bench')
+    node_urls = [make_repo(repos, 'node%d' % i, {'Pkg%d/Pkg%d.dec' % (i, i): '[Defines]\n', 'README': 'node%d' % i}) for i in range(opts.codetrees)]
+    for i in range(opts.components):
+        d = os.path.join(ws, 'Bench', 'C%d' % i)
+        os.makedirs(d)
+        with open(os.path.join(d, 'C%d.c' % i), 'w') as fout:
+            fout.write('int Main(void) { return %d; }\n' % i)
+    with open(os.path.join(ws, 'project.py'), 'w') as fout:
+        fout.write(project_py(opts, edk2_url, node_urls, os.path.join(top, 'cache'), os.path.join(top, 'codetree')))
+    with open(os.path.join(bin_dir, 'git'), 'w') as fout:
+        fout.write(fake_git % real_git)
+    for tool in ('make', 'build'):
+        with open(os.path.join(bin_dir, tool), 'w') as fout:
+            fout.write(fake_tool % sys.executable)
+    for f in os.listdir(bin_dir):
+        os.chmod(os.path.join(bin_dir, f), 0o755)
+    with open(os.path.join(top, 'runner.py'), 'w') as fout:
+        fout.write(runner_py)
+
+    env = {k: v for k, v in os.environ.items() if not k.startswith('DEFAULT_') and k not in {'WORKSPACE', 'CONF_PATH', 'EDK_TOOLS_PATH', 'PACKAGES_PATH', 'MAKEFLAGS', 'UDK_DIR'}}
+    env.update({
+        'PATH': bin_dir + os.pathsep + env.get('PATH', ''),
+        'PYTHONPATH': root_dir,
+        'FAKE_GIT_LATENCY': str(opts.git_latency),
+        'FAKE_MAKE_LATENCY': str(opts.make_latency),
+        'FAKE_MAKE_LINES': str(opts.make_lines),
+        'FAKE_BUILD_LATENCY': str(opts.build_latency),
+        'FAKE_BUILD_LINES': str(opts.build_lines),
+        'FAKE_BUILD_LINE_BYTES': str(opts.line_bytes),
+        'FAKE_MODULES': str(opts.components),
+        'CODETREE_JOBS': str(opts.codetree_jobs),
+        'PUG_LOG_FLUSH': str(opts.log_flush),
+        'BASETOOLS_CACHE_SIZE': '0',
+    })
+    return ws, env
+
+
+def covered(intervals):
+    """the total length of the union of the (start, end) intervals."""
+    total, end = 0.0, None
+    for s, e in sorted(intervals):
+        if end is None or s > end:
+            total += e - s
+            end = e
+        elif e > end:
+            total += e - end
+            end = e
+    return total
+
+
+def analyze(summary, lines, line_bytes):
+    """pug's overhead per phase, and the output throughput of the build command, from a trace summary."""
+    runs = [(r['start'], r['start'] + r['duration'], r) for r in summary['runs']]
+    phases = {}
+    for p in summary['phases']:
+        start, end = p['start'], p['start'] + p['duration']
+        inner = [(max(s, start), min(e, end)) for s, e, _ in runs if s < end and e > start]
+        ph = phases.setdefault(p['name'], {'time': 0.0, 'commands': 0.0, 'overhead': 0.0})
+        ph['time'] += p['duration']
+        ph['commands'] += covered(inner)
+        ph['overhead'] += p['duration'] - covered(inner)
+    for ph in phases.values():
+        for k in ph:
+            ph[k] = max(0.0, round(ph[k], 4))
+    builds = [r for _, _, r in runs if r['name'] == 'build']
+    throughput = {}
+    if builds and lines:
+        t = builds[-1]['duration']
+        throughput = {'lines': lines, 'bytes': lines * (line_bytes + 1), 'seconds': round(t, 4), 'MB/s': round(lines * (line_bytes + 1) / t / 1e6, 3)}
+    return {
+        'total': round(summary['total'], 4),
+        'overhead': round(sum(p['overhead'] for p in phases.values()), 4),
+        'phases': phases,
+        'commands': len(runs),
+        'throughput': throughput,
+    }
+
+
+def run_ipug(top, ws, env, name, args, opts):
+    """run one ipug invocation with tracing. returns its result."""
+    trace_path = os.path.join(top, 'trace', '%s.json' % name)
+    env = dict(env, BENCH_RUSAGE=os.path.join(top, '%s.rusage.json' % name))
+    start = time.time()
+    p = subprocess.run([sys.executable, os.path.join(top, 'runner.py')] + args + ['--pug:trace=%s' % trace_path], cwd=ws, env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.STDOUT, check=False)
+    wall = time.time() - start
+    if opts.verbose:
+        print(p.stdout.decode('utf-8', 'replace'))
+    with open(env['BENCH_RUSAGE']) as fin:
+        rusage = json.load(fin)
+    with open(os.path.splitext(trace_path)[0] + '.summary.json') as fin:
+        summary = json.load(fin)
+    ret = analyze(summary, opts.build_lines if 'build' in args else 0, opts.line_bytes)
+    ret.update({'rc': rusage['rc'], 'wall': round(wall, 4), 'maxrss_kb': rusage['maxrss_kb']})
+    return ret
+
+
+def git_describe():
+    """the git revision of this pug tree, '' when it's unknown."""
+    p = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=root_dir, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False)
+    return p.stdout.decode().strip()
+
+
+def benchmark(opts):
+    """run the scenarios. returns the report."""
+    sys.path.insert(0, root_dir)
+    from ipug import __version__         # pylint: disable=import-outside-toplevel
+    top = tempfile.mkdtemp(prefix='pug-bench-')
+    try:
+        ws, env = setup_workspace(opts, top)
+        scenarios = [('setup-cold', ['setup']), ('setup-warm', ['setup']), ('build', ['build'])]
+        results = {}
+        for name, args in scenarios:
+            results[name] = [run_ipug(top, ws, env, '%s.%d' % (name, i), args, opts) for i in range(opts.repeat if name != 'setup-cold' else 1)]
+    finally:
+        if opts.keep:
+            print('The synthetic workspace: %s' % top)
+        else:
+            shutil.rmtree(top, ignore_errors=True)
+    report = {'version': __version__, 'revision': git_describe(), 'python': sys.version.split()[0], 'options': vars(opts), 'results': {}}
+    for name, rs in results.items():
+        best = min(rs, key=lambda r: r['wall'])
+        report['results'][name] = dict(best, maxrss_kb=max(r['maxrss_kb'] for r in rs), rc=max(r['rc'] for r in rs))
+    return report
+
+
+def print_report(report, baseline=None):
+    """print the report, and the changes against a baseline report."""
+    print('pug %s (%s), python %s' % (report['version'], report['revision'], report['python']))
+    for name, r in report['results'].items():
+        b = (baseline or {}).get('results', {}).get(name)
+        delta = lambda k: (' (%+.1f%%)' % (100.0 * (r[k] - b[k]) / b[k])) if b and b.get(k) else ''
+        print('%-11s rc=%d wall %.3fs%s, pug overhead %.3fs%s, peak RSS %d KiB%s, %d command(s)' % (
+            name, r['rc'], r['wall'], delta('wall'), r['overhead'], delta('overhead'), r['maxrss_kb'], delta('maxrss_kb'), r['commands']))
+        for p, v in sorted(r['phases'].items(), key=lambda x: -x[1]['time']):
+            print('    %-24s %8.3fs  commands %8.3fs  overhead %8.3fs' % (p, v['time'], v['commands'], v['overhead']))
+        if r['throughput']:
+            t = r['throughput']
+            print('    output handling: %d lines, %d bytes in %.3fs, %.2f MB/s' % (t['lines'], t['bytes'], t['seconds'], t['MB/s']))
+
+
+def main():
+    """main"""
+    parser = argparse.ArgumentParser(description='the end-to-end benchmark of pug with the fake tool chain.')
+    parser.add_argument('--components', type=int, default=200, help='the number of the components in project.py')
+    parser.add_argument('--codetrees', type=int, default=4, help='the number of the extra CODETREE nodes')
+    parser.add_argument('--codetree-jobs', type=int, default=4, help='CODETREE_JOBS')
+    parser.add_argument('--git-latency', type=float, default=0.0, help='the seconds each git command is delayed')
+    parser.add_argument('--make-latency', type=float, default=0.1, help='the seconds of the BaseTools make')
+    parser.add_argument('--make-lines', type=int, default=1000, help='the output lines of the BaseTools make')
+    parser.add_argument('--build-latency', type=float, default=0.1, help='the seconds of the EDK2 build')
+    parser.add_argument('--build-lines', type=int, default=200000, help='the output lines of the EDK2 build')
+    parser.add_argument('--line-bytes', type=int, default=120, help='the bytes per output line')
+    parser.add_argument('--log-flush', type=float, default=0.1, help="PUG_LOG_FLUSH, the seconds between the log writer's batches, 0: write each line at once")
+    parser.add_argument('--repeat', type=int, default=3, help='the runs per warm scenario; the fastest is reported')
+    parser.add_argument('--json', default='', help='write the report to this file')
+    parser.add_argument('--compare', default='', help='a report of an earlier run to compare with')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic workspace')
+    parser.add_argument('--verbose', action='store_true', help="show pug's output")
+    opts = parser.parse_args()
+
+    report = benchmark(opts)
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as fin:
+            baseline = json.load(fin)
+    print_report(report, baseline)
+    if opts.json:
+        with open(opts.json, 'w') as fout:
+            json.dump(report, fout, indent=1)
+    return max(r['rc'] for r in report['results'].values())
+
+
+if __name__ == '__main__':
+    sys.exit(main())
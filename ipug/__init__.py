@@ -4,12 +4,16 @@ A front-end to build the UDK driver(s) with only .C source files and a .PY as th
 
 (c) 2019-2022 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License."""
 
-from .ipug import main
-
 __author__ = 'Timothy Lin (timothy.gh.lin@gmail.com)'
 __version__ = '0.2.4'
 
-main = main
+
+def __getattr__(name):
+    """import ipug.ipug, and so the config, only when ipug.main is used."""
+    if name == 'main':
+        from .ipug import main
+        return main
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
 
 if __name__ == '__main__':
     print('Bow-wow!')
@@ -0,0 +1,287 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The module-level binary cache of EDK2's build: '--hash' with '--binary-source' to consume it,
+and with '--binary-destination' to populate it.
+
+A cache folder is keyed by the edk2 tag and the tool chain tag. EDK2 keeps a module's binaries in
+<cache>/<platform output>/<TARGET>_<TOOL_CHAIN_TAG>/<ARCH>/<module dir>/<BaseName>/, with a *.ModuleHashPair file:
+such a folder is an entry here, and its mtime is its last use, for the LRU eviction. A key from a store, i.e. an index,
+is taken only when it's such a relative path, see is_entry_key().
+
+EDK2 doesn't take the two options together. So a build consumes the cache once it has entries; when the
+build succeeds with misses, a second pass, which finds the modules up to date, copies them into the cache.
+
+A cache is shared by a store: a local folder (e.g. on NFS), or an HTTP server taking GET and PUT (e.g. WebDAV).
+The entries are kept there as <key>.tar.gz, downloaded before a build and uploaded after it. A folder's index is
+the archives themselves; an HTTP server's is an index.json, updated by conditional PUTs (its ETag), so that
+the concurrent uploads don't lose each other's entries.
+"""
+
+__all__ = ['BinaryCache', 'LocalStore', 'HttpStore', 'store', 'parse_line', 'is_entry_key']
+
+import os
+import re
+import json
+import time
+import random
+import shutil
+import tarfile
+import tempfile
+import urllib.parse
+import urllib.request
+import urllib.error
+
+from . import cache
+
+marker_suffix = '.ModuleHashPair'
+# e.g. "[cache hit]: MakeCache: /ws/MdeModulePkg/Universal/PCD/Dxe/Pcd.inf[X64]", "[cache miss]: PreMakeCache: ..."
+re_cache_line = re.compile(r'^\[cache (hit|miss)\]:\s*(?:\w+:\s+)?(.+?)(?:\[(\w+)\])?\s*$')
+re_key_part = re.compile(r'^[\w.+-]+$')
+re_target_tag = re.compile(r'^[A-Za-z]+_\w+$')      # e.g. RELEASE_GCC5
+re_arch = re.compile(r'^[A-Z][A-Z0-9]*$')          # e.g. X64
+
+
+def parse_line(line):
+    """(hit: True/False, the module INF, the arch) of an EDK2 cache message, or None."""
+    m = re_cache_line.match(line.strip())
+    if not m:
+        return None
+    return m.group(1) == 'hit', m.group(2).strip(), m.group(3) or ''
+
+
+def entries(root):
+    """the keys of the entries in a cache folder: the relative paths of the folders with a *.ModuleHashPair."""
+    ret = set()
+    for dirpath, dirnames, filenames in os.walk(root):
+        if any(f.endswith(marker_suffix) for f in filenames):
+            ret.add(os.path.relpath(dirpath, root).replace(os.sep, '/'))
+            dirnames[:] = []
+        else:
+            dirnames[:] = [d for d in dirnames if '.tmp.' not in d]
+    return ret
+
+
+def is_entry_key(key):
+    """True when a key is an entry's relative path: <platform output>/<TARGET>_<TOOL_CHAIN_TAG>/<ARCH>/<module dir>/<BaseName>,
+    without an absolute path, a '..' or a '.' component, e.g. 'Build/OvmfX64/DEBUG_GCC5/X64/MdePkg/Library/BaseLib/BaseLib'."""
+    parts = key.split('/') if isinstance(key, str) else []
+    if not parts or not all(re_key_part.match(p) and p not in ('.', '..') for p in parts):
+        return False
+    return any(re_target_tag.match(parts[i]) and re_arch.match(parts[i + 1]) for i in range(1, len(parts) - 3))
+
+
+def pack(root, key, path):
+    """archive an entry into a .tar.gz file."""
+    with tarfile.open(path, 'w:gz') as tar:
+        tar.add(os.path.join(root, key), arcname='.')
+
+
+def unpack(path, root, key):
+    """extract an archived entry into a cache folder. The entry appears atomically.
+    raises ValueError for a key which isn't an entry's, see is_entry_key()."""
+    if not is_entry_key(key):
+        raise ValueError('not a key of an entry: %r' % (key,))
+    dest = os.path.join(root, key)
+    tmp = '%s.tmp.%d' % (dest, os.getpid())
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    with tarfile.open(path, 'r:gz') as tar:
+        for m in tar.getmembers():
+            if m.name.startswith(('/', '..')) or '/../' in m.name or not (m.isfile() or m.isdir()):
+                raise ValueError('unsafe member: %s' % m.name)
+        if hasattr(tarfile, 'data_filter'):
+            tar.extractall(tmp, filter='data')
+        else:
+            tar.extractall(tmp)
+    try:
+        os.rename(tmp, dest)
+    except OSError:
+        shutil.rmtree(tmp, ignore_errors=True)
+
+
+class LocalStore(object):
+    """a store in a local or a mounted folder."""
+
+    def __init__(self, root):
+        self.root = root
+
+    def index(self):
+        """{key: the time stored}, of the archived entries."""
+        ret = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for f in filenames:
+                if not f.endswith('.tar.gz'):
+                    continue
+                path = os.path.join(dirpath, f)
+                try:
+                    ret[os.path.relpath(path, self.root)[:-len('.tar.gz')].replace(os.sep, '/')] = os.stat(path).st_mtime
+                except OSError:
+                    pass
+        return ret
+
+    def get(self, key, path):
+        """copy an archived entry to a file."""
+        shutil.copyfile(os.path.join(self.root, key + '.tar.gz'), path)
+
+    def put(self, key, path):
+        """store an archived entry."""
+        dest = os.path.join(self.root, key + '.tar.gz')
+        if not os.path.exists(os.path.dirname(dest)):
+            os.makedirs(os.path.dirname(dest))
+        shutil.copyfile(path, dest + '.tmp.%d' % os.getpid())
+        os.replace(dest + '.tmp.%d' % os.getpid(), dest)
+
+    def add(self, keys):
+        """record the stored entries in the index: the archives are the index."""
+
+
+class HttpStore(object):
+    """a store on an HTTP server taking GET and PUT."""
+
+    def __init__(self, url, timeout=30):
+        self.url = url.rstrip('/') + '/'
+        self.timeout = timeout
+
+    def request(self, name, data=None, headers=None):
+        """GET (or PUT, with data) an object. returns (its content, its ETag or '')."""
+        req = urllib.request.Request(self.url + urllib.parse.quote(name), data=data, headers=headers or {}, method='GET' if data is None else 'PUT')
+        with urllib.request.urlopen(req, timeout=self.timeout) as resp:
+            return resp.read(), resp.headers.get('ETag', '')
+
+    def index_etag(self):
+        """({key: the time stored}, the index's ETag: '' when the server gives none, None when there's no index yet)."""
+        try:
+            data, etag = self.request('index.json')
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                return {}, None
+            raise
+        return json.loads(data.decode('utf-8')), etag
+
+    def index(self):
+        """{key: the time stored}."""
+        return self.index_etag()[0]
+
+    def get(self, key, path):
+        """download an archived entry to a file."""
+        with open(path, 'wb') as fout:
+            fout.write(self.request(key + '.tar.gz')[0])
+
+    def put(self, key, path):
+        """upload an archived entry."""
+        with open(path, 'rb') as fin:
+            self.request(key + '.tar.gz', fin.read())
+
+    def add(self, keys, tries=8):
+        """record the uploaded entries in the index: merged into the index read, and put only if it's unchanged since
+        (If-Match its ETag, or If-None-Match for a new one); read and merged again on a conflict, i.e. 412.
+        a server giving no ETag takes the merged index unconditionally."""
+        for i in range(tries):
+            index, etag = self.index_etag()
+            index.update({k: time.time() for k in keys})
+            headers = {'If-None-Match': '*'} if etag is None else ({'If-Match': etag} if etag else {})
+            try:
+                self.request('index.json', json.dumps(index, indent=1, sort_keys=True).encode('utf-8'), headers)
+                return
+            except urllib.error.HTTPError as e:
+                if e.code != 412:
+                    raise
+            time.sleep(random.uniform(0, 0.1 * (i + 1)))
+        raise OSError('the index of %s keeps changing' % self.url)
+
+
+def store(location, namespace):
+    """the shared store of a location, an http(s):// URL or a folder, under the namespace, e.g. '<edk2 tag>/<tool chain>'."""
+    if location.startswith(('http://', 'https://')):
+        return HttpStore(location.rstrip('/') + '/' + namespace)
+    return LocalStore(os.path.join(os.path.expanduser(location), namespace))
+
+
+class BinaryCache(object):
+    """a local cache folder, fed to EDK2, and optionally a shared store behind it."""
+
+    def __init__(self, root, shared=None):
+        self.root = root
+        self.shared = shared
+        self.hits, self.misses = set(), set()
+        self.known = set()      # the entries before the build
+        self.consumed = False   # True when the build consumes the cache, rather than populates it
+
+    def build_args(self, populate=False):
+        """the EDK2 build options: consume the cache once it has entries, or populate it."""
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        self.known = entries(self.root)
+        self.consumed = bool(self.known) and not populate
+        return ['--hash', '--binary-%s=%s' % ('source' if self.consumed else 'destination', self.root)]
+
+    def feed(self, stream, line):
+        """take a line of the build output; the signature fits run()'s on_line callback."""
+        r = parse_line(line) if line.startswith('[cache ') else None
+        if r:
+            (self.hits if r[0] else self.misses).add((os.path.normpath(r[1]), r[2]))
+
+    def result(self):
+        """(the modules hit, the modules missed)."""
+        return len(self.hits), len(self.misses - self.hits)
+
+    def touch_hits(self):
+        """mark the entries of the modules hit as the most recently used."""
+        for key in self.known:
+            parts = key.split('/')
+            for module, arch in self.hits:
+                if arch not in parts[:-1]:
+                    continue
+                # the folders between <ARCH>/ and /<BaseName> are the module's folder, relative to its package path.
+                sub = '/'.join(parts[parts.index(arch) + 1:-1])
+                if ('/' + os.path.dirname(module).replace(os.sep, '/') + '/').endswith('/' + sub + '/'):
+                    cache.lookup(self.root, key)
+                    break
+
+    def pull(self):
+        """download the shared entries missing from the local folder, ignoring the index's keys which aren't an entry's. returns their number."""
+        if self.shared is None:
+            return 0
+        local = entries(self.root)
+        count = 0
+        with tempfile.TemporaryDirectory(prefix='pug-bincache-') as tmp:
+            for key in sorted(set(k for k in self.shared.index() if is_entry_key(k)) - local):
+                path = os.path.join(tmp, 'entry.tar.gz')
+                self.shared.get(key, path)
+                unpack(path, self.root, key)
+                count += 1
+        return count
+
+    def push(self):
+        """upload the local entries missing from the shared store. returns their number."""
+        if self.shared is None:
+            return 0
+        index = self.shared.index()
+        new = sorted(entries(self.root) - set(index))
+        with tempfile.TemporaryDirectory(prefix='pug-bincache-') as tmp:
+            for key in new:
+                path = os.path.join(tmp, 'entry.tar.gz')
+                pack(self.root, key, path)
+                self.shared.put(key, path)
+        if new:
+            self.shared.add(new)
+        return len(new)
+
+    def evict(self, max_bytes):
+        """remove the least recently used local entries until the folder fits in max_bytes. returns the removed keys."""
+        found = [(os.stat(os.path.join(self.root, k)).st_mtime, k, cache.dir_size(os.path.join(self.root, k))) for k in entries(self.root)]
+        total = sum(e[2] for e in found)
+        removed = []
+        for _, key, size in sorted(found):
+            if total <= max_bytes:
+                break
+            shutil.rmtree(os.path.join(self.root, key), ignore_errors=True)
+            total -= size
+            removed.append(key)
+        return removed
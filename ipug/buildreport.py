@@ -0,0 +1,117 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+A streaming analyzer of the EDK2 build output, which attributes the wall time to the build phases
+(AutoGen, make, GenFds) and to the module INFs, line by line as the output arrives.
+
+The attribution is by the timing of the lines:
+- a module starts at its "Building ... <INF> [<ARCH>]" line, and
+- it lasts until the last line referring to its output folder, e.g. a compiler or a linker command.
+"""
+
+__all__ = ['BuildAnalyzer']
+
+import os
+import json
+import time
+import collections
+
+
+class BuildAnalyzer(object):
+    """feed() it with the build output, and then write_report()."""
+
+    # the phase transitions: (the phase, the prefixes of the lines starting it)
+    phase_marks = [
+        ('AutoGen', ('Processing meta-data',)),
+        ('make', ('Building ... ',)),
+        ('GenFds', ('GenFds ', 'Generating FD', 'Fd File Name:')),
+        ('done', ('- Done -', '- Failed -', 'Build end time:')),
+    ]
+
+    def __init__(self, active_modules=64, clock=time.time):
+        self.clock = clock
+        self.start = clock()
+        self.phase = 'init'
+        self.rank = -1
+        self.phase_start = self.start
+        self.phases = collections.OrderedDict()
+        self.modules = collections.OrderedDict()       # (inf, arch) -> {'start', 'last', 'lines'}
+        self.active = collections.deque(maxlen=active_modules)
+        self.lines = 0
+
+    def _enter(self, phase, now):
+        self.phases[self.phase] = self.phases.get(self.phase, 0.0) + (now - self.phase_start)
+        self.phase, self.phase_start = phase, now
+
+    def feed(self, stream, line):
+        """take a line of the build output. The signature fits run()'s on_line callback."""
+        now = self.clock()
+        self.lines += 1
+        if os.sep == '\\':
+            line = line.replace('\\', '/')
+        stripped = line.lstrip()
+        for rank, (phase, marks) in enumerate(self.phase_marks):
+            if stripped.startswith(marks):
+                # the phases only move forward; e.g. "Building ..." also shows up for the libraries of GenFds.
+                if rank > self.rank:
+                    self.rank = rank
+                    self._enter(phase, now)
+                break
+        if stripped.startswith('Building ... '):
+            body = stripped[len('Building ... '):].strip()
+            arch = ''
+            if body.endswith(']') and '[' in body:
+                body, arch = body[:-1].rsplit('[', 1)
+                body = body.strip()
+            key = (body, arch)
+            if key not in self.modules:
+                stem = os.path.splitext(os.path.basename(body))[0]
+                parent = os.path.basename(os.path.dirname(body))
+                self.modules[key] = {'start': now, 'last': now, 'lines': 0, 'fragment': '/%s/%s/' % (parent, stem), 'phase': self.phase}
+                self.active.append(key)
+            return
+        for key in self.active:
+            m = self.modules[key]
+            if m['fragment'] in line:
+                m['last'] = now
+                m['lines'] += 1
+
+    def finish(self):
+        """close the current phase."""
+        self._enter('done', self.clock())
+
+    def report(self):
+        """the analysis as a dict."""
+        modules = [{
+            'inf': k[0], 'arch': k[1],
+            'seconds': round(m['last'] - m['start'], 3),
+            'start': round(m['start'] - self.start, 3),
+            'lines': m['lines'],
+        } for k, m in self.modules.items()]
+        modules.sort(key=lambda x: -x['seconds'])
+        return {
+            'total': round(self.clock() - self.start, 3),
+            'lines': self.lines,
+            'phases': {k: round(v, 3) for k, v in self.phases.items()},
+            'modules': modules,
+        }
+
+    def write_report(self, path, top=30):
+        """write the "slowest modules" report to path, and the JSON to <path-without-extension>.json."""
+        rpt = self.report()
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(os.path.splitext(path)[0] + '.json', 'w') as fout:
+            json.dump(rpt, fout, indent=1)
+        msg = ['EDK2 build: %.1fs, %d line(s), %d module(s)' % (rpt['total'], rpt['lines'], len(rpt['modules'])), '', 'Phases:']
+        msg += ['  %-10s %9.1fs' % (k, v) for k, v in rpt['phases'].items()]
+        msg += ['', 'The slowest modules:']
+        msg += ['  %9.1fs  %-6s %s' % (m['seconds'], m['arch'], m['inf']) for m in rpt['modules'][:top]]
+        with open(path, 'w') as fout:
+            fout.write('\n'.join(msg) + '\n')
+        return msg
@@ -0,0 +1,103 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The helpers of the pug-managed caches under DEFAULT_PUG_CACHE_DIR.
+A cache store is a folder whose sub-folders are the entries; the mtime of an entry is its last use.
+"""
+
+__all__ = ['tree_digest', 'entry_path', 'lookup', 'insert', 'evict', 'dir_size']
+
+import os
+import shutil
+import hashlib
+
+
+def tree_digest(root, exclude_dirs=(), suffixes=(), names=()):
+    """a sha256 digest of the relative paths and the contents of the files in a folder.
+    only the files with the given suffixes or names are counted when either is given."""
+    h = hashlib.sha256()
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in exclude_dirs)
+        for f in sorted(filenames):
+            if (suffixes or names) and not (f in names or os.path.splitext(f)[1] in suffixes):
+                continue
+            fpath = os.path.join(dirpath, f)
+            h.update(os.path.relpath(fpath, root).replace(os.sep, '/').encode('utf-8') + b'\0')
+            with open(fpath, 'rb') as fin:
+                for chunk in iter(lambda: fin.read(1 << 20), b''):
+                    h.update(chunk)
+            h.update(b'\0')
+    return h.hexdigest()
+
+
+def dir_size(path):
+    """the total size of the files in a folder."""
+    size = 0
+    for dirpath, _, filenames in os.walk(path):
+        for f in filenames:
+            try:
+                size += os.lstat(os.path.join(dirpath, f)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def entry_path(store, key):
+    """the path of an entry in a cache store."""
+    return os.path.join(store, key)
+
+
+def lookup(store, key):
+    """the path of an existing entry, which is then marked as the most recently used; or '' on a miss."""
+    path = entry_path(store, key)
+    if not os.path.isdir(path):
+        return ''
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+    return path
+
+
+def insert(store, key, src_dir):
+    """copy a folder into a cache store as an entry. The entry appears atomically."""
+    path = entry_path(store, key)
+    if os.path.isdir(path):
+        return path
+    tmp_path = '%s.tmp.%d' % (path, os.getpid())
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+    shutil.copytree(src_dir, tmp_path, symlinks=True)
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # a concurrent insertion of the same entry wins.
+        shutil.rmtree(tmp_path, ignore_errors=True)
+    return path
+
+
+def evict(store, max_bytes):
+    """remove the least recently used entries until the store fits in max_bytes.
+    returns the list of the removed keys."""
+    if not os.path.isdir(store):
+        return []
+    entries = []
+    for key in os.listdir(store):
+        path = os.path.join(store, key)
+        if os.path.isdir(path) and '.tmp.' not in key:
+            entries += [(os.stat(path).st_mtime, key, dir_size(path))]
+    total = sum(e[2] for e in entries)
+    removed = []
+    for _, key, size in sorted(entries):
+        if total <= max_bytes:
+            break
+        shutil.rmtree(os.path.join(store, key), ignore_errors=True)
+        total -= size
+        removed += [key]
+    return removed
+
@@ -7,10 +7,8 @@ import sys
 # import click
 
 try:
-    from ipug.ipug import main as ipug_main
-    from ipug.__init__ import __version__
+    from ipug import __version__
 except ImportError:
-    from ipug import main as ipug_main
     from __init__ import __version__
 
 
@@ -34,6 +32,11 @@ def main():
         except Exception:
             print('--empty--')
         return 0
+    # the config is materialized only from here.
+    try:
+        from ipug.ipug import main as ipug_main
+    except ImportError:
+        from ipug import main as ipug_main
     return ipug_main()
 
 
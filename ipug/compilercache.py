@@ -0,0 +1,135 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The compiler cache (ccache or a compatible wrapper) wiring of the generated Conf/tools_def.txt.
+
+EDK2's build_rule.txt quotes the tools, e.g. "$(CC)", so a *_PATH value can't simply be prefixed with "ccache ".
+Instead, each wrapped *_PATH value is expanded (DEF()) and replaced by a small wrapper script,
+which execs the compiler cache with the original tool and its arguments, the ENV() macros resolved as it runs.
+"""
+
+__all__ = ['find_wrapper', 'wrap_tools_def', 'stats', 'stats_delta']
+
+import os
+import re
+import shlex
+import shutil
+import hashlib
+import subprocess
+
+# the *_PATH attributes routed through the compiler cache.
+wrapped_tools = ('CC', 'DLINK', 'DLINK2', 'ASLCC', 'ASLDLINK')
+
+re_tool_path = re.compile(r'^(\s*)([^_\s#]+)_([^_\s]+)_([^_\s]+)_(%s)_PATH(\s*=\s*)(.*?)\s*$' % '|'.join(wrapped_tools))
+re_define = re.compile(r'^\s*DEFINE\s+(\w+)\s*=\s*(.*?)\s*$')
+re_macro = re.compile(r'(DEF|ENV)\((\w+)\)')
+
+
+def find_wrapper(setting):
+    """the absolute path of the compiler cache: 'auto'/'ccache' looks for ccache in PATH; otherwise it's a command or a path."""
+    if not setting:
+        return ''
+    name = 'ccache' if setting in {'auto', 'ccache', '1'} else setting
+    return shutil.which(name) or ''
+
+
+def expand(value, defines, environ=None, depth=8):
+    """expand the DEF() and the ENV() macros of a tools_def value. environ=False leaves the ENV() macros as they are."""
+    environ = os.environ if environ is None else environ
+
+    def _macro(m):
+        if m.group(1) == 'DEF':
+            return defines.get(m.group(2), '')
+        return environ.get(m.group(2), '') if environ is not False else m.group(0)
+
+    for _ in range(depth):
+        v = re_macro.sub(_macro, value)
+        if v == value:
+            break
+        value = v
+    return value
+
+
+def shell_word(word):
+    """a word of a tool value as a shell word: the ENV() macros as the shell's variables, e.g. 'ENV(PREFIX)gcc' as "${PREFIX}"'gcc'."""
+    parts = re.split(r'ENV\((\w+)\)', word)
+    return ''.join(('"${%s}"' % p if i % 2 else shlex.quote(p)) for i, p in enumerate(parts) if p) or "''"
+
+
+def wrapper_script(wrap_dir, wrapper, tool):
+    """create (once) the wrapper script of a tool, e.g. 'ENV(PREFIX)gcc -m64'. returns its path.
+    the tool's ENV() macros are resolved by the script as it runs, and its arguments are passed as they are."""
+    words = tool.split()
+    base = os.path.basename(re.sub(r'ENV\(\w+\)', '', words[0])) if words else ''
+    name = '%s-%s' % (hashlib.sha1(('%s\0%s' % (wrapper, tool)).encode('utf-8')).hexdigest()[:10], base or 'tool')
+    path = os.path.join(wrap_dir, name)
+    content = '#!/bin/sh\nexec %s %s "$@"\n' % (shlex.quote(wrapper), ' '.join(shell_word(w) for w in words))
+    try:
+        with open(path, 'r') as fin:
+            if fin.read() == content:
+                return path
+    except (IOError, OSError):
+        pass
+    if not os.path.exists(wrap_dir):
+        os.makedirs(wrap_dir)
+    with open(path, 'w') as fout:
+        fout.write(content)
+    os.chmod(path, 0o755)
+    return path
+
+
+def wrap_tools_def(path, tags, wrapper, wrap_dir):
+    """route the CC/DLINK-related *_PATH entries of the tool chain tags through the compiler cache, in place.
+    the entries already wrapped are left as they are. returns the number of the newly wrapped entries."""
+    with open(path, 'r') as fin:
+        lines = fin.read().split('\n')
+    defines = {}
+    for line in lines:
+        m = re_define.match(line)
+        if m:
+            defines[m.group(1)] = m.group(2)
+    count = 0
+    wrap_dir = os.path.abspath(wrap_dir)
+    for i, line in enumerate(lines):
+        m = re_tool_path.match(line)
+        if not m or (m.group(3) not in tags and m.group(3) != '*'):
+            continue
+        value = m.group(7)
+        if not value or value.startswith(wrap_dir):
+            continue
+        script = wrapper_script(wrap_dir, wrapper, expand(value, defines, environ=False))
+        lines[i] = '%s%s_%s_%s_%s_PATH%s%s' % (m.group(1), m.group(2), m.group(3), m.group(4), m.group(5), m.group(6), script)
+        count += 1
+    if count:
+        # replaced, not rewritten in place: the file may be a hard link to its template.
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'w') as fout:
+            fout.write('\n'.join(lines))
+        os.replace(tmp, path)
+    return count
+
+
+def stats(wrapper):
+    """the statistics counters of the compiler cache (ccache 4's --print-stats); {} when they're unavailable."""
+    try:
+        out = subprocess.run([wrapper, '--print-stats'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=False).stdout
+    except OSError:
+        return {}
+    ret = {}
+    for line in out.decode('utf-8', 'replace').splitlines():
+        kv = line.split('\t')
+        if len(kv) == 2 and kv[1].strip().isdigit():
+            ret[kv[0].strip()] = int(kv[1])
+    return ret
+
+
+def stats_delta(before, after):
+    """the hits and the misses between two statistics snapshots: (direct hits, preprocessed hits, misses)."""
+    def _d(k):
+        return after.get(k, 0) - before.get(k, 0)
+    return _d('direct_cache_hit'), _d('preprocessed_cache_hit'), _d('cache_miss')
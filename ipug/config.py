@@ -9,10 +9,13 @@
 The basic/default configuration file for PUG.
 """
 
-__all__ = ['dump_config', 'dump_env_vars', 'WORKSPACE', 'CODETREE', 'TARGET_TXT', 'PLATFORM', 'COMPONENT', 'VERBOSE_THRESHOLD']
+__all__ = ['load', 'dump_config', 'dump_env_vars', 'WORKSPACE', 'CODETREE', 'TARGET_TXT', 'PLATFORM', 'COMPONENT', 'MATRIX', 'VERBOSE_THRESHOLD']
 
 import os
 import sys
+import types
+import pickle
+import hashlib
 
 sys.dont_write_bytecode = True      # inhibit the creation of .pyc file
 VERBOSE_THRESHOLD = 1               # the bigger number, the higher threshold, the less messages being displayed
@@ -28,119 +31,231 @@ DEFAULT_BUILD_COMMAND = ''
 DEFAULT_WORKSPACE_DIR = os.environ.get('WORKSPACE', os.getcwd())
 DEFAULT_ACTIVE_PLATFORM = os.environ.get('ACTIVE_PLATFORM', '')
 DEFAULT_PATH_APPEND_SIGNATURE = False
+DEFAULT_CODETREE_JOBS = os.environ.get('CODETREE_JOBS', 1)            # the number of CODETREE nodes fetched concurrently
+DEFAULT_SUBMODULE_JOBS = os.environ.get('SUBMODULE_JOBS', 8)          # the submodules fetched at a time, unless a CODETREE node's 'git.submodule.jobs'
+DEFAULT_PIPELINE_JOBS = os.environ.get('PIPELINE_JOBS', 0)            # the tasks of build() run at a time, 0: all the ready ones, 1: one by one, with their output streamed
+DEFAULT_INF_JOBS = os.environ.get('INF_JOBS', 1)                      # the workers generating the COMPONENTs' INF files, 0: cpu_count()
+DEFAULT_INF_POOL = os.environ.get('INF_POOL', 'process')              # the INF workers: 'process' or 'thread'
 
-DEFAULT_UDK_DIR = os.environ.get('UDK_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pug', DEFAULT_EDK2_TAG))
+DEFAULT_LOG_FLUSH = os.environ.get('PUG_LOG_FLUSH', 0.1)             # the seconds between the log writer's batches, 0: write each message at once
+DEFAULT_LOG_JSON = os.environ.get('PUG_LOG_JSON', '')                # the JSON-lines file the messages are appended to, '' for none
 
-CODETREE = {}
-PLATFORM = {}
-WORKSPACE = {}
-COMPONENT = {}
-TARGET_TXT = {}
+DEFAULT_JOBS = os.environ.get('PUG_JOBS', 0)                         # the global concurrency limit, 0: cpu_count()
+DEFAULT_JOBSERVER = os.environ.get('PUG_JOBSERVER', 'auto')           # 'auto': join the parent's make jobserver or create one, 'off'
+DEFAULT_COMPILER_CACHE = os.environ.get('COMPILER_CACHE', '')         # '': off, 'auto'/'ccache': ccache in PATH, or a compatible wrapper's command/path
+DEFAULT_CONF_COPY = os.environ.get('CONF_COPY', 'auto')             # the Conf files copied on change by 'auto' (reflink, else copy), 'hardlink' or 'copy'; 'always': on every setup
+DEFAULT_BINARY_CACHE = os.environ.get('BINARY_CACHE', '')           # EDK2's module binary cache: '' off, 'local', or a shared folder/http(s):// URL
+DEFAULT_BINARY_CACHE_SIZE = os.environ.get('BINARY_CACHE_SIZE', 4096)  # MiB of the local module binary cache, 0: unbounded
+DEFAULT_BUILD_REPORT = os.environ.get('BUILD_REPORT', 0)             # 1: analyze the EDK2 build output into Build/pug/build-report.txt, via pipes instead of the terminal
+DEFAULT_WATCH_DEBOUNCE = os.environ.get('WATCH_DEBOUNCE', 0.3)       # 'ipug watch': the quiet seconds ending a burst of changes
+DEFAULT_WATCH_POLL = os.environ.get('WATCH_POLL', 0)                 # 'ipug watch': 0 for inotify when available, or the polling period in seconds
+DEFAULT_FARM_WORKERS = os.environ.get('FARM_WORKERS', '127.0.0.1:7878')  # 'ipug farm': the workers, 'host:port[,host:port...]'
+DEFAULT_FARM_LISTEN = os.environ.get('FARM_LISTEN', '127.0.0.1:7878')    # 'ipug serve-worker': the address listened
+DEFAULT_FARM_SLOTS = os.environ.get('FARM_SLOTS', 1)                 # 'ipug serve-worker': the jobs run at a time
+DEFAULT_FARM_TOKEN = os.environ.get('FARM_TOKEN', '')                # the shared secret of the coordinator and the workers, '': the one generated in DEFAULT_PUG_CACHE_DIR/farm/token
+DEFAULT_FARM_WORKSPACES = os.environ.get('FARM_WORKSPACES', '')      # 'ipug serve-worker': the folders of the jobs' workspaces, os.pathsep-separated, '': this workspace
+DEFAULT_RUN_TAIL_LINES = os.environ.get('RUN_TAIL_LINES', 1000)      # the lines of a command's output kept in memory, per stream
+DEFAULT_PUG_CACHE_DIR = os.environ.get('PUG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pug'))
+DEFAULT_BASETOOLS_CACHE_SIZE = os.environ.get('BASETOOLS_CACHE_SIZE', 512)  # MiB of the BaseTools binary cache, 0 to disable it
+DEFAULT_GIT_MIRROR = os.environ.get('GIT_MIRROR', 'auto')           # 'auto': use the existing mirrors, 'update': refresh them on setup, 'off'
+
+DEFAULT_UDK_DIR = os.environ.get('UDK_DIR', os.path.join(DEFAULT_PUG_CACHE_DIR, DEFAULT_EDK2_TAG))
 
-project = None
 project_py = 'project.py'
+project_cache = os.environ.get('PUG_CONFIG_CACHE', '')     # '1': cache the evaluated settings of project.py, see import_project()
+
+# the settings materialized by load(), on the first access.
+lazy_settings = {'CODETREE', 'PLATFORM', 'WORKSPACE', 'COMPONENT', 'TARGET_TXT', 'MATRIX', 'ACTIVE_PLATFORM', 'project', 'customized_settings'}
+loaded_defaults = None      # the DEFAULT_* of config.py, before the customization of the environment variables and project.py
+
+
+def __getattr__(name):
+    """materialize the settings on the first access of config.WORKSPACE, config.CODETREE, ..."""
+    if name in lazy_settings and loaded_defaults is None:
+        load()
+        return globals()[name]
+    raise AttributeError("module '%s' has no attribute '%s'" % (__name__, name))
+
+
+def project_cache_path(path):
+    """the cache file of a project.py's evaluated settings."""
+    cache_dir = os.environ.get('PUG_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pug'))
+    key = hashlib.sha1(('%s\0%s' % (path, sys.version)).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(cache_dir, 'config', key + '.pickle')
+
+
+def import_project():
+    """import project.py off the current folder, or None when there's none.
+    with PUG_CONFIG_CACHE=1, its all-capital settings are cached, and restored while the mtime and the size, or the hash, of project.py hold.
+    NOTE: a project.py with side effects, or whose settings depend on anything but itself, should not be cached."""
+    path = os.path.join(os.getcwd(), project_py)
+    st = os.stat(path) if project_cache and os.path.isfile(path) else None
+    if st:
+        cache_path = project_cache_path(path)
+        try:
+            with open(cache_path, 'rb') as fin:
+                cached = pickle.load(fin)
+            digest = None
+            if cached['stat'] != [st.st_mtime_ns, st.st_size]:
+                with open(path, 'rb') as fin:
+                    digest = hashlib.sha256(fin.read()).hexdigest()
+            if digest in {None, cached['sha256']}:
+                prj = types.ModuleType('project')
+                prj.__file__ = path
+                prj.__dict__.update(cached['settings'])
+                sys.modules['project'] = prj
+                return prj
+        except (IOError, OSError, EOFError, KeyError, TypeError, pickle.PickleError, AttributeError, ImportError):
+            pass
+
+    ORIGINAL_SYS_PATH = sys.path[:]
+    try:
+        sys.path = [os.getcwd()] + sys.path
+        # WARNING: here is actually a potential vulnerability with unbounded privilege propagation when importing a local python file.
+        import project
+    except ImportError:
+        # let the invoker to handle the mess.
+        return None
+    finally:
+        sys.path = ORIGINAL_SYS_PATH
+
+    if st and os.path.abspath(getattr(project, '__file__', '')) == path:
+        try:
+            with open(path, 'rb') as fin:
+                digest = hashlib.sha256(fin.read()).hexdigest()
+            content = pickle.dumps({
+                'stat': [st.st_mtime_ns, st.st_size],
+                'sha256': digest,
+                'settings': {k: getattr(project, k) for k in dir(project) if k.isupper()},
+            })
+            if not os.path.exists(os.path.dirname(cache_path)):
+                os.makedirs(os.path.dirname(cache_path))
+            with open(cache_path + '.tmp', 'wb') as fout:
+                fout.write(content)
+            os.replace(cache_path + '.tmp', cache_path)
+        except (IOError, OSError, pickle.PicklingError, TypeError, AttributeError):
+            # e.g. a module or a function in the settings.
+            pass
+    return project
+
+
+def load(reload=False):
+    """materialize the settings: the DEFAULT_* above customized by the environment variables and project.py,
+    and then CODETREE, WORKSPACE, TARGET_TXT, ... once, or again with reload, e.g. after project.py changes."""
+    global loaded_defaults, project, customized_settings, ACTIVE_PLATFORM
+    global CODETREE, PLATFORM, WORKSPACE, COMPONENT, TARGET_TXT, MATRIX, DEFAULT_UDK_DIR
+    if loaded_defaults is not None and not reload:
+        return
+    if loaded_defaults is None:
+        loaded_defaults = {k: v for k, v in globals().items() if k.startswith('DEFAULT_')}
+    globals().update(loaded_defaults)
+    sys.modules.pop('project', None)
+    g = globals()
 
-pCODETREE = {}
-pPLATFORM = {}
-pWORKSPACE = {}
-pCOMPONENT = {}
-pTARGET_TXT = {}
-
-ORIGINAL_SYS_PATH = sys.path[:]
-customized_settings = {}
-
-# assimilate DEFAULT_* from the environment variable space first.
-for dv in os.environ:
-    if not dv.startswith('DEFAULT_'):
-        continue
-    customized_settings[dv] = locals()[dv] = os.environ[dv]
-
-try:
-    sys.path = [os.getcwd()] + sys.path
-    # WARNING: here is actually a potential vulnerability with unbounded privilege propagation when importing a local python file.
-    import project
+    CODETREE = {}
+    PLATFORM = {}
+    WORKSPACE = {}
+    COMPONENT = {}
+    TARGET_TXT = {}
+    MATRIX = {}
+
+    customized_settings = {}
+
+    # assimilate DEFAULT_* from the environment variable space first.
+    for dv in os.environ:
+        if not dv.startswith('DEFAULT_'):
+            continue
+        customized_settings[dv] = g[dv] = os.environ[dv]
+
+    project = import_project()
     pCODETREE = getattr(project, 'CODETREE', {})
     pPLATFORM = getattr(project, 'PLATFORM', {})
     pWORKSPACE = getattr(project, 'WORKSPACE', {})
     pCOMPONENT = getattr(project, 'COMPONENT', {})
     pTARGET_TXT = getattr(project, 'TARGET_TXT', {})
+    pMATRIX = getattr(project, 'MATRIX', {})
 
     # TODO: eventually, all the all-capital symbols should be merged from project.py.
     # TODO: any "DEFAULT_" symbol exists in project.py but not in this config.py should be an error. (strict mode)
-    for dv in dir(project):
+    for dv in dir(project) if project else []:
         if not dv.startswith('DEFAULT_'):
             continue
-        customized_settings[dv] = locals()[dv] = getattr(project, dv)
-
-except ImportError:
-    # let the invoker to handle the mess.
-    pass
-
-sys.path = ORIGINAL_SYS_PATH
-
-# update the dependent settings after settings of project.py are loaded.
-if ('DEFAULT_UDK_DIR' not in customized_settings) and ('DEFAULT_EDK2_TAG' in customized_settings):
-    DEFAULT_UDK_DIR = os.environ.get('UDK_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'pug', DEFAULT_EDK2_TAG))
-
-# basic global settings of WORKSPACE. Any relative-path is relative to the WORKSPACE-dir.
-WORKSPACE = {
-    'path'              : DEFAULT_WORKSPACE_DIR,
-    'target'            : DEFAULT_BUILD_TARGET,
-    'target_arch'       : DEFAULT_TARGET_ARCH,
-    'tool_chain_tag'    : DEFAULT_MSVC_TAG if (os.name == 'nt') else DEFAULT_XCODE_TAG if (sys.platform == 'darwin') else DEFAULT_GCC_TAG,
-}
-
-WORKSPACE['conf_path'] = os.environ.get('CONF_PATH', os.path.join(WORKSPACE['path'], 'Build', 'Conf'))
-
-# code tree layout for those remote repository(-ies).
-CODETREE = {
-    'edk2'              : {
-        'source'        : {
-            'url'       : DEFAULT_EDK2_REPO,
-            'signature' : DEFAULT_EDK2_TAG,
+        customized_settings[dv] = g[dv] = getattr(project, dv)
+
+    # update the dependent settings after settings of project.py are loaded.
+    if ('DEFAULT_UDK_DIR' not in customized_settings) and ({'DEFAULT_EDK2_TAG', 'DEFAULT_PUG_CACHE_DIR'} & set(customized_settings)):
+        DEFAULT_UDK_DIR = os.environ.get('UDK_DIR', os.path.join(DEFAULT_PUG_CACHE_DIR, DEFAULT_EDK2_TAG))
+
+    # basic global settings of WORKSPACE. Any relative-path is relative to the WORKSPACE-dir.
+    WORKSPACE = {
+        'path'              : DEFAULT_WORKSPACE_DIR,
+        'target'            : DEFAULT_BUILD_TARGET,
+        'target_arch'       : DEFAULT_TARGET_ARCH,
+        'tool_chain_tag'    : DEFAULT_MSVC_TAG if (os.name == 'nt') else DEFAULT_XCODE_TAG if (sys.platform == 'darwin') else DEFAULT_GCC_TAG,
+    }
+
+    WORKSPACE['conf_path'] = os.environ.get('CONF_PATH', os.path.join(WORKSPACE['path'], 'Build', 'Conf'))
+    WORKSPACE['pug_path'] = os.path.join(WORKSPACE['path'], 'Build', 'pug')     # pug's own state: manifest, logs, ...
+
+    # code tree layout for those remote repository(-ies).
+    # besides the 'git.<command>.arguments', a node takes:
+    #   'git.filter'         : a partial clone, 'blob:none' (or 'blobless') or 'tree:0' (or 'treeless'), of the tree and its submodules.
+    #   'git.sparse'         : the folders checked out, e.g. ['MdePkg', 'MdeModulePkg', 'BaseTools'], plus the packages referenced
+    #                          by PLATFORM and COMPONENT. only the submodules inside them are updated.
+    #   'git.submodule.jobs' : the submodules fetched at a time, DEFAULT_SUBMODULE_JOBS by default.
+    CODETREE = {
+        'edk2'              : {
+            'source'        : {
+                'url'       : DEFAULT_EDK2_REPO,
+                'signature' : DEFAULT_EDK2_TAG,
+            },
+            'recursive'     : True,
+            'multiworkspace': True,
+            'git.clone.arguments' : '--depth=1',
+            'git.fetch.arguments' : '--depth=1',
         },
-        'recursive'     : True,
-        'multiworkspace': True,
-        'git.clone.arguments' : '--depth=1',
-        'git.fetch.arguments' : '--depth=1',
-    },
-}
-CODETREE['edk2']['path'] = DEFAULT_UDK_DIR
-if DEFAULT_PATH_APPEND_SIGNATURE and CODETREE['edk2']['source'].get('signature', ''):
-    CODETREE['edk2']['path'] = os.path.join(CODETREE['edk2']['path'], CODETREE['edk2']['source'].get('signature', ''))
-
-# Conf/target.txt. Ref. BaseTools/Conf/target.template
-TARGET_TXT = {
-    'path'              : os.path.join(WORKSPACE['conf_path'], 'target.txt'),
-    'update'            : True,
-    'TOOL_CHAIN_CONF'   : 'tools_def.txt',
-    'BUILD_RULE_CONF'   : 'build_rule.txt',
-    'TARGET'            : WORKSPACE['target'],
-    'TARGET_ARCH'       : WORKSPACE['target_arch'],
-    'TOOL_CHAIN_TAG'    : WORKSPACE['tool_chain_tag'],
-    'ACTIVE_PLATFORM'   : '',
-}
-try:
-    TARGET_TXT['ACTIVE_PLATFORM'] = getattr(PLATFORM, 'path', '')
-except NameError:
-    pass
+    }
+    CODETREE['edk2']['path'] = DEFAULT_UDK_DIR
+    if DEFAULT_PATH_APPEND_SIGNATURE and CODETREE['edk2']['source'].get('signature', ''):
+        CODETREE['edk2']['path'] = os.path.join(CODETREE['edk2']['path'], CODETREE['edk2']['source'].get('signature', ''))
+
+    # Conf/target.txt. Ref. BaseTools/Conf/target.template
+    TARGET_TXT = {
+        'path'              : os.path.join(WORKSPACE['conf_path'], 'target.txt'),
+        'update'            : True,
+        'TOOL_CHAIN_CONF'   : 'tools_def.txt',
+        'BUILD_RULE_CONF'   : 'build_rule.txt',
+        'TARGET'            : WORKSPACE['target'],
+        'TARGET_ARCH'       : WORKSPACE['target_arch'],
+        'TOOL_CHAIN_TAG'    : WORKSPACE['tool_chain_tag'],
+        'ACTIVE_PLATFORM'   : '',
+    }
+    # the build matrix of '--pug:matrix'. each item is a list of the values to be combined.
+    MATRIX = {
+        'TARGET'            : WORKSPACE['target'].split(),
+        'TARGET_ARCH'       : [WORKSPACE['target_arch']],
+        'TOOL_CHAIN_TAG'    : [WORKSPACE['tool_chain_tag']],
+    }
 
-try:
-    if ACTIVE_PLATFORM:
-        pass
-except NameError:
+    TARGET_TXT['ACTIVE_PLATFORM'] = getattr(PLATFORM, 'path', '')
     ACTIVE_PLATFORM = DEFAULT_ACTIVE_PLATFORM
 
-for c in pCODETREE:
-    CODETREE[c] = pCODETREE[c]
-for c in pPLATFORM:
-    PLATFORM[c] = pPLATFORM[c]
-for c in pWORKSPACE:
-    WORKSPACE[c] = pWORKSPACE[c]
-for c in pCOMPONENT:
-    COMPONENT[c] = pCOMPONENT[c]
-for c in pTARGET_TXT:
-    TARGET_TXT[c] = pTARGET_TXT[c]
+    for c in pCODETREE:
+        CODETREE[c] = pCODETREE[c]
+    for c in pPLATFORM:
+        PLATFORM[c] = pPLATFORM[c]
+    for c in pWORKSPACE:
+        WORKSPACE[c] = pWORKSPACE[c]
+    if isinstance(pCOMPONENT, dict):
+        for c in pCOMPONENT:
+            COMPONENT[c] = pCOMPONENT[c]
+    else:
+        # a list of the components' settings.
+        COMPONENT = list(pCOMPONENT)
+    for c in pTARGET_TXT:
+        TARGET_TXT[c] = pTARGET_TXT[c]
+    for c in pMATRIX:
+        MATRIX[c] = pMATRIX[c]
 
 
 def dump_config():
@@ -154,6 +269,7 @@ def dump_config():
         'WORKSPACE:',       '  %s' % str(WORKSPACE),  '',
         'COMPONENT:',       '  %s' % str(COMPONENT),  '',
         'TARGET_TXT:',      '  %s' % str(TARGET_TXT), '',
+        'MATRIX:',          '  %s' % str(MATRIX),     '',
         'ACTIVE_PLATFORM:', '  %s' % ACTIVE_PLATFORM, '',
     ]
 
@@ -0,0 +1,156 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The task graph of build(): the tasks with their inputs, i.e. the tasks whose outputs they take, run as soon as
+those are done, concurrently with the other ready tasks.
+
+A task's function returns its rc. When a task fails, the tasks depending on it, directly or not, are skipped,
+and the others run on. A 'soft' task's failure is reported, but doesn't hold its dependents back.
+With jobs=1, the tasks run one by one in their declared order, which is then a topological order.
+"""
+
+__all__ = ['Task', 'run', 'check']
+
+import time
+import threading
+import concurrent.futures
+
+
+class Task(object):
+    """a task of the graph.
+    - deps: the names of the tasks whose outputs it takes.
+    - group: the name of a concurrency limit shared by the tasks, e.g. the git fetches.
+    - soft: its failure doesn't skip its dependents."""
+
+    def __init__(self, name, func, deps=(), group='', soft=False):
+        self.name = name
+        self.func = func
+        self.deps = list(deps)
+        self.group = group
+        self.soft = soft
+        self.state = 'pending'      # 'pending' -> 'running' -> 'done'/'failed', or 'skipped'
+        self.rc = None
+        self.error = None           # the exception raised by func
+        self.reason = ''            # why it's skipped
+        self.start = self.end = 0.0
+
+    @property
+    def seconds(self):
+        """the time it ran."""
+        return max(self.end - self.start, 0.0)
+
+    def __repr__(self):
+        return 'Task(%r, %s, rc=%r)' % (self.name, self.state, self.rc)
+
+
+def check(tasks):
+    """raise ValueError on a duplicate name, an unknown dependency or a cycle. returns {name: task}."""
+    by_name = {}
+    for t in tasks:
+        if t.name in by_name:
+            raise ValueError('duplicate task: %s' % t.name)
+        by_name[t.name] = t
+    for t in tasks:
+        unknown = [d for d in t.deps if d not in by_name]
+        if unknown:
+            raise ValueError('%s depends on unknown task(s): %s' % (t.name, ', '.join(unknown)))
+    visiting, visited = set(), set()
+
+    def visit(name, path):
+        if name in visited:
+            return
+        if name in visiting:
+            raise ValueError('dependency cycle: %s' % ' -> '.join(path + [name]))
+        visiting.add(name)
+        for d in by_name[name].deps:
+            visit(d, path + [name])
+        visiting.discard(name)
+        visited.add(name)
+
+    for t in tasks:
+        visit(t.name, [])
+    return by_name
+
+
+def run(tasks, jobs=0, limits=None, on_done=None):
+    """run the tasks, jobs at a time (0: all the ready ones), limits: {group: the tasks of the group at a time}.
+    the ready tasks start in their declared order. on_done(task) is called, in this thread, as each task finishes or is skipped.
+    returns the rc: the first failure's, in the declared order, of the tasks which aren't soft, or 0.
+    the first exception raised by a task is raised again once the running tasks finish."""
+    by_name = check(tasks)
+    limits = limits or {}
+    cond = threading.Condition()
+    finished = []
+
+    def _run(t):
+        t.start = time.time()
+        try:
+            t.rc = t.func() or 0
+        except BaseException as e:      # pylint: disable=broad-except
+            t.error, t.rc = e, 1
+        t.end = time.time()
+        with cond:
+            finished.append(t)
+            cond.notify()
+
+    def _blocked(t):
+        """the name of a dependency which failed or was skipped, or ''."""
+        for d in t.deps:
+            dep = by_name[d]
+            if dep.state == 'skipped' or (dep.state == 'failed' and not dep.soft):
+                return d
+        return ''
+
+    running = {}
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=jobs or len(tasks) or 1)
+    try:
+        while True:
+            # skip the tasks blocked by a failure, then start the ready ones, in the declared order.
+            for t in tasks:
+                if t.state != 'pending':
+                    continue
+                blocker = _blocked(t)
+                if blocker:
+                    t.state, t.reason = 'skipped', '%s %s' % (blocker, by_name[blocker].state)
+                    if on_done:
+                        on_done(t)
+                    continue
+                if any(by_name[d].state not in {'done', 'failed'} for d in t.deps):
+                    continue
+                if jobs and len(running) >= jobs:
+                    if jobs == 1:
+                        break       # one by one: keep the declared order
+                    continue
+                if t.group in limits and sum(1 for r in running.values() if r.group == t.group) >= int(limits[t.group]):
+                    if jobs == 1:
+                        break
+                    continue
+                t.state = 'running'
+                running[t.name] = t
+                pool.submit(_run, t)
+            if not running:
+                break
+            with cond:
+                while not finished:
+                    cond.wait()
+                done, finished[:] = list(finished), []
+            for t in done:
+                del running[t.name]
+                t.state = 'failed' if t.rc else 'done'
+                if on_done:
+                    on_done(t)
+    finally:
+        pool.shutdown(wait=True)
+
+    for t in tasks:
+        if t.error is not None:
+            raise t.error
+    for t in tasks:
+        if t.state == 'failed' and not t.soft:
+            return t.rc
+    return 0
@@ -0,0 +1,139 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The streaming emitter of the generated files, e.g. the DSC and the INF files.
+
+The lines are written to a temporary file next to the target and hashed on the way, so the memory use is flat
+in the size of the file. On commit, the temporary file atomically replaces the target, unless the target's
+content is already identical, in which case the target, and its mtime, are left untouched.
+"""
+
+__all__ = ['Emitter', 'iter_section']
+
+import os
+import hashlib
+import threading
+
+chunk_size = 256 * 1024      # the bytes buffered between the writes, and read per chunk when comparing
+
+
+def iter_section(items, override=None, section='', sep='=', ident=0):
+    """yield the lines of a section"""
+    if section:
+        yield '\n%s[%s]' % (' '*ident*2, section)
+    if items:
+        if isinstance(items, (tuple, list)) or (override in {list, tuple}):
+            for d in items:
+                if d:
+                    if isinstance(d, (list, tuple)):
+                        yield '%s%s' % (' '*(ident+1)*2, sep.join(d))
+                    else:
+                        yield '%s%s' % (' '*(ident+1)*2, str(d))
+        elif isinstance(items, dict):
+            for d in sorted(items):
+                if d:
+                    yield '%s%s %s %s' % (' '*(ident+1)*2, str(d), sep, str(items[d]))
+
+
+def file_digest(path):
+    """the sha256 of a text file's content, read in chunks. '' when it's unreadable."""
+    h = hashlib.sha256()
+    try:
+        with open(path, 'r') as fin:
+            for chunk in iter(lambda: fin.read(chunk_size), ''):
+                h.update(chunk.encode('utf-8'))
+    except (IOError, OSError, UnicodeDecodeError):
+        return ''
+    return h.hexdigest()
+
+
+class Emitter(object):
+    """write a generated file incrementally, then commit it atomically.
+    - known: the file's manifest entry, {'digest', 'size', 'mtime'}; when it says the file is identical, the file isn't read back.
+    - as a context manager, the file is committed on a normal exit, and discarded on an exception."""
+
+    def __init__(self, path, signature='', known=None):
+        self.path = path
+        self.known = known
+        self.digest = ''
+        self.changed = False
+        self.sha = hashlib.sha256()
+        self.buf, self.buf_size = [], 0     # the text buffered up to chunk_size
+        path_dir = os.path.dirname(path)
+        if path_dir and not os.path.exists(path_dir):
+            os.makedirs(path_dir)
+        self.tmp_path = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        self.fout = open(self.tmp_path, 'w')
+        if signature:
+            self.write(signature)
+
+    def write(self, text):
+        """write a text as it is."""
+        self.buf.append(text)
+        self.buf_size += len(text)
+        if self.buf_size >= chunk_size:
+            self.flush()
+
+    def line(self, text):
+        """write a line."""
+        self.write(text + '\n')
+
+    def lines(self, lines):
+        """write the lines."""
+        for l in lines:
+            self.write(l + '\n')
+
+    def flush(self):
+        """hash and write the buffered text."""
+        text = ''.join(self.buf)
+        self.sha.update(text.encode('utf-8'))
+        self.fout.write(text)
+        self.buf, self.buf_size = [], 0
+
+    def section(self, items, override=None, section='', sep='=', ident=0):
+        """write a section, ref. iter_section()."""
+        self.lines(iter_section(items, override, section, sep, ident))
+
+    def commit(self):
+        """replace the target with the written content, unless it's identical. returns the content's digest."""
+        self.flush()
+        self.fout.close()
+        self.digest = self.sha.hexdigest()
+        known = self.known
+        unchanged = False
+        if known and known.get('digest', '') == self.digest:
+            try:
+                st = os.stat(self.path)
+                unchanged = st.st_size == known.get('size', -1) and st.st_mtime_ns == known.get('mtime', -1)
+            except OSError:
+                pass
+        if not unchanged and os.path.exists(self.path):
+            unchanged = file_digest(self.path) == self.digest
+        if unchanged:
+            os.remove(self.tmp_path)
+        else:
+            os.replace(self.tmp_path, self.path)
+            self.changed = True
+        return self.digest
+
+    def abort(self):
+        """discard the written content."""
+        self.fout.close()
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
@@ -0,0 +1,439 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The build farm: a coordinator ('ipug farm') hands the build jobs over to the worker agents ('ipug serve-worker').
+
+The protocol is a JSON object per line over TCP. The coordinator connects to the workers:
+    coordinator -> worker: {'op': 'hello', 'token'}, {'op': 'job', 'id', 'workspace', 'argv', 'env'}, {'op': 'bye'}
+    worker -> coordinator: {'op': 'hello', 'name', 'slots'}, {'op': 'log', 'id', 'line'},
+                           {'op': 'done', 'id', 'rc', 'elapsed', 'artifacts'}, {'op': 'error', 'message'}
+A job runs 'ipug <argv>' in its workspace, with env added to the environment, e.g. {'BUILD_TARGET': 'DEBUG'}.
+The workspace is a path on the worker's side, e.g. on a shared file system.
+
+The jobs are dispatched to the workers' free slots, the longest expected first (the historical durations),
+so that a long job doesn't start last. The job of a lost worker is handed over to another worker.
+The jobs of a workspace run one at a time, on any worker: they share its Build folder, i.e. the outputs,
+the Conf folder and Build/pug/manifest.json, and a job's artifacts are the files it modified there.
+A worker kills the jobs of a coordinator which disconnects, as they are handed over to another worker.
+
+A job runs the project.py of its workspace: a worker requires a token, even on a loopback address, as the other users
+of the host may connect to it, and it runs the jobs of the workspaces it's given only, with the env keys of job_env only.
+"""
+
+__all__ = ['Worker', 'Coordinator', 'execute', 'artifacts', 'job_key', 'token_file']
+
+import os
+import sys
+import hmac
+import stat
+import json
+import time
+import signal
+import socket
+import hashlib
+import secrets
+import threading
+import subprocess
+
+artifact_suffixes = ('.efi', '.fd', '.fv', '.rom', '.cap')
+max_retries = 2         # the times a job is handed over again after its worker is lost
+mtime_slack = 2.0       # the seconds of the file systems' coarse timestamps, when telling a job's artifacts
+job_env = ('BUILD_TARGET', 'TARGET_ARCH', 'TOOL_CHAIN_TAG')    # the environment variables a job may set
+
+
+def send(sock, lock, msg):
+    """send a message."""
+    data = (json.dumps(msg) + '\n').encode('utf-8')
+    with lock:
+        sock.sendall(data)
+
+
+def messages(sock):
+    """yield the received messages until the connection closes."""
+    with sock.makefile('r', encoding='utf-8', errors='replace') as fin:
+        for line in fin:
+            if line.strip():
+                yield json.loads(line)
+
+
+def job_key(job):
+    """the key of a job's historical duration."""
+    return hashlib.sha1(json.dumps([job.get('workspace', ''), job.get('argv', []), job.get('env', {})], sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def workspace_key(job):
+    """the key of a job's workspace: the jobs of a workspace run one at a time."""
+    return os.path.normcase(os.path.normpath(job.get('workspace', '')))
+
+
+def artifacts(workspace, since=0.0):
+    """the manifest of the build's artifacts, i.e. the *.efi/*.fd/... under Build/ modified since a time:
+    [{'path' (relative to the workspace), 'size', 'sha256'}]."""
+    ret = []
+    build_dir = os.path.join(workspace, 'Build')
+    for root, dirs, files in os.walk(build_dir):
+        dirs[:] = sorted(d for d in dirs if d != 'pug')
+        for f in sorted(files):
+            if not f.lower().endswith(artifact_suffixes):
+                continue
+            path = os.path.join(root, f)
+            try:
+                st = os.stat(path)
+                if st.st_mtime < since:
+                    continue
+                h = hashlib.sha256()
+                with open(path, 'rb') as fin:
+                    for chunk in iter(lambda: fin.read(1 << 20), b''):
+                        h.update(chunk)
+            except OSError:
+                continue
+            ret.append({'path': os.path.relpath(path, workspace), 'size': st.st_size, 'sha256': h.hexdigest()})
+    return ret
+
+
+def token_file(path):
+    """the token saved in a file, or a new random one saved there. the file is readable by its owner only.
+    raises ValueError for a file the others may read."""
+    path_dir = os.path.dirname(path)
+    if path_dir and not os.path.exists(path_dir):
+        os.makedirs(path_dir, exist_ok=True)
+    if not os.path.exists(path):
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'w') as fout:
+            fout.write(secrets.token_hex(32))
+        try:
+            os.link(tmp, path)      # the first one wins, when two of them start at once.
+        except FileExistsError:
+            pass
+        finally:
+            os.remove(tmp)
+    if os.name != 'nt' and stat.S_IMODE(os.stat(path).st_mode) & 0o077:
+        raise ValueError('%s is accessible to the others, please chmod 600 it' % path)
+    with open(path, 'r') as fin:
+        return fin.read().strip()
+
+
+def is_inside(path, folders):
+    """True when a path is one of the folders, or inside one of them, after resolving the symbolic links."""
+    path = os.path.normcase(os.path.realpath(path))
+    for folder in folders:
+        folder = os.path.normcase(os.path.realpath(folder))
+        if path == folder or path.startswith(folder.rstrip(os.sep) + os.sep):
+            return True
+    return False
+
+
+def kill(proc):
+    """kill a job's process, and its children, e.g. the EDK2 build's."""
+    try:
+        if os.name == 'nt':
+            proc.kill()
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        pass
+
+
+def execute(job, on_line, cancel=None):
+    """run a job, 'python -m ipug <argv>' in its workspace, calling on_line(line) for its output. returns the exit code.
+    the job is killed once the cancel event, when given, is set. a job setting an env key other than job_env's doesn't run."""
+    rejected = sorted(k for k in job.get('env', {}) if k not in job_env)
+    if rejected:
+        on_line('the job is rejected, its env keys are not allowed: %s' % ', '.join(rejected))
+        return -1
+    env = dict(os.environ)
+    env.update({k: str(v) for k, v in job.get('env', {}).items()})
+    env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__)))] + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else []))
+    env['PYTHONUNBUFFERED'] = '1'
+    try:
+        proc = subprocess.Popen([sys.executable, '-m', 'ipug'] + list(job.get('argv', [])), cwd=job['workspace'], env=env,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL, start_new_session=(os.name != 'nt'))
+    except OSError as e:
+        on_line('unable to run the job: %s' % e)
+        return -1
+    if cancel is not None:
+        def _watch():
+            while proc.poll() is None:
+                if cancel.wait(0.2):
+                    kill(proc)
+                    return
+        threading.Thread(target=_watch, daemon=True).start()
+    for line in iter(proc.stdout.readline, b''):
+        on_line(line.decode('utf-8', 'replace').rstrip('\r\n'))
+    proc.stdout.close()
+    return proc.wait()
+
+
+class Worker(object):
+    """a worker agent: it listens for the coordinators, and runs their jobs, up to slots at a time, and one at a time per workspace.
+    - workspaces: the folders of the jobs' workspaces, the jobs of the other workspaces are rejected.
+    - run_job(job, on_line, cancel): runs a job until the cancel event is set, returns its exit code. execute() by default.
+    - notify(text): reports the worker's activities.
+    raises ValueError without a token, or without a workspace."""
+
+    def __init__(self, host='127.0.0.1', port=0, slots=1, token='', workspaces=(), name='', run_job=None, notify=None):
+        if not token:
+            raise ValueError('a token is required')
+        if not workspaces:
+            raise ValueError('a workspace is required')
+        self.slots = max(1, slots)
+        self.slot = threading.BoundedSemaphore(self.slots)
+        self.workspaces = [os.path.abspath(w) for w in workspaces]
+        self.workspace_locks = {}   # {workspace: its lock}
+        self.lock = threading.Lock()
+        self.token = token
+        self.name = name or '%s:%d' % (socket.gethostname(), os.getpid())
+        self.run_job = run_job or execute
+        self.notify = notify or (lambda text: None)
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.server.bind((host, port))
+        self.server.listen(8)
+        self.address = self.server.getsockname()[:2]
+        self.closed = False
+
+    def serve_forever(self):
+        """accept the coordinators until close()."""
+        while not self.closed:
+            try:
+                conn, peer = self.server.accept()
+            except OSError:
+                break
+            threading.Thread(target=self.serve, args=(conn, peer), daemon=True).start()
+
+    def serve(self, conn, peer):
+        """serve a coordinator's connection."""
+        lock = threading.Lock()
+        running = []
+        lost = threading.Event()
+        try:
+            msgs = messages(conn)
+            hello = next(msgs, {})
+            if hello.get('op') != 'hello' or not hmac.compare_digest(str(hello.get('token', '')).encode('utf-8'), self.token.encode('utf-8')):
+                send(conn, lock, {'op': 'error', 'message': 'the token is rejected'})
+                self.notify('rejected %s:%d' % peer)
+                return
+            send(conn, lock, {'op': 'hello', 'name': self.name, 'slots': self.slots})
+            for msg in msgs:
+                if msg.get('op') == 'job':
+                    t = threading.Thread(target=self.job, args=(conn, lock, msg, lost), daemon=True)
+                    t.start()
+                    running.append(t)
+                elif msg.get('op') == 'bye':
+                    break
+            else:
+                # the coordinator is gone, and hands its jobs over to another worker: they must not run on here.
+                if any(t.is_alive() for t in running):
+                    self.notify('%s:%d is disconnected, killing its jobs' % peer)
+                lost.set()
+        except (OSError, ValueError) as e:
+            self.notify('%s:%d: %s' % (peer[0], peer[1], e))
+            lost.set()
+        finally:
+            for t in running:
+                t.join()
+            conn.close()
+
+    def job(self, conn, lock, job, lost):
+        """run a job once a slot and its workspace are free, streaming its output and its result back.
+        the job is killed, or doesn't run, once the coordinator is lost."""
+        with self.lock:
+            workspace_lock = self.workspace_locks.setdefault(workspace_key(job), threading.Lock())
+        with self.slot, workspace_lock:
+            if not lost.is_set():
+                self.run(conn, lock, job, lost)
+
+    def run(self, conn, lock, job, lost):
+        """run a job, streaming its output and its result back."""
+        jid = job.get('id')
+        self.notify('job %s: ipug %s @ %s' % (jid, ' '.join(job.get('argv', [])), job.get('workspace', '')))
+
+        def on_line(line):
+            try:
+                send(conn, lock, {'op': 'log', 'id': jid, 'line': line})
+            except OSError:
+                pass
+
+        start = time.time()
+        try:
+            if not is_inside(job['workspace'], self.workspaces):
+                raise ValueError('the workspace %s is not one of this worker\'s' % job['workspace'])
+            rc = self.run_job(job, on_line, lost)
+        except Exception as e:      # pylint: disable=broad-except
+            on_line('the job failed: %s' % e)
+            rc = -1
+        elapsed = time.time() - start
+        try:
+            found = artifacts(job['workspace'], start - mtime_slack) if rc == 0 else []
+        except (KeyError, OSError):
+            found = []
+        self.notify('job %s: rc=%d, %.1fs' % (jid, rc, elapsed))
+        try:
+            send(conn, lock, {'op': 'done', 'id': jid, 'rc': rc, 'elapsed': elapsed, 'artifacts': found})
+        except OSError:
+            pass
+
+    def close(self):
+        """stop listening."""
+        self.closed = True
+        try:
+            self.server.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server.close()
+
+
+class Coordinator(object):
+    """hand the jobs over to the workers, and collect their results.
+    - workers: the workers' [(host, port)].
+    - history_path: the JSON file of the jobs' historical durations.
+    - on_line(job, line): the jobs' output; notify(text): the coordinator's activities."""
+
+    def __init__(self, workers, history_path='', token='', on_line=None, notify=None, timeout=10.0):
+        self.workers = list(workers)
+        self.history_path = history_path
+        self.token = token
+        self.on_line = on_line or (lambda job, line: None)
+        self.notify = notify or (lambda text: None)
+        self.timeout = timeout
+        self.history = {}
+        if history_path:
+            try:
+                with open(history_path, 'r') as fin:
+                    self.history = json.load(fin)
+            except (IOError, OSError, ValueError):
+                pass
+        self.cond = threading.Condition()
+        self.pending, self.results, self.tries = [], {}, {}
+        self.busy = set()           # the workspaces of the jobs running
+        self.total = self.alive = 0
+
+    def expected(self, job):
+        """the expected duration of a job: its history, or the longest known one for a new job."""
+        return self.history.get(job_key(job), max(self.history.values()) if self.history else 0.0)
+
+    def run(self, jobs):
+        """run the jobs. returns their results in the jobs' order: [{'id', 'rc', 'elapsed', 'worker', 'artifacts'}]."""
+        jobs = [dict(job, id=i) for i, job in enumerate(jobs)]
+        self.pending = sorted(jobs, key=lambda j: -self.expected(j))
+        self.results, self.tries, self.busy, self.total = {}, {}, set(), len(jobs)
+        connections = []
+        for address in self.workers:
+            try:
+                sock = socket.create_connection(address, self.timeout)
+                sock.settimeout(None)
+            except OSError as e:
+                self.notify('worker %s:%d is unavailable: %s' % (address[0], address[1], e))
+                continue
+            connections.append((sock, address))
+        self.alive = len(connections)
+        if not self.alive:
+            with self.cond:
+                self.abandon('no worker is available')
+        threads = [threading.Thread(target=self.drive, args=c, daemon=True) for c in connections]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.save_history()
+        return [self.results[j['id']] for j in jobs]
+
+    def next_job(self):
+        """take the first pending job whose workspace isn't busy, or None. the caller holds the condition."""
+        for i, job in enumerate(self.pending):
+            if workspace_key(job) not in self.busy:
+                self.busy.add(workspace_key(job))
+                return self.pending.pop(i)
+        return None
+
+    def abandon(self, reason):
+        """fail the pending jobs, when no worker is left. the caller holds the condition."""
+        for job in self.pending:
+            self.results[job['id']] = {'id': job['id'], 'rc': -1, 'elapsed': 0.0, 'worker': '', 'artifacts': [], 'error': reason}
+        self.pending = []
+        self.cond.notify_all()
+
+    def drive(self, sock, address):
+        """feed a worker with the jobs until none is left."""
+        lock = threading.Lock()
+        outstanding = {}
+        name = '%s:%d' % address
+        try:
+            msgs = messages(sock)
+            send(sock, lock, {'op': 'hello', 'token': self.token})
+            hello = next(msgs, {})
+            if hello.get('op') != 'hello':
+                raise OSError(hello.get('message', 'no hello'))
+            name, slots = hello.get('name', name), int(hello.get('slots', 1))
+            self.notify('worker %s: %d slot(s)' % (name, slots))
+            while True:
+                with self.cond:
+                    while len(outstanding) < slots:
+                        job = self.next_job()
+                        if job is None:
+                            break
+                        outstanding[job['id']] = job
+                        send(sock, lock, {'op': 'job', 'id': job['id'], 'workspace': job['workspace'], 'argv': job.get('argv', []), 'env': job.get('env', {})})
+                        self.notify('job %d -> %s' % (job['id'], name))
+                    if not outstanding:
+                        # idle: wait for a job whose workspace is freed, or handed over from a lost worker, or for the end.
+                        while not any(workspace_key(j) not in self.busy for j in self.pending) and len(self.results) < self.total:
+                            self.cond.wait()
+                        if not self.pending:
+                            break
+                        continue
+                msg = next(msgs, None)
+                if msg is None:
+                    raise OSError('the connection is closed')
+                if msg.get('op') == 'log':
+                    job = outstanding.get(msg.get('id'))
+                    if job is not None:
+                        self.on_line(job, msg.get('line', ''))
+                elif msg.get('op') == 'done':
+                    job = outstanding.pop(msg.get('id'), None)
+                    if job is None:
+                        continue
+                    with self.cond:
+                        self.busy.discard(workspace_key(job))
+                        self.results[job['id']] = {'id': job['id'], 'rc': msg.get('rc', -1), 'elapsed': msg.get('elapsed', 0.0),
+                                                   'worker': name, 'artifacts': msg.get('artifacts', [])}
+                        if msg.get('rc', -1) == 0:
+                            key = job_key(job)
+                            old = self.history.get(key)
+                            self.history[key] = msg['elapsed'] if old is None else (old + msg['elapsed']) / 2.0
+                        self.cond.notify_all()
+            send(sock, lock, {'op': 'bye'})
+        except (OSError, ValueError) as e:
+            self.notify('worker %s is lost: %s' % (name, e))
+        finally:
+            sock.close()
+            with self.cond:
+                self.alive -= 1
+                for job in outstanding.values():
+                    self.busy.discard(workspace_key(job))
+                    self.tries[job['id']] = self.tries.get(job['id'], 0) + 1
+                    if self.tries[job['id']] > max_retries:
+                        self.results[job['id']] = {'id': job['id'], 'rc': -1, 'elapsed': 0.0, 'worker': name, 'artifacts': [], 'error': 'the workers are lost'}
+                    else:
+                        self.pending.insert(0, job)
+                if not self.alive and self.pending:
+                    self.abandon('all the workers are lost')
+                self.cond.notify_all()
+
+    def save_history(self):
+        """write the historical durations."""
+        if not self.history_path:
+            return
+        path_dir = os.path.dirname(self.history_path)
+        if path_dir and not os.path.exists(path_dir):
+            os.makedirs(path_dir)
+        tmp = '%s.%d.tmp' % (self.history_path, os.getpid())
+        with open(tmp, 'w') as fout:
+            json.dump(self.history, fout, indent=1, sort_keys=True)
+        os.replace(tmp, self.history_path)
@@ -0,0 +1,76 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The file copies of the Conf files: by a reflink (a copy-on-write clone), a hard link, or a plain copy.
+
+A copy replaces its destination atomically and takes the source's mtime, so that copying an unchanged
+source again leaves the destination's timestamps as they were.
+"""
+
+__all__ = ['copy_file', 'digest']
+
+import os
+import shutil
+import hashlib
+
+FICLONE = 0x40049409        # linux/fs.h: _IOW(0x94, 9, int)
+chunk_size = 256 * 1024
+
+
+def digest(path):
+    """the sha256 of a file's bytes, read in chunks."""
+    h = hashlib.sha256()
+    with open(path, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def reflink(src, dest):
+    """clone src into dest with the FICLONE ioctl (btrfs, xfs, ...). raises OSError when it's unsupported."""
+    try:
+        import fcntl        # pylint: disable=import-outside-toplevel
+    except ImportError:
+        raise OSError('reflink is not supported')
+    with open(src, 'rb') as fin, open(dest, 'wb') as fout:
+        fcntl.ioctl(fout.fileno(), FICLONE, fin.fileno())
+
+
+def copy_file(src, dest, mode='auto'):
+    """copy src to dest atomically, keeping src's mtime. returns the method used: 'hardlink', 'reflink' or 'copy'.
+    - 'hardlink': a hard link, falling back to 'auto' across the file systems. dest then shares src's inode,
+      so it must not be modified in place.
+    - 'auto': a reflink, falling back to a plain copy.
+    - 'copy': a plain copy."""
+    tmp = '%s.%d.tmp' % (dest, os.getpid())
+    method = ''
+    if mode == 'hardlink':
+        try:
+            os.link(src, tmp)
+            method = 'hardlink'
+        except OSError:
+            mode = 'auto'
+    if mode == 'auto':
+        try:
+            reflink(src, tmp)
+            method = 'reflink'
+        except OSError:
+            pass
+    try:
+        if not method:
+            shutil.copyfile(src, tmp)
+            method = 'copy'
+        if method != 'hardlink':
+            st = os.stat(src)
+            os.utime(tmp, ns=(st.st_atime_ns, st.st_mtime_ns))
+        os.replace(tmp, dest)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
+    return method
@@ -0,0 +1,310 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The change-impact index: which module INFs a changed file affects.
+
+The index is assimilated from:
+1. the COMPONENTs' Sources,
+2. the [Sources] of the INFs listed in the platform's DSC, and of the modules built under Build/,
+3. the compilers' dependency files (*.d, *.deps, deps.txt) and the module makefiles under Build/.
+   a module makefile maps its build folder to its INF (MODULE_DIR/MODULE_FILE),
+   and its STATIC_LIBRARY_FILES map the libraries to their consumers.
+
+Each input file is re-parsed only when its (mtime_ns, size) changes, and a Build/ folder is
+re-listed only when its mtime changes. The index is kept in a JSON file between the runs.
+"""
+
+__all__ = ['ImpactIndex', 'parse_inf', 'parse_dsc', 'parse_deps', 'parse_makefile']
+
+import os
+import re
+import json
+
+index_version = 1
+
+# the changed files with these suffixes, but not in the index, demand a full build.
+build_suffixes = {
+    '.c', '.h', '.s', '.asm', '.nasm', '.nasmb', '.asm16', '.vfr', '.uni', '.hfr', '.asl', '.aslc', '.act',
+    '.inf', '.dsc', '.dec', '.fdf', '.inc', '.idf', '.bmp', '.depex', '.dxs', '.cpp', '.hpp',
+}
+deps_suffixes = ('.d', '.deps')
+makefile_names = ('GNUmakefile', 'Makefile')
+
+re_section = re.compile(r'^\s*\[([^\]]+)\]')
+re_macro_def = re.compile(r'^([A-Za-z_][A-Za-z0-9_]*)\s*=\s*(.*)$')
+re_macro_ref = re.compile(r'\$\(([A-Za-z_][A-Za-z0-9_]*)\)')
+re_rule = re.compile(r'^(.*?[^\s:\\]):(?:\s|$)(.*)$')
+
+
+def fingerprint(path):
+    """(mtime_ns, size) of a file, None when it's missing."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return [st.st_mtime_ns, st.st_size]
+
+
+def read_lines(path):
+    """the logical lines of a text file: the comments stripped and the '\\' continuations joined."""
+    try:
+        with open(path, 'r', errors='replace') as fin:
+            text = fin.read()
+    except (IOError, OSError):
+        return []
+    return [l.strip() for l in text.replace('\\\r\n', ' ').replace('\\\n', ' ').splitlines()]
+
+
+def sections(lines):
+    """yield (the lowercase section names, the stripped line) of an INF/DSC's lines."""
+    names = []
+    for line in lines:
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+        m = re_section.match(line)
+        if m:
+            names = [n.strip().split('.')[0].lower() for n in m.group(1).split(',')]
+            continue
+        yield names, line
+
+
+def parse_inf(path):
+    """(the source files, True for a library) of an INF file."""
+    base = os.path.dirname(path)
+    sources, library = [], False
+    for names, line in sections(read_lines(path)):
+        if 'defines' in names and line.split('=', 1)[0].strip().upper() == 'LIBRARY_CLASS':
+            library = True
+        elif 'sources' in names:
+            f = line.split('|', 1)[0].strip()
+            if f:
+                sources.append(os.path.normpath(os.path.join(base, f)))
+    return sources, library
+
+
+def parse_dsc(path, search_dirs):
+    """the absolute paths of (the [Components] INFs, the library instance INFs) of a DSC, resolved against search_dirs."""
+    components, libraries = [], []
+    for names, line in sections(read_lines(path)):
+        if 'components' not in names and 'libraryclasses' not in names:
+            continue
+        f = line.split('{', 1)[0].strip()
+        instance = '|' in f
+        f = f.split('|', 1)[-1].strip().replace('$(WORKSPACE)/', '').replace('$(WORKSPACE)\\', '')
+        if not f.lower().endswith('.inf'):
+            continue
+        for d in search_dirs:
+            p = os.path.normpath(os.path.join(d, f))
+            if os.path.exists(p):
+                (libraries if instance or 'libraryclasses' in names else components).append(p)
+                break
+    return components, libraries
+
+
+def parse_deps(path):
+    """the prerequisites of a make-style dependency file."""
+    deps = []
+    for line in read_lines(path):
+        if not line:
+            continue
+        m = re_rule.match(line)
+        for d in (m.group(2) if m else line).split():
+            if not d.endswith(':'):
+                deps.append(d)
+    return deps
+
+
+def expand(value, macros, depth=8):
+    """expand the $(MACRO)s of a makefile value."""
+    for _ in range(depth):
+        v = re_macro_ref.sub(lambda m: macros.get(m.group(1), os.environ.get(m.group(1), m.group(0))), value)
+        if v == value:
+            break
+        value = v
+    return value
+
+
+def parse_makefile(path):
+    """the module INF, the module build folder and the static libraries of an EDK2 module makefile.
+    returns None for the other makefiles, e.g. the platform's."""
+    macros = {}
+    for line in read_lines(path):
+        m = re_macro_def.match(line)
+        if m:
+            macros[m.group(1)] = m.group(2).strip()
+    if 'MODULE_DIR' not in macros or 'MODULE_FILE' not in macros:
+        return None
+    return {
+        'inf': os.path.normpath(os.path.join(expand(macros['MODULE_DIR'], macros), expand(macros['MODULE_FILE'], macros))),
+        'build_dir': os.path.normpath(expand(macros.get('MODULE_BUILD_DIR', os.path.dirname(path)), macros)),
+        'libs': [os.path.normpath(expand(l, macros)) for l in macros.get('STATIC_LIBRARY_FILES', '').split()],
+    }
+
+
+class ImpactIndex(object):
+    """the index from the source files to the module INFs, persisted in a JSON file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.inputs = {}        # {input file: {'fp': fingerprint, ...the parsed result}}
+        self.dirs = {}          # {Build/ folder: [mtime_ns, sub-folders, the interesting files]}
+        self.components = {}    # {INF: [the sources from COMPONENT]}
+        self.platform = []      # the INFs of the DSC's [Components], not the library instances
+        try:
+            with open(path, 'r') as fin:
+                data = json.load(fin)
+            if data.get('version', 0) == index_version:
+                self.inputs, self.dirs = data['inputs'], data['dirs']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self.parsed = 0         # the number of the input files (re-)parsed by the latest update()
+
+    def save(self):
+        """write the index."""
+        if not os.path.exists(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as fout:
+            json.dump({'version': index_version, 'inputs': self.inputs, 'dirs': self.dirs}, fout)
+
+    def refresh(self, path, parse):
+        """re-parse an input file when its fingerprint changes."""
+        fp = fingerprint(path)
+        entry = self.inputs.get(path)
+        if fp is None:
+            self.inputs.pop(path, None)
+            return None
+        if entry is None or entry['fp'] != fp:
+            entry = dict(parse(path), fp=fp)
+            self.inputs[path] = entry
+            self.parsed += 1
+        return entry
+
+    def scan(self, root, seen):
+        """the deps files and the makefiles under root, re-listing only the folders whose mtime changed."""
+        found = []
+        todo = [root]
+        while todo:
+            d = todo.pop()
+            seen.add(d)
+            mtime = (fingerprint(d) or [None])[0]
+            if mtime is None:
+                continue
+            cached = self.dirs.get(d)
+            if cached is None or cached[0] != mtime:
+                subdirs, files = [], []
+                try:
+                    for e in os.scandir(d):
+                        if e.is_dir(follow_symlinks=False):
+                            subdirs.append(e.name)
+                        elif e.name.endswith(deps_suffixes) or e.name == 'deps.txt' or e.name in makefile_names:
+                            files.append(e.name)
+                except OSError:
+                    continue
+                cached = self.dirs[d] = [mtime, subdirs, files]
+            todo += [os.path.join(d, s) for s in cached[1]]
+            found += [os.path.join(d, f) for f in cached[2]]
+        return found
+
+    def update(self, dsc='', search_dirs=(), build_roots=(), components=None):
+        """refresh the index with the DSC's INFs, the Build/ folders' deps/makefiles and the COMPONENTs' Sources."""
+        self.parsed = 0
+        live = set()
+        self.components = {}
+        for comp in components or []:
+            inf = os.path.normpath(comp['path'])
+            sources = []
+            for s in comp:
+                if s.split('.')[0] == 'Sources':
+                    sources += [os.path.normpath(os.path.join(os.path.dirname(inf), (f if isinstance(f, str) else f[0]).split('|')[0].strip())) for f in comp[s] if f]
+            self.components[inf] = sources
+        seen = set()
+        for root in build_roots:
+            for f in self.scan(os.path.abspath(root), seen):
+                if os.path.basename(f) in makefile_names:
+                    entry = self.refresh(f, lambda p: dict(parse_makefile(p) or {}, kind='makefile'))
+                else:
+                    entry = self.refresh(f, lambda p: {'kind': 'deps', 'deps': parse_deps(p)})
+                if entry:
+                    live.add(f)
+        self.platform, libraries = [], []
+        if dsc:
+            entry = self.refresh(dsc, lambda p: dict(zip(('components', 'libraries'), parse_dsc(p, search_dirs)), kind='dsc'))
+            if entry:
+                live.add(dsc)
+                self.platform, libraries = entry['components'], entry['libraries']
+        for inf in set(self.platform) | set(libraries) | set(self.components) | set(self.modules().values()):
+            if self.refresh(inf, lambda p: dict(zip(('sources', 'library'), parse_inf(p)), kind='inf')):
+                live.add(inf)
+        for p in set(self.inputs) - live:
+            del self.inputs[p]
+        for d in set(self.dirs) - seen:
+            del self.dirs[d]
+
+    def modules(self):
+        """{the build folder: the INF} of the module makefiles."""
+        return {e['build_dir']: e['inf'] for e in self.inputs.values() if e['kind'] == 'makefile' and e.get('inf')}
+
+    def is_library(self, inf):
+        """True when the INF defines a LIBRARY_CLASS."""
+        return self.inputs.get(inf, {}).get('library', False)
+
+    def sources(self):
+        """{a source file: {the INFs using it}}."""
+        ret = {}
+        build_dirs = self.modules()
+        for inf, sources in self.components.items():
+            for s in sources:
+                ret.setdefault(s, set()).add(inf)
+        for path, e in self.inputs.items():
+            if e['kind'] == 'inf':
+                for s in e['sources']:
+                    ret.setdefault(s, set()).add(path)
+            elif e['kind'] == 'deps':
+                # a deps file lives in its module's build folder, or below it, e.g. OUTPUT/.
+                d = os.path.dirname(path)
+                while d and d not in build_dirs and os.path.dirname(d) != d:
+                    d = os.path.dirname(d)
+                inf = build_dirs.get(d)
+                if inf:
+                    for s in e['deps']:
+                        ret.setdefault(os.path.normpath(s), set()).add(inf)
+        return ret
+
+    def consumers(self):
+        """{a library INF: {the module INFs linking it}}."""
+        build_dirs = self.modules()
+        ret = {}
+        for e in self.inputs.values():
+            if e['kind'] != 'makefile' or not e.get('inf'):
+                continue
+            for lib in e['libs']:
+                # $(BIN_DIR)/<module>/<base-name>/OUTPUT/<base-name>.lib
+                lib_inf = build_dirs.get(os.path.dirname(os.path.dirname(lib)))
+                if lib_inf:
+                    ret.setdefault(lib_inf, set()).add(e['inf'])
+        return ret
+
+    def affected(self, changed):
+        """(the affected module INFs, the changed files beyond the index, which demand a full build).
+        a changed library's consumers are affected as well."""
+        sources = self.sources()
+        known_infs = set(self.components) | {p for p, e in self.inputs.items() if e['kind'] == 'inf'} | set(self.modules().values())
+        modules, unresolved = set(), set()
+        for p in changed:
+            p = os.path.normpath(os.path.abspath(p))
+            if p in known_infs:
+                modules.add(p)
+            elif p in sources:
+                modules |= sources[p]
+            elif os.path.splitext(p)[1].lower() in build_suffixes:
+                unresolved.add(p)
+        consumers = self.consumers()
+        for lib in [m for m in modules if self.is_library(m) or m in consumers]:
+            modules |= consumers.get(lib, set())
+        return modules, unresolved
@@ -38,21 +38,52 @@ TODO:
 from __future__ import print_function
 from __future__ import absolute_import
 
-__all__ = ['build', 'build_basetools', 'run', 'setup_codetree', 'main']
+__all__ = ['build', 'build_basetools', 'run', 'run_async', 'run_group', 'run_many', 'setup_codetree', 'main']
 
 import os
 import sys
 import time
 import shutil
+import signal
+import tarfile
+import types
+import asyncio
+import contextlib
+import re
+import shlex
+import json
+import hashlib
+import itertools
+import platform
 import threading
+import selectors
+import collections
 import subprocess
 import multiprocessing
+import http.client
+import concurrent.futures
 
 from . import config             # Invoke config.py in the same folder
+from . import cache
+from . import trace
+from .jobserver import JobServer
+from .buildreport import BuildAnalyzer
+from . import compilercache
+from . import filecopy
+from . import farm
+from . import bincache
+from . import dag
+from . import log
+from .emitter import Emitter, iter_section
+from . import watch as watcher
+from .impact import ImpactIndex
 
 sys.dont_write_bytecode = True      # To inhibit the creation of .pyc file
 
 dry_run = False
+jobserver = None                    # the GNU make jobserver shared by the child makes, see setup_jobserver()
+impact_changes = None               # the changed files of '--pug:changed'/'--pug:diff': rebuild only the affected modules
+farm_jobs_path = ''                 # the jobs of 'ipug farm', '--pug:farm-jobs=<file>'
 
 if dry_run:
     VERBOSE_THRESHOLD = -1
@@ -67,7 +98,15 @@ default_pug_signature = '#\n# Do not edit this file.\n# It is automatically crea
 
 edk2_actions = ['all', 'fds', 'genc', 'genmake', 'clean', 'cleanall', 'cleanlib', 'modules', 'libraries', 'run']
 pug_action_clean = ['clean', 'cleanall']
-pug_action_all = ['build', 'setup', 'clean', 'cleanall', 'init', 'init-basetools', 'clean-basetools', 'help']
+pug_action_all = ['build', 'setup', 'clean', 'cleanall', 'init', 'init-basetools', 'clean-basetools', 'prefetch', 'watch', 'farm', 'serve-worker', 'help']
+
+run_log_keep = 10            # the number of the latest invocations whose run() logs are kept.
+manifest_version = 2         # bump it when the generated contents change for the same inputs.
+
+basetools_source_suffixes = {'.c', '.h', '.cpp', '.hpp', '.S', '.s', '.asm', '.nasm', '.makefile', '.mk'}
+basetools_source_names = {'Makefile', 'GNUmakefile'}
+git_filters = {'blobless': 'blob:none', 'treeless': 'tree:0'}     # the aliases of the partial clone filters of 'git.filter'
+matrix_keys = ['TARGET', 'TARGET_ARCH', 'TOOL_CHAIN_TAG']           # the keys of MATRIX and '--pug:matrix=KEY=...'
 
 
 def pwdpopd(target_dir=''):
@@ -86,19 +125,10 @@ def pwdpopd(target_dir=''):
 pwdpopd.pushd = []
 
 
-def bowwow(msg, noise_pitch=0, no_clobber=False):
-    """display some tagged progress messages when iPug is running."""
-    if noise_pitch >= VERBOSE_THRESHOLD:
-        if no_clobber:
-            print(msg)
-        else:
-            pugsay = 'PUG: '
-            if msg.startswith('\n'):
-                print('\n')
-                msg = msg[1:]
-            msg = msg.replace('\n', '\n{}'.format(pugsay))
-            print('{0}{1}'.format(pugsay, str(msg)))
-        sys.stdout.flush()
+def bowwow(msg, noise_pitch=0, no_clobber=False, cmd=0):
+    """display some tagged progress messages when iPug is running, those of noise_pitch >= VERBOSE_THRESHOLD.
+    the messages are written by the log writer in batches, ref. log.emit(). cmd: the id of the run() command it's about."""
+    log.emit(str(msg), noise_pitch, noise_pitch >= VERBOSE_THRESHOLD, no_clobber, cmd)
 
 
 def abs_path(sub_dir, base_dir):
@@ -106,148 +136,433 @@ def abs_path(sub_dir, base_dir):
     return sub_dir if os.path.isabs(sub_dir) else os.path.join(base_dir, sub_dir)
 
 
-def write_file(path, content, signature=''):
+def write_file(path, content, signature='', known=None):
     """update a platform's dsc file content.
     - create the folder when it does not exist.
-    - skip write attempt when the contents are identical"""
-
-    if isinstance(content, (list, tuple)):
-        content = '\n'.join(content)
-        if not content.endswith('\n'):
-            content += '\n'
-    if signature:
-        content = signature + content
-    path_dir = os.path.dirname(path)
-    content0 = ''
-    if not os.path.exists(path_dir):
-        os.makedirs(path_dir)
-    else:
-        if os.path.exists(path):
-            with open(path, 'r') as pf:
-                content0 = pf.read()
-            if content0 == content:
-                return
-    with open(path, 'w') as pf:
-        pf.write(content)
+    - skip write attempt when the contents are identical
+    - skip the read-back when the known manifest entry of the file says it's identical.
+    - replace the file atomically.
+    returns the content's digest."""
+
+    with Emitter(path, signature, known) as out:
+        if isinstance(content, (list, tuple)):
+            out.lines(content)
+        else:
+            out.write(content)
+    return out.digest
+
 
+def fingerprint(*inputs):
+    """a canonical hash of the config inputs of a generated file.
+    a list, or a generator, is hashed item by item, so that a large one, e.g. the components, isn't serialized at once."""
+    h = hashlib.sha256(json.dumps(manifest_version).encode('utf-8'))
+    for i in inputs:
+        h.update(b'\1')
+        for item in (i if isinstance(i, (list, types.GeneratorType)) else [i]):
+            h.update(b'\0' + json.dumps(item, sort_keys=True, default=repr).encode('utf-8'))
+    return h.hexdigest()
 
-def conf_files(files, dest_conf_dir, cmd_arg, verbose=False):
-    """Ref. BaseTools/BuildEnv for build_rule.txt , tools_def.txt and target.txt"""
+
+def load_manifest(path):
+    """load the manifest of the generated files: {path: {'input', 'digest', 'size', 'mtime'}}"""
+    try:
+        with open(path, 'r') as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_manifest(path, manifest):
+    """save the manifest of the generated files."""
+    write_file(path, json.dumps(manifest, indent=1, sort_keys=True))
+
+
+def is_file_unchanged(path, known):
+    """True when the file's size and mtime are those recorded in its manifest entry."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return False
+    return st.st_size == known.get('size', -1) and st.st_mtime_ns == known.get('mtime', -1)
+
+
+def is_generated_current(manifest, path, fp):
+    """True when a generated file was created from the same inputs and has not been touched since."""
+    if manifest is None:
+        return False
+    known = manifest.get(path, None)
+    return bool(known) and known.get('input', '') == fp and is_file_unchanged(path, known)
+
+
+def update_generated(manifest, path, fp, content, signature=''):
+    """(re)generate a file and record it in the manifest."""
+    with generated_file(manifest, path, fp, signature) as out:
+        out.lines(content)
+
+
+@contextlib.contextmanager
+def generated_file(manifest, path, fp, signature=''):
+    """(re)generate a file through a streaming Emitter, and record it in the manifest."""
+    known = manifest.get(path, None) if manifest is not None else None
+    with Emitter(path, signature, known) as out:
+        yield out
+    if manifest is not None:
+        st = os.stat(path)
+        manifest[path] = {'input': fp, 'digest': out.digest, 'size': st.st_size, 'mtime': st.st_mtime_ns}
+
+
+def conf_file_status(src_conf_path, dest_conf_path, manifest, key=''):
+    """(True when the copy of a Conf template is current, the template's [mtime, size], the template's digest).
+    the copy is current when the template's digest and the overrides' key are those recorded, and it's untouched since."""
+    known = manifest.get('conf:%s' % dest_conf_path, {})
+    st = os.stat(src_conf_path)
+    template = [st.st_mtime_ns, st.st_size]
+    tdigest = known['template_digest'] if known.get('template', None) == template else filecopy.digest(src_conf_path)
+    # a copy since regenerated by pug, e.g. target.txt, is as current as the copy itself.
+    current = known.get('template_digest', '') == tdigest and known.get('overrides', '') == key and \
+        (is_file_unchanged(dest_conf_path, known) or is_file_unchanged(dest_conf_path, manifest.get(dest_conf_path, {})))
+    return current, template, tdigest
+
+
+def conf_files(files, dest_conf_dir, cmd_arg, verbose=False, manifest=None, overrides=None):
+    """Ref. BaseTools/BuildEnv for build_rule.txt , tools_def.txt and target.txt
+    with a manifest, a file is copied from its template only when the template's digest or the overrides changed,
+    or the copy was touched since; otherwise the copy, and its mtime, are left as they are.
+    the copy is made by DEFAULT_CONF_COPY, ref. filecopy.copy_file(); 'always' copies on every setup.
+    - overrides: {file: (a key, a function modifying the copy in place)}, applied on every copy and when the key changes."""
     dest_conf_dir = os.path.abspath(dest_conf_dir)
     if not os.path.exists(dest_conf_dir):
         os.makedirs(dest_conf_dir)
     os.environ['CONF_PATH'] = dest_conf_dir
     if cmd_arg[0] in {'setup', 'init'}:
         src_conf_dir = os.path.join(os.environ.get('EDK_TOOLS_PATH', os.path.join(os.environ['WORKSPACE'], 'BaseTools')), 'Conf')
+        mode = config.DEFAULT_CONF_COPY
         for f in files:
             src_conf_path = os.path.join(src_conf_dir, '%s.template' % f)
             dest_conf_path = os.path.join(dest_conf_dir, '%s.txt' % f)
+            key, apply_overrides = (overrides or {}).get(f, ('', None))
+            if manifest is None or mode == 'always':
+                if verbose:
+                    bowwow('Copy %s\nTo   %s' % (src_conf_path, dest_conf_path), noise_pitch=1)
+                shutil.copyfile(src_conf_path, dest_conf_path)
+                if apply_overrides:
+                    apply_overrides(dest_conf_path)
+                continue
+            current, template, tdigest = conf_file_status(src_conf_path, dest_conf_path, manifest, key)
+            if current:
+                continue
+            # a file modified in place must not be a hard link to its template.
+            method = filecopy.copy_file(src_conf_path, dest_conf_path, 'auto' if apply_overrides and mode == 'hardlink' else mode)
             if verbose:
-                bowwow('Copy %s\nTo   %s' % (src_conf_path, dest_conf_path), noise_pitch=1)
-            shutil.copyfile(src_conf_path, dest_conf_path)
+                bowwow('Copy %s\nTo   %s (%s)' % (src_conf_path, dest_conf_path, method), noise_pitch=1)
+            if apply_overrides:
+                apply_overrides(dest_conf_path)
+            st = os.stat(dest_conf_path)
+            manifest['conf:%s' % dest_conf_path] = {'template': template, 'template_digest': tdigest, 'overrides': key, 'size': st.st_size, 'mtime': st.st_mtime_ns}
 
 
 def gen_section(items, override=None, section='', sep='=', ident=0):
     """generate a section's content"""
-    ret_list = []
-    if section:
-        ret_list += ['\n%s[%s]' % (' '*ident*2, section)]
-    if items:
-        if isinstance(items, (tuple, list)) or (override in {list, tuple}):
-            for d in items:
-                if d:
-                    if isinstance(d, (list, tuple)):
-                        ret_list += ['%s%s' % (' '*(ident+1)*2, sep.join(d))]
-                    else:
-                        ret_list += ['%s%s' % (' '*(ident+1)*2, str(d))]
-        elif isinstance(items, dict):
-            ret_list += ['%s%s %s %s' % (' '*(ident+1)*2, str(d), sep, str(items[d])) for d in sorted(items) if d]
-    return ret_list
-
-
-def gen_target_txt(target_txt):
+    return list(iter_section(items, override, section, sep, ident))
+
+
+def gen_target_txt(target_txt, manifest=None):
     """generate the content of Conf/target.txt"""
+    fp = fingerprint(target_txt)
+    if is_generated_current(manifest, target_txt['path'], fp):
+        return
     tt = []
     for s in sorted(target_txt):
         if s.isupper():
             tt += ['%s = %s' % (s, target_txt[s])]
-    write_file(target_txt['path'], tt)
-
-
-def run(Command, WorkingDir='.', verbose=VERBOSE_THRESHOLD<=1):
+    update_generated(manifest, target_txt['path'], fp, tt)
+
+
+def run_log_path(Command):
+    """allocate the path of a log file of run(), in this invocation's own log folder.
+    only the latest few invocations' log folders are kept."""
+    with run_log_path.lock:
+        if not run_log_path.log_dir:
+            log_root = os.path.join(config.WORKSPACE['pug_path'], 'log')
+            run_log_path.log_dir = os.path.join(log_root, '%s-%d' % (time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+            os.makedirs(run_log_path.log_dir)
+            for d in sorted(os.listdir(log_root))[:-run_log_keep]:
+                shutil.rmtree(os.path.join(log_root, d), ignore_errors=True)
+        run_log_path.count += 1
+        name = os.path.basename(Command.split(None, 1)[0]) if Command.strip() else 'run'
+        return os.path.join(run_log_path.log_dir, '%03d-%s.log' % (run_log_path.count, ''.join(c if c.isalnum() else '_' for c in name)))
+run_log_path.lock = threading.Lock()
+run_log_path.log_dir = ''
+run_log_path.count = 0
+command_ids = itertools.count(1)        # the ids of run()'s commands, in the log
+run_captured = threading.local()        # .on: the thread's run() commands are captured rather than streamed, ref. captured()
+run_env = threading.local()             # .extra: the environment variables added to the thread's run() commands, ref. git_queries()
+
+
+class RunOutput(object):
+    """the bounded output capture of a command.
+    Only the last DEFAULT_RUN_TAIL_LINES lines of each stream are kept in memory;
+    once the output outgrows that, the whole output is streamed to a log file,
+    whose path is then appended to the stderr content."""
+
+    def __init__(self, Command, verbose=False, on_line=None, cmd=0):
+        self.command = Command
+        self.cmd = cmd
+        self.verbose = verbose
+        self.on_line = on_line
+        self.tail_lines = max(int(config.DEFAULT_RUN_TAIL_LINES), 1)
+        self.stdout = collections.deque(maxlen=self.tail_lines)
+        self.stderr = collections.deque(maxlen=self.tail_lines)
+        self.tail = collections.deque()
+        self.log = None
+        self.log_path = ''
+        self.lock = threading.Lock()
+
+    def feed(self, stream, msg):
+        """take a line of a stream, 'stdout' or 'stderr'."""
+        msg = msg.decode('utf-8', 'replace').rstrip()
+        with self.lock:
+            (self.stdout if stream == 'stdout' else self.stderr).append(msg)
+            if self.log:
+                self.log.write(msg + '\n')
+            elif len(self.tail) < self.tail_lines:
+                self.tail.append(msg)
+            else:
+                self.log_path = run_log_path(self.command)
+                self.log = open(self.log_path, 'w', encoding='utf-8')
+                self.log.write('\n'.join(list(self.tail) + [msg, '']))
+                self.tail.clear()
+            if self.verbose:
+                bowwow(msg, noise_pitch=1, no_clobber=True, cmd=self.cmd)
+            if self.on_line:
+                self.on_line(stream, msg)
+
+    def result(self, return_code):
+        """the (rc, stdout, stderr) tuple."""
+        if self.log:
+            self.log.close()
+            self.log = None
+            self.stderr.append('[the full output: %s]' % self.log_path)
+        return return_code, list(self.stdout), list(self.stderr)
+
+
+def run(Command, WorkingDir='.', verbose=VERBOSE_THRESHOLD<=1, on_line=None):
     """A derivative of EDK2's BaseTools/build/build.py::launch_command
 
+        The output is multiplexed by a single selector loop (a thread per stream on Windows),
+        and it is captured by RunOutput.
+        on_line(stream, line) is called for each line as it arrives, stream being 'stdout' or 'stderr'.
+
         returns
         [0] - error code
-        [1] - buffered stdout content, list
-        [2] - buffered stderr content, list
+        [1] - buffered stdout content (the tail), list
+        [2] - buffered stderr content (the tail), list
     """
-    stdout_buffer = []
-    stderr_buffer = []
 
-    def ReadMessage(From, To, ExitFlag):
-        """read message fro stream"""
-        while True:
-            Line = From.readline()
-            if Line:
-                To(Line.rstrip())
-            if not Line or ExitFlag.isSet():
-                break
+    def ReadMessage(From, stream):
+        """read message from stream (Windows)"""
+        for Line in iter(From.readline, b''):
+            output.feed(stream, Line)
+
+    def Multiplex(Proc):
+        """read the messages from both streams by a single selector loop (Posix)"""
+        sel = selectors.DefaultSelector()
+        partial = {}
+        for stream, From in (('stdout', Proc.stdout), ('stderr', Proc.stderr)):
+            sel.register(From, selectors.EVENT_READ, stream)
+            partial[stream] = b''
+        while sel.get_map():
+            for key, _ in sel.select():
+                stream = key.data
+                data = os.read(key.fd, 1 << 16)
+                if not data:
+                    sel.unregister(key.fileobj)
+                    if partial[stream]:
+                        output.feed(stream, partial[stream])
+                    continue
+                lines = (partial[stream] + data).split(b'\n')
+                partial[stream] = lines.pop()
+                for Line in lines:
+                    output.feed(stream, Line)
+        sel.close()
 
-    def __logger(msg, buf):
-        if isinstance(msg, bytes):
-            msg = msg.decode('utf-8')
-        if verbose:
-            bowwow('%s' % msg, noise_pitch=1)
-        buf += [msg]
+    if isinstance(Command, (list, tuple)):
+        Command = ' '. join(Command)
+    if getattr(run_captured, 'on', False):
+        verbose = False
 
-    def logger_stdout(msg):
-        """print message from stdout"""
-        __logger(msg, stdout_buffer)
+    # the child process runs in WorkingDir. The process-wide current directory stays intact,
+    # so that run() can be invoked by the concurrent threads.
+    WorkingDir = os.path.abspath(WorkingDir)
+    cmd = next(command_ids)
+    bowwow('Run: [%s] @ [%s]' % (Command, WorkingDir), noise_pitch=2, cmd=cmd)
 
-    def logger_stderr(msg):
-        """print message from stderr"""
-        __logger(msg, stderr_buffer)
+    if dry_run:
+        return 0, ['dry-run-stdout'], ['']
 
+    output = RunOutput(Command, verbose, on_line, cmd)
+    start_time = time.time()
+    capture = (not verbose) or (on_line is not None)
+    _stdout = subprocess.PIPE if capture else sys.stdout
+    _stderr = subprocess.PIPE if capture else sys.stderr
+    if not capture:
+        log.flush()     # the child writes to the console directly
+    extra = getattr(run_env, 'extra', None)
+    Proc = subprocess.Popen(Command, stdout=_stdout, stderr=_stderr, env=dict(os.environ, **extra) if extra else os.environ, cwd=WorkingDir, bufsize=-1, shell=True,
+                            pass_fds=jobserver.pass_fds() if jobserver else ())
+    if capture:
+        if os.name == 'nt':
+            readers = [threading.Thread(target=ReadMessage, args=(f, n), name='%s-Redirector' % n.upper()) for n, f in (('stdout', Proc.stdout), ('stderr', Proc.stderr))]
+            for t in readers:
+                t.start()
+            for t in readers:
+                t.join()
+        else:
+            Multiplex(Proc)
+    # waiting for program exit
+    return_code, rusage = wait_child(Proc)
+    trace.add_run(Command, WorkingDir, start_time, time.time(), return_code, rusage)
+    return output.result(return_code)
+
+
+def wait_child(Proc):
+    """wait for a child to exit.
+    returns the exit code, and the child's own (user CPU, system CPU, max RSS) when it's traced on Posix."""
+    if os.name == 'nt' or not trace.enabled:
+        return Proc.wait(), None
+    _, status, ru = os.wait4(Proc.pid, 0)
+    Proc.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    return Proc.returncode, (ru.ru_utime, ru.ru_stime, ru.ru_maxrss)
+
+
+async def run_async(Command, WorkingDir='.', env=None, verbose=False, on_line=None):
+    """the asyncio counterpart of run().
+    - the child runs in WorkingDir and with env (a snapshot of os.environ by default);
+      neither the process-wide current directory nor os.environ is touched.
+    - when the task is cancelled, the child's whole process group is killed.
+
+        returns (rc, stdout, stderr), the same as run()
+    """
     if isinstance(Command, (list, tuple)):
         Command = ' '. join(Command)
-
     WorkingDir = os.path.abspath(WorkingDir)
-    pwdpopd(WorkingDir)
-    bowwow('Run: [%s] @ [%s]' % (Command, WorkingDir), noise_pitch=2)
+    cmd = next(command_ids)
+    bowwow('Run: [%s] @ [%s]' % (Command, WorkingDir), noise_pitch=2, cmd=cmd)
 
     if dry_run:
         return 0, ['dry-run-stdout'], ['']
 
-    Proc = EndOfProcedure = StdOutThread = StdErrThread = None
-    _stdout = sys.stdout if verbose else subprocess.PIPE
-    _stderr = sys.stderr if verbose else subprocess.PIPE
-    Proc = subprocess.Popen(Command, stdout=_stdout, stderr=_stderr, env=os.environ, cwd=WorkingDir, bufsize=-1, shell=True)
-    if not verbose:
-        EndOfProcedure = threading.Event()
-        EndOfProcedure.clear()
-        if Proc.stdout:
-            StdOutThread = threading.Thread(target=ReadMessage, args=(Proc.stdout, logger_stdout, EndOfProcedure))
-            StdOutThread.setName('STDOUT-Redirector')
-            StdOutThread.setDaemon(False)
-            StdOutThread.start()
-        if Proc.stderr:
-            StdErrThread = threading.Thread(target=ReadMessage, args=(Proc.stderr, logger_stderr, EndOfProcedure))
-            StdErrThread.setName('STDERR-Redirector')
-            StdErrThread.setDaemon(False)
-            StdErrThread.start()
-        # waiting for program exit
-    Proc.wait()
-
-    return_code = -1
-    if Proc:
-        if Proc.stdout and StdOutThread:
-            StdOutThread.join()
-        if Proc.stderr and StdErrThread:
-            StdErrThread.join()
-        return_code = Proc.returncode
-    pwdpopd()
-    return return_code, stdout_buffer, stderr_buffer
+    output = RunOutput(Command, verbose, on_line, cmd)
+    start_time = time.time()
+    limit = 1 << 20
+    Proc = await asyncio.create_subprocess_shell(
+        Command, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        env=dict(os.environ) if env is None else env, cwd=WorkingDir, limit=limit,
+        start_new_session=(os.name != 'nt'), pass_fds=jobserver.pass_fds() if jobserver else ())
+
+    async def ReadMessage(From, stream):
+        while True:
+            try:
+                Line = await From.readuntil(b'\n')
+            except asyncio.IncompleteReadError as e:
+                Line = e.partial        # the last line, without a newline
+            except asyncio.LimitOverrunError:
+                Line = await From.read(limit)       # a line longer than the limit: fed in pieces, as run() does
+            if not Line:
+                break
+            output.feed(stream, Line)
+
+    try:
+        await asyncio.gather(ReadMessage(Proc.stdout, 'stdout'), ReadMessage(Proc.stderr, 'stderr'))
+        return_code = await Proc.wait()
+        trace.add_run(Command, WorkingDir, start_time, time.time(), return_code)
+        return output.result(return_code)
+    except BaseException:       # e.g. cancelled: the child doesn't outlive the task
+        kill_process_group(Proc)
+        await Proc.wait()
+        output.result(Proc.returncode)
+        raise
+
+
+def kill_process_group(Proc):
+    """kill a child and its descendants."""
+    if Proc.returncode is not None:
+        return
+    try:
+        if os.name == 'nt':
+            Proc.kill()
+        else:
+            os.killpg(Proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError):
+        pass
+
+
+async def run_group(tasks, jobs=0, fail_fast=False, elapsed=None):
+    """run a group of run_async() tasks, at most 'jobs' of them at a time (0: unbounded).
+    each task is a dict of run_async()'s arguments, e.g. {'Command': 'make', 'WorkingDir': d, 'env': e}.
+    with fail_fast, the pending/running tasks are cancelled once a task fails; a cancelled task's result is None.
+    the tasks' running times are appended to the 'elapsed' list, when it is given.
+
+        returns the list of the tasks' (rc, stdout, stderr), in the order of the tasks.
+    """
+    sem = asyncio.Semaphore(jobs if jobs > 0 else max(len(tasks), 1))
+    futures = []
+
+    times = [0.0] * len(tasks)
+
+    async def _one(i, t):
+        async with sem:
+            t0 = time.time()
+            r = await run_async(**t)
+            times[i] = time.time() - t0
+        if fail_fast and r[0]:
+            for f in futures:
+                if not f.done() and f is not asyncio.current_task():
+                    f.cancel()
+        return r
+
+    futures += [asyncio.ensure_future(_one(i, t)) for i, t in enumerate(tasks)]
+    results = await asyncio.gather(*futures, return_exceptions=True)
+    if elapsed is not None:
+        elapsed += times
+    ret = []
+    for r in results:
+        if isinstance(r, asyncio.CancelledError):
+            ret += [None]
+        elif isinstance(r, BaseException):
+            raise r
+        else:
+            ret += [r]
+    return ret
+
+
+def run_many(tasks, jobs=0, fail_fast=False):
+    """run a group of commands concurrently from the synchronous code. See run_group()."""
+    return asyncio.run(run_group(tasks, jobs, fail_fast))
+
+
+def captured(func):
+    """func, with the output of its run() commands captured rather than streamed to the console,
+    e.g. a task running alongside others. a failed command's output is shown by print_run_result()."""
+    def _run():
+        run_captured.on = True
+        try:
+            return func()
+        finally:
+            run_captured.on = False
+    return _run
+
+
+def git_queries(func):
+    """func, with the git of its run() commands taking no optional lock (GIT_OPTIONAL_LOCKS=0), i.e. leaving the index alone,
+    e.g. the plan's queries. the process' environment stays intact."""
+    def _run(*args, **kwargs):
+        run_env.extra = {'GIT_OPTIONAL_LOCKS': '0'}
+        try:
+            return func(*args, **kwargs)
+        finally:
+            run_env.extra = None
+    return _run
 
 
 def print_run_result(r, prompt=''):
@@ -331,21 +646,161 @@ def setup_env_vars(workspace, codetree):
             env_var('+PACKAGES_PATH', codetree[c]['path'])
 
 
+def basetools_cache_key(tools_dir):
+    """the cache key of the BaseTools binaries: a digest of the C sources, the compiler identity and the host triple."""
+    cc = os.environ.get('CC', 'gcc')
+    r = run([cc, '--version'], tools_dir, verbose=False)
+    compiler = r[1][0] if (not r[0] and r[1]) else cc
+    r = run([cc, '-dumpmachine'], tools_dir, verbose=False)
+    host = r[1][0] if (not r[0] and r[1]) else '%s-%s' % (platform.machine(), sys.platform)
+    sources = cache.tree_digest(os.path.join(tools_dir, 'Source', 'C'), exclude_dirs={'bin', 'libs'}, suffixes=basetools_source_suffixes, names=basetools_source_names)
+    return hashlib.sha256('\0'.join([sources, compiler, host]).encode('utf-8')).hexdigest()[:32]
+
+
+def copy_tree(src_dir, dest_dir):
+    """copy the files of a folder over another folder, keeping the modes and the timestamps."""
+    for dirpath, _, filenames in os.walk(src_dir):
+        dest_path = os.path.join(dest_dir, os.path.relpath(dirpath, src_dir))
+        if not os.path.exists(dest_path):
+            os.makedirs(dest_path)
+        for f in filenames:
+            shutil.copy2(os.path.join(dirpath, f), os.path.join(dest_path, f))
+
+
+def compiler_cache_path():
+    """the path of the compiler cache's wrapper (DEFAULT_COMPILER_CACHE), or ''. nothing is set up."""
+    if not config.DEFAULT_COMPILER_CACHE or os.name == 'nt':
+        return ''
+    return compilercache.find_wrapper(config.DEFAULT_COMPILER_CACHE)
+
+
+def compiler_cache_wrapper():
+    """the compiler cache's wrapper (DEFAULT_COMPILER_CACHE) with its environment variables set up, or ''.
+    the cache folder is DEFAULT_PUG_CACHE_DIR/ccache unless CCACHE_DIR is assigned."""
+    if not config.DEFAULT_COMPILER_CACHE or os.name == 'nt':
+        return ''
+    wrapper = compiler_cache_path()
+    if not wrapper:
+        bowwow('The compiler cache "%s" is not found. Building without it.' % config.DEFAULT_COMPILER_CACHE, noise_pitch=2)
+        return ''
+    env_var('=CCACHE_DIR', os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'ccache'))
+    env_var('=CCACHE_BASEDIR', os.environ['WORKSPACE'])
+    return wrapper
+
+
+def compiler_cache_overrides(wrapper, tags):
+    """the conf_files() overrides routing the compilers of tools_def.txt through the compiler cache."""
+    if not wrapper:
+        return {}
+    wrap_dir = os.path.join(config.WORKSPACE['pug_path'], 'ccache-bin')
+    return {'tools_def': (' '.join([wrapper, wrap_dir] + sorted(tags)), lambda path: compilercache.wrap_tools_def(path, tags, wrapper, wrap_dir))}
+
+
+def setup_compiler_cache(conf_dir, tags, wrapper=None):
+    """route the compilers of the tool chain tags in Conf/tools_def.txt through the compiler cache (DEFAULT_COMPILER_CACHE).
+    returns the wrapper's path, or ''."""
+    if wrapper is None:
+        wrapper = compiler_cache_wrapper()
+    if not wrapper:
+        return ''
+    tools_def = os.path.join(conf_dir, 'tools_def.txt')
+    if os.path.exists(tools_def):
+        n = compilercache.wrap_tools_def(tools_def, tags, wrapper, os.path.join(config.WORKSPACE['pug_path'], 'ccache-bin'))
+        bowwow('compiler cache: %s, %d tool path(s) newly wrapped, CCACHE_DIR=%s' % (wrapper, n, os.environ['CCACHE_DIR']), noise_pitch=1)
+    return wrapper
+
+
+def print_compiler_cache_stats(wrapper, stats0):
+    """print the hits and the misses of the compiler cache since the stats0 snapshot."""
+    if not wrapper or stats0 is None:
+        return
+    stats1 = compilercache.stats(wrapper)
+    if not stats1:
+        return
+    direct, preprocessed, miss = compilercache.stats_delta(stats0, stats1)
+    total = direct + preprocessed + miss
+    bowwow('compiler cache: %d hit(s) (direct %d, preprocessed %d), %d miss(es), hit rate %.1f%%' % (
+        direct + preprocessed, direct, preprocessed, miss, 100.0 * (direct + preprocessed) / total if total else 0.0), noise_pitch=1)
+
+
+def setup_jobserver():
+    """create/join the GNU make jobserver and export its MAKEFLAGS to the child processes (Posix only).
+    the pool has DEFAULT_JOBS tokens (cpu_count() by default), unless a parent jobserver is joined."""
+    global jobserver
+    if jobserver or os.name == 'nt' or config.DEFAULT_JOBSERVER == 'off' or dry_run:
+        return jobserver
+    jobserver = JobServer(int(config.DEFAULT_JOBS) or multiprocessing.cpu_count())
+    os.environ['MAKEFLAGS'] = jobserver.makeflags()
+    bowwow('jobserver: %s %d job(s), MAKEFLAGS=%s' % ('pug\'s own' if jobserver.owner else 'joined', jobserver.jobs, os.environ['MAKEFLAGS']), noise_pitch=1)
+    return jobserver
+
+
+def acquire_threads(args):
+    """the number of EDK2 build threads, i.e. '-n', taken from the jobserver's pool. 0: not sized by the jobserver.
+    the caller shall release them back to the jobserver."""
+    if not jobserver or '-n' in args:
+        return 0
+    return jobserver.acquire(jobserver.jobs)
+
+
+def basetools_status(home_dir, store):
+    """(the BaseTools cache key, True when the binaries are up-to-date, the path of the cache entry or '')."""
+    key = basetools_cache_key(home_dir)
+    try:
+        with open(os.path.join(home_dir, 'Source', 'C', 'bin', '.pug-basetools-key'), 'r') as fin:
+            if fin.read() == key:
+                return key, True, ''
+    except (IOError, OSError):
+        pass
+    hit = cache.entry_path(store, key)
+    return key, False, hit if os.path.isdir(hit) else ''
+
+
 def build_basetools(cmd=''):
-    """build the C-Lang executable binaries in BaseTools."""
+    """build the C-Lang executable binaries in BaseTools.
+    the binaries are restored from the BaseTools cache, when they were built before with the same sources and compiler."""
     if cmd[:2] == ['build', 'clean']:
         return 0
     home_dir = os.environ['EDK_TOOLS_PATH']
     cmds = [UDKBUILD_MAKETOOL]
 
-    if UDKBUILD_MAKETOOL == 'make':
+    if UDKBUILD_MAKETOOL == 'make' and not jobserver:
         cmds += [
             '--jobs', '%d' % multiprocessing.cpu_count()
         ]
-    if (cmd[0] == 'clean-basetools') or (cmd[:2] == ['build', 'cleanall']):
+    cleaning = (cmd[0] == 'clean-basetools') or (cmd[:2] == ['build', 'cleanall'])
+    if cleaning:
         cmds += ['clean']
 
-    r = run(cmds, home_dir)
+    store = os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'basetools')
+    store_size = int(config.DEFAULT_BASETOOLS_CACHE_SIZE) * 1024 * 1024
+    bin_dir = os.path.join(home_dir, 'Source', 'C', 'bin')
+    key_path = os.path.join(bin_dir, '.pug-basetools-key')
+    key = ''
+    if store_size > 0 and UDKBUILD_MAKETOOL == 'make' and not cleaning and not dry_run:
+        key, current, hit = basetools_status(home_dir, store)
+        if current:
+            bowwow('build_basetools(): the binaries are up-to-date.', noise_pitch=1)
+            return 0
+        if hit:
+            cache.lookup(store, key)
+            copy_tree(hit, bin_dir)
+            bowwow('build_basetools(): the binaries are restored from the cache %s' % hit, noise_pitch=1)
+            return 0
+
+    # with the jobserver, make's own job slot is a token held by pug; its other jobs take their tokens from the pool.
+    held = jobserver.acquire(1) if jobserver else 0
+    try:
+        r = run(cmds, home_dir)
+    finally:
+        if held:
+            jobserver.release(held)
+    if key and not r[0] and os.path.isdir(bin_dir):
+        with open(key_path, 'w') as fout:
+            fout.write(key)
+        cache.insert(store, key, bin_dir)
+        for k in cache.evict(store, store_size):
+            bowwow('build_basetools(): evict the cache entry %s' % k, noise_pitch=1)
     return print_run_result(r, 'build_basetools(): ')
 
 
@@ -363,85 +818,544 @@ def apply_patch(codetree, workspace):
     return print_run_result((r0, r1, r2), 'apply_patch(): ')
 
 
-def setup_codetree(codetree):
-    """pull the edk2 code tree when it does not locally/correctly exist.
-        1. git clone
-        2. git checkout tag/branch/master"""
-
-    def _get_code(node):
-        """get code using git clone/checkout"""
-        r = 0, [], []
-        local_dir = node['path']
-        dot_git = os.path.join(local_dir, '.git')
-        if not os.path.exists(local_dir):
-            os.makedirs(local_dir)
-
-        nsource = node.get('source', None)
-        if nsource is None:
-            return r
+def patch_command(command):
+    """(the folder, the 'git apply' options, the patch file, reversed) of a patch command which 'git apply --check' can evaluate:
+    'git [-C <dir>] apply|am [-p<n>] [--directory=<root>] [-R] <file>', or 'patch [-p<n>] [-d <dir>] [-R] [-i] <file>' or '< <file>'.
+    None for the other commands, e.g. a script or a compound command."""
+    try:
+        words = shlex.split(command) if isinstance(command, str) else [str(w) for w in command]
+    except ValueError:
+        return None
+    if any(w in {'&&', '||', ';', '|', '>', '>>'} for w in words):
+        return None
+    folder, options, files, reverse = '.', [], [], False
+    if words[:1] == ['git']:
+        words = words[1:]
+        while words[:1] == ['-C'] and len(words) > 1:
+            folder, words = os.path.join(folder, words[1]), words[2:]
+        if words[:1] not in (['apply'], ['am']):
+            return None
+        words = words[1:]
+        for w in words:
+            if re.match(r'^-p\d+$', w) or w.startswith('--directory='):
+                options.append(w)
+            elif w in {'-R', '--reverse'}:
+                reverse = True
+            elif not w.startswith('-'):
+                files.append(w)
+    elif words[:1] == ['patch']:
+        words, i = words[1:], 0
+        while i < len(words):
+            w = words[i]
+            nxt = words[i + 1] if i + 1 < len(words) else ''
+            if re.match(r'^-p\d+$', w) or w.startswith('--strip='):
+                options.append('-p' + (w[2:] if w.startswith('-p') else w[len('--strip='):]))
+            elif w == '-p' and nxt:
+                options.append('-p' + nxt)
+                i += 1
+            elif w in {'-d', '--directory'} and nxt:
+                folder = os.path.join(folder, nxt)
+                i += 1
+            elif w.startswith('--directory='):
+                folder = os.path.join(folder, w[len('--directory='):])
+            elif w in {'-i', '--input', '<'} and nxt:
+                files.append(nxt)
+                i += 1
+            elif w.startswith('--input='):
+                files.append(w[len('--input='):])
+            elif w in {'-R', '--reverse'}:
+                reverse = True
+            elif not w.startswith('-'):
+                return None     # the file to patch: beyond 'git apply'
+            i += 1
+        options = options or ['-p0']
+    else:
+        return None
+    if len(files) != 1:
+        return None
+    return folder, options, files[0], reverse
+
+
+def patch_state(command, workspace):
+    """the state of a patch command's patch in the workspace, by 'git apply --check', and '--check --reverse', leaving the tree alone:
+    'applicable', 'applied', 'conflicting', or '' when the command can't be evaluated."""
+    p = patch_command(command)
+    if p is None:
+        return ''
+    folder, options, path = abs_path(p[0], workspace), p[1], p[2]
+    if not os.path.isdir(folder) or not os.path.isfile(abs_path(path, folder)):
+        return ''
+    forward = run(['git', 'apply', '--check'] + options + [path], folder, verbose=False)[0] == 0
+    backward = run(['git', 'apply', '--check', '--reverse'] + options + [path], folder, verbose=False)[0] == 0
+    if p[3]:
+        forward, backward = backward, forward
+    return 'applicable' if forward else ('applied' if backward else 'conflicting')
+
+
+def mirror_path(url):
+    """return the path of the pug-managed bare mirror of a source url."""
+    name = os.path.basename(url.rstrip('/'))
+    if name.endswith('.git'):
+        name = name[:-4]
+    key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+    return os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'mirrors', '%s-%s.git' % (name, key))
+
+
+def resolve_url(base, url):
+    """resolve a relative submodule url against its superproject's url."""
+    if not url.startswith(('./', '../')):
+        return url
+    base = base.rstrip('/')
+    for part in url.split('/'):
+        if part == '..':
+            base = base.rsplit('/', 1)[0]
+        elif part and part != '.':
+            base += '/' + part
+    return base
+
+
+def update_mirror(url, verbose=False):
+    """create or refresh the bare mirror of a source url."""
+    mirror = mirror_path(url)
+    with update_mirror.locks.setdefault(mirror, threading.Lock()):
+        if os.path.exists(os.path.join(mirror, 'HEAD')):
+            return run(['git', 'fetch', '--prune', 'origin'], mirror, verbose=verbose)
+        if not os.path.exists(os.path.dirname(mirror)):
+            os.makedirs(os.path.dirname(mirror))
+        return run(['git', 'clone', '--mirror', url, mirror], os.path.dirname(mirror), verbose=verbose)
+update_mirror.locks = {}
+
+
+def mirror_submodules(url, rev, update=False, verbose=False, depth=0):
+    """list the (url, mirror) pairs of the submodules of a revision in the mirror of url, recursively.
+    when update is set, the submodules' mirrors are created or refreshed on the way."""
+    ret = []
+    mirror = mirror_path(url)
+    if depth > 8 or not os.path.exists(os.path.join(mirror, 'HEAD')):
+        return ret
+    r = run(['git', 'config', '--blob', '%s:.gitmodules' % rev, '--get-regexp', '"^submodule\\..*\\.(url|path)$"'], mirror, verbose=False)
+    if r[0]:
+        return ret
+    modules = {}
+    for line in r[1]:
+        kv = line.split(None, 1)
+        if len(kv) == 2:
+            name, key = kv[0][len('submodule.'):].rsplit('.', 1)
+            modules.setdefault(name, {})[key] = kv[1]
+    for m in modules.values():
+        if 'url' not in m or 'path' not in m:
+            continue
+        suburl = resolve_url(url, m['url'])
+        s = run(['git', 'rev-parse', '%s:%s' % (rev, m['path'])], mirror, verbose=False)
+        if s[0] or not s[1]:
+            continue
+        subrev = s[1][0]
+        submirror = mirror_path(suburl)
+        if update:
+            t = run(['git', 'cat-file', '-e', '%s^{commit}' % subrev], submirror, verbose=False) if os.path.exists(submirror) else (1,)
+            if t[0] and update_mirror(suburl, verbose)[0]:
+                continue
+        if os.path.exists(os.path.join(submirror, 'HEAD')):
+            ret += [(suburl, submirror)]
+            ret += mirror_submodules(suburl, subrev, update, verbose, depth + 1)
+    return ret
+
+
+def git_mirror_config(url, rev):
+    """git's '-c' arguments which redirect the submodules of a revision to their local mirrors."""
+    cfg = []
+    for suburl, submirror in mirror_submodules(url, rev):
+        cfg += ['-c', 'url.%s.insteadOf=%s' % (submirror, suburl)]
+    if cfg:
+        # the submodules are then cloned from the local mirrors, i.e. via the "file" protocol.
+        cfg += ['-c', 'protocol.file.allow=always']
+    return cfg
+
+
+def prefetch(codetree, signatures=None, verbose=False):
+    """refresh the mirrors of the CODETREE nodes ahead of time.
+    the edk2 mirror is checked against the signatures (the node's own signature by default),
+    and the mirrors of their submodules are refreshed as well."""
+    r0, r1, r2 = 0, [], []
+    for c, node in codetree.items():
+        nsource = node.get('source', None) or {}
         nsource_url = nsource.get('url', None)
-        nsource_cmd = nsource.get('command', None)
-        if nsource_url is None and nsource_cmd is None:
-            return r
+        if not nsource_url or nsource.get('command', None):
+            continue
+        mirror = mirror_path(nsource_url)
+        bowwow('prefetch(): [%s] %s\n  -> %s' % (c, nsource_url, mirror), noise_pitch=1)
+        s = update_mirror(nsource_url, verbose)
+        r0 |= s[0]
+        r1 += s[1]
+        r2 += s[2]
+        if s[0]:
+            continue
+        sigs = signatures if (c == 'edk2' and signatures) else [nsource.get('signature', '') or 'master']
+        for sig in sigs:
+            s = run(['git', 'rev-parse', '--verify', '-q', '%s^{commit}' % sig], mirror, verbose=False)
+            if s[0]:
+                r0 |= s[0]
+                r2 += ['prefetch(): [%s] %s is not found in %s' % (c, sig, nsource_url)]
+            elif node.get('recursive', ''):
+                mirror_submodules(nsource_url, sig, update=True, verbose=verbose)
+    return print_run_result((r0, r1, r2), 'prefetch(): ')
+
+
+def prefetch_signatures(args):
+    """the edk2 tags of 'ipug prefetch [edk2-tag ...]', or None when an argument isn't a tag, e.g. an EDK2 build option or a define."""
+    if any(a.startswith('-') or '=' in a for a in args):
+        return None
+    return [a for a in args if a]
+
+
+def git_rev(local_dir, rev):
+    """resolve a revision to its commit id in a local git tree, or '' when it does not resolve."""
+    if dry_run:
+        return ''
+    r = run(['git', 'rev-parse', '-q', '--verify', '%s^{commit}' % rev], local_dir, verbose=False)
+    return r[1][0] if (r[0] == 0 and r[1]) else ''
+
+
+def git_version():
+    """the version of git, e.g. (2, 39, 5), or (0,) when it's unknown."""
+    if git_version.cached is None:
+        r = run(['git', '--version'], '.', verbose=False)
+        m = re.search(r'(\d+)\.(\d+)(?:\.(\d+))?', r[1][0]) if (not r[0] and r[1]) else None
+        git_version.cached = tuple(int(x) for x in m.groups() if x) if m else (0,)
+    return git_version.cached
+git_version.cached = None
+
+
+def is_sparse_checkout(local_dir):
+    """True when a local git tree is a sparse checkout."""
+    r = run(['git', 'config', '--get', 'core.sparseCheckout'], local_dir, verbose=False)
+    return not r[0] and bool(r[1]) and r[1][0].strip() == 'true'
+
+
+def codetree_filter(node):
+    """the partial clone filter of a CODETREE node's 'git.filter', e.g. 'blob:none' (or 'blobless') and 'tree:0' (or 'treeless'), or ''."""
+    spec = node.get('git.filter', '') or ''
+    return git_filters.get(spec, spec)
+
+
+def referenced_packages():
+    """the top folders of the relative .dec/.dsc/.fdf/.inf paths in PLATFORM and COMPONENT, e.g. 'MdePkg' of 'MdePkg/MdePkg.dec'."""
+    ret, stack = set(), [getattr(config, 'PLATFORM', None), getattr(config, 'COMPONENT', None)]
+    while stack:
+        v = stack.pop()
+        if isinstance(v, dict):
+            stack += list(v.values())
+        elif isinstance(v, (list, tuple)):
+            stack += list(v)
+        elif isinstance(v, str) and v.lower().endswith(('.dec', '.dsc', '.fdf', '.inf')) and not os.path.isabs(v):
+            parts = v.replace('\\', '/').split('/')
+            if len(parts) > 1 and parts[0] not in {'', '.', '..'} and '$' not in parts[0]:
+                ret.add(parts[0])
+    return ret
+
 
-        nsource_signature = nsource.get('signature', '')
-        if not nsource_signature:
-            nsource_signature = 'master'
-            branch_sig = []
+def codetree_sparse(node):
+    """the folders checked out of a CODETREE node with 'git.sparse': the ones listed, and the packages referenced by PLATFORM and COMPONENT.
+    [] for the whole tree."""
+    sparse = node.get('git.sparse', None) or []
+    if not sparse:
+        return []
+    if isinstance(sparse, str):
+        sparse = sparse.split()
+    return sorted(set(p.strip('/') for p in sparse) | referenced_packages())
+
+
+def sparse_checkout_set(local_dir, sparse, verbose=True):
+    """check out only the sparse folders of a local git tree, in the cone mode: explicitly, as git before 2.37 defaults to the non-cone patterns."""
+    if git_version() >= (2, 35):
+        return run(['git', 'sparse-checkout', 'set', '--cone'] + sparse, local_dir, verbose=verbose)
+    r = run(['git', 'sparse-checkout', 'init', '--cone'], local_dir, verbose=verbose)
+    return r if r[0] else run(['git', 'sparse-checkout', 'set'] + sparse, local_dir, verbose=verbose)
+
+
+def sparse_submodules(local_dir, sparse):
+    """the paths of the submodules of a local git tree inside the sparse folders."""
+    r = run(['git', 'config', '--file', '.gitmodules', '--get-regexp', '"^submodule\\..*\\.path$"'], local_dir, verbose=False)
+    paths = [line.split(None, 1)[1].strip() for line in r[1] if len(line.split(None, 1)) == 2] if not r[0] else []
+    return [p for p in paths if any((p + '/').startswith(f + '/') for f in sparse)]
+
+
+def codetree_state_path(node):
+    """the path of the state file of a CODETREE node."""
+    return os.path.join(node['path'], '.git', 'pug-state.json')
+
+
+def codetree_state(node):
+    """the resolved commit, the worktree status and the submodule status of a CODETREE node, via the local git only."""
+    local_dir = node['path']
+    if dry_run or not os.path.isdir(os.path.join(local_dir, '.git')):
+        return None
+    nsource = node.get('source', None) or {}
+    state = {
+        'url': nsource.get('url', ''),
+        'signature': nsource.get('signature', '') or 'master',
+        'head': git_rev(local_dir, 'HEAD'),
+    }
+    # the partial clone and the sparse checkout, as configured: a change of them is a change of the tree.
+    if codetree_filter(node):
+        state['filter'] = codetree_filter(node)
+    if codetree_sparse(node):
+        state['sparse'] = codetree_sparse(node)
+    r = run(['git', 'status', '--porcelain', '--untracked-files=no'], local_dir, verbose=False)
+    state['status'] = r[1] if not r[0] else None
+    if node.get('recursive', ''):
+        r = run(['git', 'submodule', 'status', '--recursive'], local_dir, verbose=False)
+        state['submodules'] = r[1] if not r[0] else None
+    return state
+
+
+def save_codetree_state(node):
+    """record the current state of a CODETREE node."""
+    state = codetree_state(node)
+    if state and state['head']:
+        with open(codetree_state_path(node), 'w') as fout:
+            json.dump(state, fout, indent=1)
+
+
+def is_codetree_current(node):
+    """True when the node is checked out at an immutable signature (a tag or a commit id)
+    and nothing has changed since its state was recorded."""
+    try:
+        with open(codetree_state_path(node), 'r') as fin:
+            state0 = json.load(fin)
+    except (IOError, OSError, ValueError):
+        return False
+    local_dir = node['path']
+    signature = (node.get('source', None) or {}).get('signature', '') or 'master'
+    if state0.get('signature', '') != signature:
+        return False
+    pinned = git_rev(local_dir, 'refs/tags/%s' % signature)
+    if not pinned and len(signature) == 40 and all(x in '0123456789abcdef' for x in signature):
+        pinned = git_rev(local_dir, signature)
+    if not pinned or pinned != state0.get('head', ''):
+        return False
+    return codetree_state(node) == state0
+
+
+def codetree_plan(node):
+    """(the action, the reason) of setup_codetree() for a CODETREE node, judged by the local state only."""
+    nsource = node.get('source', None) or {}
+    nsource_url, nsource_cmd = nsource.get('url', None), nsource.get('command', None)
+    signature = nsource.get('signature', '') or 'master'
+    if not nsource_url and not nsource_cmd:
+        return 'skip', 'no source'
+    if nsource_cmd:
+        return 'run', 'the source command runs on every setup'
+    local_dir = node['path']
+    if not os.path.exists(os.path.join(local_dir, '.git')):
+        mirror = config.DEFAULT_GIT_MIRROR != 'off' and os.path.exists(os.path.join(mirror_path(nsource_url), 'HEAD'))
+        options = [o for o in ('filter %s' % codetree_filter(node) if codetree_filter(node) else '',
+                               'sparse %s' % ' '.join(codetree_sparse(node)) if codetree_sparse(node) else '',
+                               'by the local mirror' if mirror else '') if o]
+        return 'run', 'clone %s at %s%s' % (nsource_url, signature, ''.join(', ' + o for o in options))
+    if is_codetree_current(node):
+        return 'skip', 'up-to-date at %s' % signature
+    if git_rev(local_dir, 'refs/tags/%s' % signature) or git_rev(local_dir, signature) == signature:
+        return 'run', 'check out %s, already local' % signature
+    return 'run', 'fetch and check out %s' % signature
+
+
+def get_code(node, verbose=True):
+    """get the code of a CODETREE node by git clone/checkout, or by its source command."""
+    r = 0, [], []
+    local_dir = node['path']
+    dot_git = os.path.join(local_dir, '.git')
+    if not os.path.exists(local_dir):
+        os.makedirs(local_dir)
+
+    nsource = node.get('source', None)
+    if nsource is None:
+        return r
+    nsource_url = nsource.get('url', None)
+    nsource_cmd = nsource.get('command', None)
+    if nsource_url is None and nsource_cmd is None:
+        return r
+
+    nsource_signature = nsource.get('signature', '')
+    if not nsource_signature:
+        nsource_signature = 'master'
+        branch_sig = []
+    else:
+        branch_sig = ['-b', nsource_signature]
+
+    recurse_submodule = '--recurse-submodules' if node.get('recursive', '') else ''
+    new_clone = False
+    if nsource_cmd:
+        if isinstance(nsource_cmd, type("")):
+            r = run(nsource_cmd, local_dir, verbose=verbose)
+        elif hasattr(nsource_cmd, '__iter__'):
+            for ncmd in nsource_cmd:
+                r = run(ncmd, local_dir, verbose=verbose)
+                if r[0]:
+                    break
         else:
-            branch_sig = ['-b', nsource_signature]
-
-        recurse_submodule = '--recurse-submodules' if node.get('recursive', '') else ''
-        new_clone = False
-        if nsource_cmd:
-            if isinstance(nsource_cmd, type("")):
-                r = run(nsource_cmd, local_dir, verbose=True)
-            elif hasattr(nsource_cmd, '__iter__'):
-                for ncmd in nsource_cmd:
-                    r = run(ncmd, local_dir, verbose=True)
-                    if r[0]:
-                        break
-            else:
-                pass    # TODO: this should be an error
+            pass    # TODO: this should be an error
+        if r[0]:
+            return r
+    elif nsource_url:
+        if os.path.exists(dot_git) and is_codetree_current(node):
+            bowwow('setup_codetree(): %s is up-to-date at %s.' % (local_dir, nsource_signature), noise_pitch=1)
+            return r
+        # the local mirror, when it exists, serves the objects of the clone and the submodules via url rewriting.
+        git, reference = ['git'], []
+        if config.DEFAULT_GIT_MIRROR != 'off':
+            if config.DEFAULT_GIT_MIRROR == 'update':
+                r = update_mirror(nsource_url, verbose)
+                if r[0]:
+                    return r
+                if node.get('recursive', ''):
+                    mirror_submodules(nsource_url, nsource_signature, update=True, verbose=verbose)
+            mirror = mirror_path(nsource_url)
+            if os.path.exists(os.path.join(mirror, 'HEAD')):
+                # dissociated: the clone copies the objects it borrows, as the mirror's 'fetch --prune' and gc may drop them.
+                reference = ['--reference-if-able', mirror, '--dissociate']
+                if node.get('recursive', ''):
+                    git += git_mirror_config(nsource_url, nsource_signature)
+        filter_spec, sparse = codetree_filter(node), codetree_sparse(node)
+        jobs = int(node.get('git.submodule.jobs', config.DEFAULT_SUBMODULE_JOBS))
+        submodule_jobs = ['--jobs', '%d' % jobs] if jobs > 1 else []
+        if not os.path.exists(dot_git):
+            clone_arguments = node.get('git.clone.arguments', '')
+            options = ['--filter=%s' % filter_spec] if filter_spec else []
+            if sparse:
+                # only the top files are checked out, and the submodules are updated after the sparse checkout.
+                options += ['--sparse']
+            elif recurse_submodule:
+                options += [recurse_submodule] + submodule_jobs + (['--also-filter-submodules'] if filter_spec and git_version() >= (2, 36) else [])
+            r = run(git + ['clone', clone_arguments] + options + reference + [nsource_url, local_dir] + branch_sig, local_dir, verbose=verbose)
             if r[0]:
                 return r
-        elif nsource_url:
-            if not os.path.exists(dot_git):
-                clone_arguments = node.get('git.clone.arguments', '')
-                r = run(['git', 'clone', clone_arguments, recurse_submodule, nsource_url, local_dir] + branch_sig, local_dir, verbose=True)
+            new_clone = True
+            if sparse:
+                r = sparse_checkout_set(local_dir, sparse, verbose)
                 if r[0]:
                     return r
-                new_clone = True
-            else:
-                pwdpopd(local_dir)
+        else:
+            # the sparse checkout (or the whole tree) first, so that the checkout below fills in only the folders wanted.
+            if sparse:
+                r = sparse_checkout_set(local_dir, sparse, verbose)
+            elif is_sparse_checkout(local_dir):
+                r = run(['git', 'sparse-checkout', 'disable'], local_dir, verbose=verbose)
+            if r[0]:
+                return r
+            # fetch only the requested ref, and only when it is not a tag/commit that is already local.
+            checkout_signature = nsource_signature
+            if not (git_rev(local_dir, 'refs/tags/%s' % nsource_signature) or git_rev(local_dir, nsource_signature) == nsource_signature):
                 fetch_arguments = node.get('git.fetch.arguments', '')
-                r = run(['git', 'fetch', '--tags', '--all', fetch_arguments, recurse_submodule], local_dir, verbose=True)
-                pwdpopd()
-                if r[0]:
-                    return r
-                checkout_arguments = node.get('git.checkout.arguments', '')
-                r = run(['git', 'checkout', checkout_arguments, nsource_signature], local_dir, verbose=True)
+                options = ['--filter=%s' % filter_spec] if filter_spec else []
+                r = run(git + ['fetch', fetch_arguments, recurse_submodule] + options + ['origin', nsource_signature], local_dir, verbose=verbose)
                 if r[0]:
                     return r
-            if node.get('recursive', ''):
-                submodule_arguments = node.get('git.submodule.arguments', '')
-                if not new_clone:
-                    r = run(['git', 'submodule sync --recursive', submodule_arguments], local_dir, verbose=True)
-                r = run(['git', 'submodule update --recursive', submodule_arguments], local_dir, verbose=True)
-        return r
+                fetched = ['', '']
+                try:
+                    with open(os.path.join(dot_git, 'FETCH_HEAD'), 'r') as fin:
+                        fetched = fin.readline().split('\t')
+                except (IOError, OSError):
+                    pass
+                if len(fetched) > 2 and fetched[2].startswith('tag '):
+                    run(['git', 'update-ref', 'refs/tags/%s' % nsource_signature, fetched[0]], local_dir, verbose=False)
+                elif not git_rev(local_dir, 'refs/heads/%s' % nsource_signature):
+                    checkout_signature = 'FETCH_HEAD'
+            checkout_arguments = node.get('git.checkout.arguments', '')
+            r = run(['git', 'checkout', checkout_arguments, checkout_signature], local_dir, verbose=verbose)
+            if r[0]:
+                return r
+        if node.get('recursive', ''):
+            submodule_arguments = node.get('git.submodule.arguments', '')
+            if not new_clone:
+                r = run(git + ['submodule sync --recursive', submodule_arguments], local_dir, verbose=verbose)
+            # initialized: the submodules outside a former sparse checkout, or new to the revision, are not yet.
+            options = ['--init'] + submodule_jobs + (['--filter=%s' % filter_spec] if filter_spec and git_version() >= (2, 36) else [])
+            # with a sparse checkout, only the submodules inside it.
+            paths = sparse_submodules(local_dir, sparse) if sparse else []
+            if paths or not sparse:
+                r = run(git + ['submodule update --recursive', submodule_arguments] + options + (['--'] + paths if paths else []), local_dir, verbose=verbose)
+    return r
+
+
+def codetree_nodes(codetree):
+    """the CODETREE nodes: edk2 first, and then the others in their declared order.
+    they are copies with their paths made absolute, and the config itself is left as it is."""
+    order = ['edk2'] + [c for c in codetree if c != 'edk2']
+    return {c: dict(codetree[c], path=os.path.abspath(codetree[c]['path'])) for c in order}
+
+
+def codetree_ancestors(codetree, path):
+    """the nodes whose paths are the ancestors of a path."""
+    path = os.path.abspath(path)
+    return [c for c in codetree if path.startswith(codetree[c]['path'] + os.sep)]
+
+
+def codetree_overlaps(codetree, path):
+    """the nodes whose trees overlap a path: the node at it, the nodes it's inside and the nodes inside it."""
+    path = os.path.abspath(path)
+    return [c for c in codetree if c in codetree_ancestors(codetree, path) or
+            (codetree[c]['path'] + os.sep).startswith(path + os.sep)]
+
+
+def fetch_codetree(codetree, c, verbose=True):
+    """get the code of a node, and record its state. returns ((rc, stdout, stderr), the seconds)."""
+    t0 = time.time()
+    with trace.phase('setup_codetree:%s' % c) as ev:
+        r = get_code(codetree[c], verbose)
+        ev['rc'] = r[0]
+    if not r[0] and not (codetree[c].get('source', None) or {}).get('command', None):
+        save_codetree_state(codetree[c])
+    return r, time.time() - t0
+
+
+def setup_codetree(codetree, jobs=1):
+    """pull the edk2 code tree when it does not locally/correctly exist.
+        1. git clone
+        2. git checkout tag/branch/master
+    when jobs > 1, the nodes are fetched concurrently by a bounded worker pool.
+    a node whose path resides inside another node's path waits for that node, and is skipped when it fails."""
+    codetree = codetree_nodes(codetree)
+    order = list(codetree)
+    results = {}
+    if jobs <= 1:
+        for c in order:
+            results[c] = fetch_codetree(codetree, c, True)
+    else:
+        def _fetch(c):
+            results[c] = fetch_codetree(codetree, c, False)
+            return results[c][0][0]
 
-    r0, r1, r2 = _get_code(codetree['edk2'])
-    for c in codetree:
-        if c == 'edk2':
-            continue
-        s = _get_code(codetree[c])
+        def _done(t):
+            if t.state == 'skipped':
+                bowwow('setup_codetree(): [%s] skipped, %s' % (t.name, t.reason), noise_pitch=1)
+            else:
+                bowwow('setup_codetree(): [%s] done in %.1fs, rc=%d' % (t.name, t.seconds, t.rc), noise_pitch=1)
+
+        bowwow('setup_codetree(): fetching %d node(s) with %d worker(s).' % (len(order), jobs), noise_pitch=1)
+        dag.run([dag.Task(c, lambda c=c: _fetch(c), codetree_ancestors(codetree, codetree[c]['path'])) for c in order], jobs, on_done=_done)
+
+    r0, r1, r2 = 0, [], []
+    for c in order:
+        s = results.get(c, ((0, [], []), 0.0))[0]
         r0 |= s[0]
         r1 += s[1]
         r2 += s[2]
+    bowwow('setup_codetree(): timing summary', noise_pitch=1)
+    for c in order:
+        bowwow('  %-24s %8.1fs  %s' % (c, results[c][1], 'rc=%d' % results[c][0][0]) if c in results else '  %-24s %9s  skipped' % (c, ''), noise_pitch=1)
     return print_run_result((r0, r1, r2), 'setup_codetree(): ')
 
 
-def platform_dsc(platform, components, workspace):
+dsc_overrides = ('LibraryClasses', 'PcdsFixedAtBuild')  # , 'BuildOptions')
+
+
+def platform_fingerprint(platform, components):
+    """the fingerprint of a platform's DSC inputs: the platform, and the components' paths and overrides."""
+    return fingerprint(platform, ([c['path'], {ov: c[ov] for ov in dsc_overrides if ov in c}] for c in components))
+
+
+def platform_dsc(platform, components, workspace, manifest=None):
     """generate a platform's dsc file."""
 
     dsc_path = abs_path(platform['path'], workspace)
@@ -449,146 +1363,830 @@ def platform_dsc(platform, components, workspace):
     if not platform.get('update', False):
         return
     sections = ['Defines', 'Components']
-    overrides = {'LibraryClasses', 'PcdsFixedAtBuild'}  # , 'BuildOptions'}
-    pfile = []
-    for s in sections:
-        if s == 'Components':
-            pfile += gen_section(None, section=s)
+    overrides = dsc_overrides
+    fp = platform_fingerprint(platform, components)
+    if is_generated_current(manifest, dsc_path, fp):
+        return
+    with generated_file(manifest, dsc_path, fp, default_pug_signature) as out:
+        for s in sections:
+            if s != 'Components':
+                out.section(platform[s], section=s)
+                continue
+            out.section(None, section=s)
             for compc in components:
-                pfile += ['  %s' % compc['path']]
-                in_override = False
-                ovs = overrides.intersection(set(compc.keys()))
+                ovs = [ov for ov in overrides if ov in compc]
+                if not ovs:
+                    out.line('  %s' % compc['path'])
+                    continue
+                out.line('  %s {' % compc['path'])
                 for ov in ovs:
-                    # print('Override: %s' % ov)
-                    if not in_override:
-                        pfile[-1] += ' {'
-                        in_override = True
-                    pfile += ['    <%s>' % ov]
-                    sep = '|' if ov in {'LibraryClasses', 'PcdsFixedAtBuild'} else '='
+                    out.line('    <%s>' % ov)
                     for d in compc[ov]:
                         if d and d[0]:
-                            pfile += ['      %s %s %s' % (d[0], sep, d[1])]
-                if in_override:
-                    pfile += ['  }']
-        else:
-            pfile += gen_section(platform[s], section=s)
-    write_file(dsc_path, pfile, default_pug_signature)
+                            out.line('      %s | %s' % (d[0], d[1]))
+                out.line('  }')
 
 
-def component_inf(components, workspace):
-    """generate INF files of components."""
-    sections = [
-        'Sources', 'Packages', 'LibraryClasses', 'Protocols', 'Ppis',
-        'Guids', 'FeaturePcd', 'Pcd', 'BuildOptions', 'Depex', 'UserExtensions',
-    ]
-    for comp in components:
-        cfile = []
-        inf_path = abs_path(comp.get('path', ''), workspace)
-        bowwow('COMPONENT: %s' % inf_path, noise_pitch=1)
-        if not comp.get('update', False):
-            continue
-        defines = comp.get('Defines', '')
-        if not defines:
-            raise Exception('INF must contain [Defines] section.')
-        cfile += gen_section(defines, section='Defines')
+inf_sections = [
+    'Sources', 'Packages', 'LibraryClasses', 'Protocols', 'Ppis',
+    'Guids', 'FeaturePcd', 'Pcd', 'BuildOptions', 'Depex', 'UserExtensions',
+]
+inf_pool_min = 32       # the fewest INF files worth a worker pool
+
+
+def gen_inf(comp, inf_path, fp, known=None):
+    """render and write a component's INF file. returns its manifest entry."""
+    manifest = {inf_path: known} if known else {}
+    with generated_file(manifest, inf_path, fp, default_pug_signature) as out:
+        out.section(comp['Defines'], section='Defines')
         for s in comp:
             s0 = s.split('.')[0]
-            if s0 not in sections:
+            if s0 not in inf_sections:
                 continue
             if s0 == 'LibraryClasses':
-                cfile += gen_section([v[0] for v in comp[s] if v[0] != 'NULL'], section=s, override=list)
+                out.section([v[0] for v in comp[s] if v[0] != 'NULL'], section=s, override=list)
             else:
-                cfile += gen_section(comp[s], section=s)
-        write_file(inf_path, cfile, default_pug_signature)
+                out.section(comp[s], section=s)
+    return manifest[inf_path]
+
+
+def gen_infs(tasks):
+    """generate a chunk of INF files, in a pool worker. returns [(the manifest entry, the error)] in the tasks' order."""
+    ret = []
+    for comp, inf_path, fp, known in tasks:
+        try:
+            ret.append((gen_inf(comp, inf_path, fp, known), ''))
+        except Exception as e:      # pylint: disable=broad-except
+            ret.append((None, '%s: %s' % (type(e).__name__, e)))
+    return ret
+
+
+def component_inf(components, workspace, manifest=None, jobs=1, pool='process'):
+    """generate INF files of components.
+    - every component to update is validated first: all those without [Defines] are reported at once, and nothing is written.
+    - jobs > 1 (0: cpu_count()) spreads the generation across a process (or thread) pool.
+      the messages, the errors and the manifest updates follow the components' order, whatever the workers' timing."""
+    tasks, missing = [], []
+    for comp in components:
+        inf_path = abs_path(comp.get('path', ''), workspace)
+        bowwow('COMPONENT: %s' % inf_path, noise_pitch=1)
+        if not comp.get('update', False):
+            continue
+        fp = fingerprint(comp)
+        if is_generated_current(manifest, inf_path, fp):
+            continue
+        if not comp.get('Defines', ''):
+            missing.append(inf_path)
+            continue
+        tasks.append((comp, inf_path, fp, manifest.get(inf_path, None) if manifest is not None else None))
+    if missing:
+        raise Exception('INF must contain [Defines] section: %s' % ', '.join(missing))
+
+    jobs = min(jobs or multiprocessing.cpu_count(), len(tasks))
+    if jobs <= 1 or len(tasks) < inf_pool_min:
+        results = gen_infs(tasks)
+    else:
+        size = -(-len(tasks) // (jobs * 4))         # a few chunks per worker to even out the load
+        chunks = [tasks[i:i + size] for i in range(0, len(tasks), size)]
+        results = None
+        if pool == 'process':
+            try:
+                with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+                    results = list(itertools.chain.from_iterable(executor.map(gen_infs, chunks)))
+            except (OSError, NotImplementedError, ImportError, concurrent.futures.BrokenExecutor) as e:
+                bowwow('INF process pool unavailable (%s), using threads.' % e, noise_pitch=1)
+        if results is None:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+                results = list(itertools.chain.from_iterable(executor.map(gen_infs, chunks)))
+
+    errors = []
+    for (_, inf_path, _, _), (entry, error) in zip(tasks, results):
+        if error:
+            errors.append('%s: %s' % (inf_path, error))
+        elif manifest is not None:
+            manifest[inf_path] = entry
+    if errors:
+        raise Exception('INF generation failed:\n  %s' % '\n  '.join(errors))
 
 
 def build(cmd_arg):
     """0. prepare the EDK2 code tree.
        1. setup environment variables.
        2. build C-Lang executable binaries in BaseTools.
-       3. EDK2 build."""
+       3. EDK2 build.
+    the steps up to the EDK2 build run as a task graph, ref. pipeline_tasks()."""
 
+    config.load()
     workspace = os.path.abspath(config.WORKSPACE['path'])
 
-    # 1. (1) check the external repos and (2) apply the patches.
-    if cmd_arg[0] in {'setup', 'init'}:
-        r = setup_codetree(config.CODETREE)
-        if r:
-            bowwow('setup_codetree(0) returns: %s' % str(r), noise_pitch=2)
-            bowwow('Unable to setup the EDK2 code tree correctly.', 2)
-            bowwow('Please check the access permission or the sanity of the external folder(s).', 2)
-            return r
-        r = apply_patch(config.CODETREE, workspace)
-        if r:
-            bowwow('apply_patch() returns: %s' % str(r), 2)
-            bowwow('The path is not applied successfully.', 2)
-            bowwow('Maybe the patch has been applied before. Ignoring the error.\n', 2)
-            # return r
-
-    # 2. setup the THREE basic text files for the EDK2 build.
+    # 0. plan, refresh the local mirrors of the external repos, watch the workspace, or run the build farm.
+    if '--pug:plan' in cmd_arg[2]:
+        return plan(cmd_arg)
+    if cmd_arg[0] == 'prefetch':
+        signatures = prefetch_signatures(sys.argv[1:])
+        if signatures is None:
+            bowwow('Usage: ipug prefetch [edk2-tag ...], not: %s' % ' '.join(sys.argv[1:]), noise_pitch=2)
+            return 1
+        return prefetch(config.CODETREE, signatures)
+    if cmd_arg[0] == 'watch':
+        return watch(cmd_arg)
+    if cmd_arg[0] == 'farm':
+        return farm_build(farm_jobs(sys.argv[1:]))
+    if cmd_arg[0] == 'serve-worker':
+        return serve_worker()
+
+    # 1. setup the environment variables, the jobserver and the compiler cache.
     setup_env_vars(workspace, config.CODETREE)
-    conf_files(['build_rule', 'tools_def', 'target'], config.WORKSPACE['conf_path'], cmd_arg)
-    gen_target_txt(config.TARGET_TXT)
+    setup_jobserver()
+    manifest_path = os.path.join(config.WORKSPACE['pug_path'], 'manifest.json')
+    manifest = load_manifest(manifest_path)
+    tags = set(config.MATRIX['TOOL_CHAIN_TAG']) | {config.TARGET_TXT['TOOL_CHAIN_TAG']}
+    wrapper = compiler_cache_wrapper()
 
-    # 2.1 dump the essential environment variables when requested.
+    # 1.1 dump the essential environment variables when requested.
     if '--pug:environ' in cmd_arg[2]:
         bowwow(config.dump_env_vars(), 3, no_clobber=True)
 
-    # 3. build/clean the BaseTools binaries
-    if cmd_arg[0] in pug_action_all:
-        r = build_basetools(cmd_arg)
-        # BaseTools build failure is ignored quietly.
-        # leave it to the EDK2's build logic to control the failure.
+    # 2. run the tasks up to the EDK2 build, each as soon as its inputs are ready:
+    #    the code trees, the patches, the THREE basic text files, the BaseTools binaries and the DSC/INF files.
+    tasks = pipeline_tasks(cmd_arg, workspace, manifest, wrapper, tags)
+    r = run_pipeline(tasks)
+    failed = [t.name for t in tasks if t.state == 'failed' and t.name.startswith('setup_codetree:')]
+    if failed:
+        bowwow('setup_codetree() fails: %s' % ', '.join(failed), noise_pitch=2)
+        bowwow('Unable to setup the EDK2 code tree correctly.', 2)
+        bowwow('Please check the access permission or the sanity of the external folder(s).', 2)
+        return r
+    save_manifest(manifest_path, manifest)
+    if r:
+        return r
 
-        if cmd_arg[0] in {'init-basetools', 'clean-basetools'}:
-            return r
+    # BaseTools build failure is ignored quietly: leave it to the EDK2's build logic to control the failure.
+    if cmd_arg[0] in {'init-basetools', 'clean-basetools'}:
+        return [t for t in tasks if t.name == 'build_basetools'][0].rc
+    if cmd_arg[0] in {'setup', 'init'}:
+        return 0
 
-    # 4. [TODO] generate the temporary DSC/INF files
+    # 3. run (1) the customized "build" command or (2) the default one to build the code base.
+    return build_edk2(cmd_arg, manifest, wrapper)
+
+
+def pipeline_tasks(cmd_arg, workspace, manifest, wrapper, tags):
+    """the tasks of build() up to the EDK2 build, and what each one takes:
+    - setup_codetree:<node>: the trees its path is inside.
+    - apply_patch:<node>: all the trees, as a patch is a command on the workspace; the patches run in their declared order.
+    - conf_files, build_basetools: edk2's tree, patched. gen_target_txt and the compiler cache: the Conf files.
+    - gen_dsc_inf: the trees its files are inside, e.g. to not write into a folder about to be cloned.
+    the failures of apply_patch and build_basetools are reported, and ignored."""
+    tasks, edk2 = [], []
+    setup = cmd_arg[0] in {'setup', 'init'}
+    codetree = codetree_nodes(config.CODETREE) if setup else {}
+    def _fetch(c):
+        r = fetch_codetree(codetree, c)[0]
+        return print_run_result(r, 'setup_codetree(): [%s] ' % c) if r[0] else 0
+
+    if setup:
+        order = list(codetree)
+        for c in order:
+            tasks.append(dag.Task('setup_codetree:%s' % c, lambda c=c: _fetch(c),
+                                  ['setup_codetree:%s' % p for p in codetree_ancestors(codetree, codetree[c]['path'])], group='setup_codetree'))
+        fetches = [t.name for t in tasks]
+        edk2 = ['setup_codetree:%s' % p for p in codetree_overlaps(codetree, codetree['edk2']['path'])]
+        patches = []
+        for c in order:
+            if codetree[c].get('patch', None):
+                tasks.append(dag.Task('apply_patch:%s' % c, lambda c=c: patch_codetree(codetree, c, workspace), fetches + patches[-1:], soft=True))
+                patches.append(tasks[-1].name)
+        edk2 += patches
+
+    def _conf_files():
+        conf_files(['build_rule', 'tools_def', 'target'], config.WORKSPACE['conf_path'], cmd_arg,
+                   manifest=manifest, overrides=compiler_cache_overrides(wrapper, tags))
+
+    def _compiler_cache():
+        # route the compilers through the compiler cache, when it's enabled.
+        setup_compiler_cache(config.WORKSPACE['conf_path'], tags, wrapper)
+
+    tasks.append(phase_task('conf_files', _conf_files, edk2))
+    tasks.append(phase_task('gen_target_txt', lambda: gen_target_txt(config.TARGET_TXT, manifest), ['conf_files']))
+    tasks.append(dag.Task('compiler_cache', _compiler_cache, ['conf_files']))
+    if cmd_arg[0] in pug_action_all:
+        tasks.append(phase_task('build_basetools', lambda: build_basetools(cmd_arg), edk2, soft=True))
+    if setup:
+        paths = [cfg['path'] for cfg in [getattr(config, 'PLATFORM', None) or {}] + list(getattr(config, 'COMPONENT', None) or []) if cfg.get('path', '')]
+        deps = set(p for path in paths for p in codetree_overlaps(codetree, abs_path(path, workspace)))
+        tasks.append(dag.Task('gen_dsc_inf', lambda: gen_dsc_inf(workspace, manifest), ['setup_codetree:%s' % p for p in order if p in deps]))
+    return tasks
+
+
+def phase_task(name, func, deps=(), soft=False):
+    """a task run as a traced phase of the same name."""
+    def _run():
+        with trace.phase(name) as ev:
+            r = ev['rc'] = func() or 0
+        return r
+    return dag.Task(name, _run, deps, soft=soft)
+
+
+def patch_codetree(codetree, c, workspace):
+    """apply a node's patch, then record the patched tree as its state."""
+    with trace.phase('apply_patch:%s' % c) as ev:
+        r = ev['rc'] = apply_patch({c: codetree[c]}, workspace)
+    if r:
+        bowwow('apply_patch() returns: %s' % str(r), 2)
+        bowwow('The path is not applied successfully.', 2)
+        bowwow('Maybe the patch has been applied before. Ignoring the error.\n', 2)
+    if not (codetree[c].get('source', None) or {}).get('command', None):
+        save_codetree_state(codetree[c])
+    return r
+
+
+def run_pipeline(tasks):
+    """run the tasks of build(), DEFAULT_PIPELINE_JOBS at a time and DEFAULT_CODETREE_JOBS git fetches at a time.
+    unless they run one by one, the output of their commands is captured, and shown on a failure, ref. captured().
+    returns the rc of the first failure."""
+    jobs = int(config.DEFAULT_PIPELINE_JOBS)
+
+    def _done(t):
+        if t.state == 'skipped':
+            bowwow('%s: skipped, %s' % (t.name, t.reason), noise_pitch=2)
+        elif jobs != 1:
+            bowwow('%s: %s in %.1fs' % (t.name, t.state, t.seconds), noise_pitch=1)
+
+    if jobs != 1:
+        # the tasks overlap: their commands' output is captured, rather than interleaved on the console.
+        for t in tasks:
+            t.func = captured(t.func)
+    start = time.time()
+    r = dag.run(tasks, jobs, {'setup_codetree': max(int(config.DEFAULT_CODETREE_JOBS), 1)}, _done)
+    if jobs != 1:
+        busy = sum(t.seconds for t in tasks)
+        bowwow('pipeline: %d task(s) in %s, %s of work' % (len(tasks), format_seconds(time.time() - start), format_seconds(busy)), noise_pitch=1)
+    return r
+
+
+def gen_dsc_inf(workspace, manifest=None):
+    """generate the platform's DSC file and the components' INF files."""
     cPlatform = getattr(config, 'PLATFORM', None)
     cComponent = getattr(config, 'COMPONENT', None)
-    if cmd_arg[0] in {'setup', 'init'}:
-        if cPlatform and cComponent:
-            platform_dsc(cPlatform, cComponent, workspace)
-        if cComponent:
-            component_inf(cComponent, workspace)
+    if cPlatform and cComponent:
+        with trace.phase('platform_dsc'):
+            platform_dsc(cPlatform, cComponent, workspace, manifest)
+    if cComponent:
+        with trace.phase('component_inf', components=len(cComponent)):
+            component_inf(cComponent, workspace, manifest, int(config.DEFAULT_INF_JOBS), config.DEFAULT_INF_POOL)
+
+
+def build_edk2(cmd_arg, manifest=None, wrapper=''):
+    """run the EDK2 build, or the build matrix, with the environment set up by build()."""
+    if impact_changes is not None and cmd_arg[0] == 'build' and not cmd_arg[1] and '--pug:matrix' not in cmd_arg[2]:
+        r = build_impacted(cmd_arg, impact_changes)
+        if r is not None:
+            return r
+    stats0 = compilercache.stats(wrapper) if wrapper and not dry_run else None
+    if '--pug:matrix' in cmd_arg[2] and cmd_arg[0] != '--help':
+        with trace.phase('build_matrix') as ev:
+            ev['rc'] = build_matrix(cmd_arg, config.MATRIX, manifest)
+        print_compiler_cache_stats(wrapper, stats0)
+        return ev['rc']
+    threads = acquire_threads(sys.argv[1:]) if cmd_arg[0] != '--help' else 0
+    analyzer = BuildAnalyzer() if (int(config.DEFAULT_BUILD_REPORT) and cmd_arg[0] == 'build' and not cmd_arg[1]) else None
+    bcache = binary_cache(sys.argv[1:]) if (cmd_arg[0] == 'build' and not cmd_arg[1] and not dry_run) else None
+    feeds = [f.feed for f in (analyzer, bcache) if f]
+    try:
+        args = sys.argv[1:] + (setup_binary_cache(bcache) if bcache else [])
+        with trace.phase('build', threads=threads) as ev:
+            r = run(build_command(cmd_arg, threads, args), os.environ['WORKSPACE'], on_line=(lambda stream, line: [f(stream, line) for f in feeds]) if feeds else None)
+            ev['rc'] = r[0]
+        if bcache:
+            finish_binary_cache(bcache, cmd_arg, threads, r[0])
+    finally:
+        if threads:
+            jobserver.release(threads)
+    if analyzer and not dry_run:
+        analyzer.finish()
+        report_path = os.path.join(config.WORKSPACE['pug_path'], 'build-report.txt')
+        msg = analyzer.write_report(report_path)
+        bowwow('\n'.join(msg[:msg.index('The slowest modules:') + 6] + ['The build report: %s' % report_path]), noise_pitch=1)
+    print_compiler_cache_stats(wrapper, stats0)
+    return print_run_result(r, 'build(): ')
 
-    if cmd_arg[0] in {'setup', 'init'}:
-        return 0
 
-    # 5. run (1) the customized "build" command or (2) the default one to build the code base.
+def binary_cache(args):
+    """the module binary cache (DEFAULT_BINARY_CACHE) of the build arguments' tool chain, or None.
+    it's off for a customized build command, or when the arguments use EDK2's cache options themselves."""
+    if not config.DEFAULT_BINARY_CACHE or config.DEFAULT_BUILD_COMMAND:
+        return None
+    if any(a == '--hash' or a.startswith(('--binary-source', '--binary-destination')) for a in args):
+        return None
+    tag = args[args.index('-t') + 1] if '-t' in args[:-1] else config.TARGET_TXT['TOOL_CHAIN_TAG']
+    edk2_tag = config.CODETREE.get('edk2', {}).get('source', {}).get('signature', '') or config.DEFAULT_EDK2_TAG
+    root = os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'bincache', edk2_tag, tag)
+    shared = None if config.DEFAULT_BINARY_CACHE == 'local' else bincache.store(config.DEFAULT_BINARY_CACHE, '%s/%s' % (edk2_tag, tag))
+    return bincache.BinaryCache(root, shared)
+
+
+def setup_binary_cache(bcache):
+    """download the shared entries, and return the EDK2 build options of the module binary cache."""
+    with trace.phase('binary_cache_pull') as ev:
+        try:
+            ev['entries'] = bcache.pull()
+        except (OSError, ValueError, tarfile.TarError, http.client.HTTPException) as e:
+            bowwow('binary cache: unable to download from the shared cache: %s' % e, noise_pitch=2)
+    args = bcache.build_args()
+    bowwow('binary cache: %s %s' % ('consuming' if bcache.consumed else 'populating', bcache.root), noise_pitch=1)
+    return args
+
+
+def finish_binary_cache(bcache, cmd_arg, threads, rc):
+    """after the build: report the hits and the misses, populate the cache with the missed modules by a second pass,
+    upload the new entries to the shared cache, and evict the least recently used entries beyond DEFAULT_BINARY_CACHE_SIZE."""
+    hits, misses = bcache.result()
+    bcache.touch_hits()
+    if rc == 0 and bcache.consumed and misses:
+        # the modules are up to date: the pass only copies them into the cache.
+        with trace.phase('binary_cache_populate') as ev:
+            ev['rc'] = run(build_command(cmd_arg, threads, sys.argv[1:] + bcache.build_args(populate=True)), os.environ['WORKSPACE'], verbose=False)[0]
+    pushed = 0
+    if rc == 0:
+        with trace.phase('binary_cache_push') as ev:
+            try:
+                pushed = ev['entries'] = bcache.push()
+            except (OSError, ValueError, tarfile.TarError, http.client.HTTPException) as e:
+                bowwow('binary cache: unable to upload to the shared cache: %s' % e, noise_pitch=2)
+    removed = bcache.evict(int(config.DEFAULT_BINARY_CACHE_SIZE) * 1024 * 1024) if int(config.DEFAULT_BINARY_CACHE_SIZE) else []
+    bowwow('binary cache: %d hit(s), %d miss(es), hit rate %.1f%%; %d entries uploaded, %d evicted' % (
+        hits, misses, 100.0 * hits / (hits + misses) if hits + misses else 0.0, pushed, len(removed)), noise_pitch=1)
+
+
+def reload_config():
+    """re-evaluate the settings of config.py and project.py."""
+    config.load(reload=True)
+
+
+def watch_paths(workspace):
+    """the folders watched recursively, the individual files and the excluded folders of 'ipug watch'."""
+    roots = {workspace}
+    for comp in getattr(config, 'COMPONENT', None) or []:
+        roots.add(os.path.dirname(abs_path(comp.get('path', ''), workspace)))
+    roots = sorted(r for r in roots if not any(r.startswith(o + os.sep) for o in roots))
+    project_py = getattr(config.project, '__file__', None) or os.path.join(os.getcwd(), config.project_py)
+    exclude = {os.path.join(workspace, 'Build'), os.path.abspath(config.WORKSPACE['conf_path']), os.path.abspath(config.WORKSPACE['pug_path'])}
+    return roots, [os.path.abspath(project_py)], exclude
+
+
+def watch(cmd_arg):
+    """build once, then watch the workspace, the components' folders and project.py, and rebuild on the changes.
+    - the environment, Conf and BaseTools are set up once, by the first build.
+    - a change of project.py reloads it and regenerates target.txt and the DSC/INF files; then the EDK2 build runs.
+    - the other changes rebuild the affected modules only, see build_impacted(); or run the EDK2 build.
+    - the bursts of changes are debounced into one rebuild."""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    build_arg = ['build', cmd_arg[1], cmd_arg[2]]
+    build(build_arg)
+    wrapper = setup_compiler_cache(config.WORKSPACE['conf_path'], set(config.MATRIX['TOOL_CHAIN_TAG']) | {config.TARGET_TXT['TOOL_CHAIN_TAG']})
+    manifest_path = os.path.join(config.WORKSPACE['pug_path'], 'manifest.json')
+    roots, files, exclude = watch_paths(workspace)
+    w = watcher.watcher(roots, files, exclude, float(config.DEFAULT_WATCH_POLL))
+    bowwow('watch: %s (%s), Ctrl-C to stop.' % (', '.join(roots + files), type(w).__name__), noise_pitch=1)
+    ret = 0
+    try:
+        while True:
+            changed, first = watcher.collect(w, float(config.DEFAULT_WATCH_DEBOUNCE))
+            bowwow('watch: %d change(s): %s' % (len(changed), ', '.join(sorted(changed)[:5]) + (' ...' if len(changed) > 5 else '')), noise_pitch=1)
+            with trace.phase('watch_rebuild', changes=len(changed)) as ev:
+                if set(files) & changed:
+                    try:
+                        reload_config()
+                    except Exception as e:      # pylint: disable=broad-except
+                        bowwow('watch: unable to reload %s: %s' % (files[0], e), noise_pitch=2)
+                        continue
+                    manifest = load_manifest(manifest_path)
+                    gen_target_txt(config.TARGET_TXT, manifest)
+                    gen_dsc_inf(workspace, manifest)
+                    save_manifest(manifest_path, manifest)
+                    if watch_paths(workspace)[0] != roots:
+                        w.close()
+                        roots = watch_paths(workspace)[0]
+                        w = watcher.watcher(roots, files, exclude, float(config.DEFAULT_WATCH_POLL))
+                    ret = ev['rc'] = build_edk2(build_arg, None, wrapper)
+                else:
+                    r = build_impacted(build_arg, changed)
+                    ret = ev['rc'] = build_edk2(build_arg, None, wrapper) if r is None else r
+            bowwow('watch: rebuilt in %.1fs, rc=%d. Watching...' % (time.time() - first, ret), noise_pitch=1)
+    except KeyboardInterrupt:
+        bowwow('watch: stopped.', noise_pitch=1)
+    finally:
+        w.close()
+    return ret
+
+
+def build_command(cmd_arg, threads=0, args=None):
+    """the EDK2 build command: (1) the customized "build" command or (2) the default one.
+    threads assigns '-n' unless the build arguments (sys.argv[1:] by default) do."""
+    args = sys.argv[1:] if args is None else args
     if config.DEFAULT_BUILD_COMMAND:
-        cmds = [config.DEFAULT_BUILD_COMMAND] + sys.argv[1:]
-        r = run(cmds, os.environ['WORKSPACE'])
-    else:
-        cmds = []
-        if os.name == 'nt':
-            cmds += [
-                os.path.join(os.environ['EDK_TOOLS_PATH'], 'toolsetup.bat'), UDKBUILD_COMMAND_JOINTER,
-            ]
+        return [config.DEFAULT_BUILD_COMMAND] + args
 
-        cmds += ['build']
+    cmds = []
+    if os.name == 'nt':
+        cmds += [
+            os.path.join(os.environ['EDK_TOOLS_PATH'], 'toolsetup.bat'), UDKBUILD_COMMAND_JOINTER,
+        ]
 
-        if cmd_arg[0] != '--help':
-            # -n Explicitly define the maximum threads number.
-            if '-n' not in sys.argv[1:]:
-                cmds += ['-n', '%d' % multiprocessing.cpu_count()]
+    cmds += ['build']
+
+    if cmd_arg[0] != '--help':
+        # -n Explicitly define the maximum threads number.
+        if '-n' not in args:
+            cmds += ['-n', '%d' % (threads or multiprocessing.cpu_count())]
+
+        # platform DSC file's path (relative to WORKSPACE)
+        if '-p' not in args:
+            ppdsc = ''
+            try:
+                ppdsc = config.DEFAULT_ACTIVE_PLATFORM
+                ppdsc = config.ACTIVE_PLATFORM
+            except AttributeError:
+                pass
+            if ppdsc:
+                cmds += [
+                    '-p', ppdsc
+                ]
+
+    return cmds + args
+
+
+def thread_budget(args):
+    """(the jobserver's tokens held, the '-n' thread budget, args without '-n') of the concurrent EDK2 builds.
+    the budget is '-n' of args, the tokens held, or cpu_count(). the caller releases the tokens held."""
+    held = acquire_threads(args)
+    budget = held or multiprocessing.cpu_count()
+    if '-n' in args:
+        i = args.index('-n')
+        budget = int(args[i + 1])
+        args = args[:i] + args[i + 2:]
+    return held, budget, args
+
+
+def private_conf(conf_dir, overrides=None, manifest=None):
+    """set up a private Conf folder, i.e. CONF_PATH, of a concurrent EDK2 build:
+    the tools_def.txt and the build_rule.txt of WORKSPACE['conf_path'], and a target.txt with the overrides."""
+    conf_dir0 = os.path.abspath(config.WORKSPACE['conf_path'])
+    if not os.path.exists(conf_dir):
+        os.makedirs(conf_dir)
+    for f in ('build_rule.txt', 'tools_def.txt'):
+        src, dest = os.path.join(conf_dir0, f), os.path.join(conf_dir, f)
+        if not os.path.exists(dest) or os.stat(src).st_mtime_ns != os.stat(dest).st_mtime_ns:
+            filecopy.copy_file(src, dest, 'copy' if config.DEFAULT_CONF_COPY == 'always' else config.DEFAULT_CONF_COPY)
+    gen_target_txt(dict(config.TARGET_TXT, path=os.path.join(conf_dir, 'target.txt'), **(overrides or {})), manifest)
+    return conf_dir
+
+
+def changed_files(diff_range=''):
+    """the files changed in a git diff range of the workspace, or in the working tree when the range is empty.
+    None when git fails."""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    r = run(['git', 'rev-parse', '--show-toplevel'], workspace, verbose=False)
+    if r[0] or not r[1]:
+        return None
+    top = r[1][0].strip()
+    r = run(['git', 'diff', '--name-only', diff_range or 'HEAD'], workspace, verbose=False)
+    if r[0]:
+        return None
+    return [os.path.join(top, f.strip()) for f in r[1] if f.strip()]
 
-            # platform DSC file's path (relative to WORKSPACE)
-            if '-p' not in sys.argv[1:]:
-                ppdsc = ''
-                try:
-                    ppdsc = config.DEFAULT_ACTIVE_PLATFORM
-                    ppdsc = config.ACTIVE_PLATFORM
-                except AttributeError:
-                    pass
-                if ppdsc:
-                    cmds += [
-                        '-p', ppdsc
-                    ]
 
-        cmds += sys.argv[1:]
-        r = run(cmds, os.environ['WORKSPACE'])
-    return print_run_result(r, 'build(): ')
+def module_arg(inf, workspace):
+    """the path of an INF for EDK2's '-m': relative to WORKSPACE or to a PACKAGES_PATH folder."""
+    for d in [workspace] + [p for p in os.environ.get('PACKAGES_PATH', '').split(os.pathsep) if p]:
+        d = os.path.abspath(d)
+        if inf.startswith(d + os.sep):
+            return os.path.relpath(inf, d)
+    return inf
+
+
+def impact_index():
+    """the change-impact index, refreshed incrementally. ref. ipug/impact.py"""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    index = ImpactIndex(os.path.join(config.WORKSPACE['pug_path'], 'impact.json'))
+    dsc = (getattr(config, 'PLATFORM', None) or {}).get('path', '') or getattr(config, 'ACTIVE_PLATFORM', '')
+    search_dirs = [workspace] + [p for p in os.environ.get('PACKAGES_PATH', '').split(os.pathsep) if p]
+    components = [dict(c, path=abs_path(c.get('path', ''), workspace)) for c in getattr(config, 'COMPONENT', None) or []]
+    with trace.phase('impact_index') as ev:
+        index.update(abs_path(dsc, workspace) if dsc else '', search_dirs, [os.path.join(workspace, 'Build')], components)
+        ev['parsed'] = index.parsed
+    index.save()
+    return index
+
+
+def build_impacted(cmd_arg, changed):
+    """rebuild only the modules affected by the changed files, with EDK2's single-module mode ('-m').
+    returns None when a full build is needed instead, e.g. a DSC/DEC/FDF or a file beyond the index changed.
+    NOTE: the FD/FV images are not regenerated by '-m'."""
+    if '-m' in sys.argv[1:] or config.DEFAULT_BUILD_COMMAND:
+        return None
+    index = impact_index()
+    modules, unresolved = index.affected(changed)
+    if unresolved:
+        bowwow('build_impacted(): beyond the change-impact index: %s. A full build.' % ', '.join(sorted(unresolved)[:5]), noise_pitch=1)
+        return None
+    if not modules:
+        bowwow('build_impacted(): no module is affected by the %d change(s).' % len(changed), noise_pitch=1)
+        return 0
+    return build_modules(cmd_arg, modules, index)
+
+
+def build_modules(cmd_arg, modules, index):
+    """build the modules with EDK2's '-m', one after another, each with the whole '-n' thread budget:
+    the builds share the platform's output folder, i.e. its AutoGen and the libraries' outputs.
+    a changed library is rebuilt by the build of a consumer of it. a library with no known consumer is built on its own,
+    when it's a component of the platform.
+    returns None when a full build is needed instead."""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    consumers = index.consumers()
+    libs = sorted(m for m in modules if index.is_library(m))
+    drivers = sorted(set(modules) - set(libs))
+    builds = []
+    for lib in libs:
+        users = consumers.get(lib, set())
+        if users & set(drivers + builds):
+            continue
+        if lib in index.platform:
+            builds.append(lib)
+        else:
+            bowwow('build_modules(): %s has no known consumer. A full build.' % lib, noise_pitch=1)
+            return None
+    builds += drivers
+    bowwow('build_modules(): %d module(s): %s' % (len(builds), ', '.join(module_arg(m, workspace) for m in builds)), noise_pitch=1)
+
+    held, budget, args = thread_budget(sys.argv[1:])
+    try:
+        for inf in builds:
+            r = run(build_command(cmd_arg, budget, args + ['-m', module_arg(inf, workspace)]), os.environ['WORKSPACE'])
+            if r[0]:
+                return print_run_result(r, 'build(-m %s): ' % module_arg(inf, workspace))
+    finally:
+        if held:
+            jobserver.release(held)
+    return 0
+
+
+def matrix_combos(matrix):
+    """the builds of a matrix: one per TARGET x TOOL_CHAIN_TAG, with all the TARGET_ARCH values at once, e.g. 'IA32 X64'.
+    the arches of a TARGET and a TOOL_CHAIN_TAG share EDK2's output folder, Build/<platform>/<TARGET>_<TOOL_CHAIN_TAG>,
+    i.e. the platform's AutoGen, FV and FD files: they are built by one EDK2 build, not by concurrent ones."""
+    arches = []
+    for a in matrix['TARGET_ARCH']:
+        arches += [x for x in a.split() if x not in arches]
+    return [{'TARGET': t, 'TARGET_ARCH': ' '.join(arches), 'TOOL_CHAIN_TAG': tag} for t, tag in itertools.product(matrix['TARGET'], matrix['TOOL_CHAIN_TAG'])]
+
+
+def build_matrix(cmd_arg, matrix, manifest=None):
+    """build the TARGET x TOOL_CHAIN_TAG combinations of the matrix concurrently, each for all its TARGET_ARCH values, ref. matrix_combos().
+    - each combination has its own Conf folder, i.e. CONF_PATH, next to WORKSPACE['conf_path'].
+    - the '-n' thread budget (the jobserver's tokens, or cpu_count()) is split across the combinations."""
+    combos = matrix_combos(matrix)
+    held, budget, args = thread_budget(sys.argv[1:])
+    threads = max(1, budget // len(combos))
+
+    conf_dir0 = os.path.abspath(config.WORKSPACE['conf_path'])
+    tasks = []
+    for combo in combos:
+        conf_dir = private_conf('%s.%s_%s_%s' % (conf_dir0, combo['TARGET'], combo['TARGET_ARCH'].replace(' ', '-'), combo['TOOL_CHAIN_TAG']), combo, manifest)
+        tasks += [{
+            'Command': build_command(cmd_arg, threads, args),
+            'WorkingDir': os.environ['WORKSPACE'],
+            'env': dict(os.environ, CONF_PATH=conf_dir),
+        }]
+
+    bowwow('build_matrix(): %d combination(s), %d thread(s) each.' % (len(combos), threads), noise_pitch=1)
+    start_time = time.time()
+    elapsed = []
+    try:
+        results = asyncio.run(run_group(tasks, elapsed=elapsed))
+    finally:
+        if held:
+            jobserver.release(held)
+    wall_time = time.time() - start_time
+
+    ret = 0
+    for combo, r in zip(combos, results):
+        ret |= print_run_result(r, 'build(%s/%s/%s): ' % (combo['TARGET'], combo['TARGET_ARCH'], combo['TOOL_CHAIN_TAG']))
+    bowwow('build_matrix(): summary', noise_pitch=1)
+    for combo, r, t in zip(combos, results, elapsed):
+        bowwow('  %-8s %-10s %-10s rc=%-3d %8.1fs' % (combo['TARGET'], combo['TARGET_ARCH'], combo['TOOL_CHAIN_TAG'], r[0], t), noise_pitch=1)
+    bowwow('  total wall time: %.1fs' % wall_time, noise_pitch=1)
+    return ret
+
+
+def farm_address(address):
+    """(host, port) of 'host:port'."""
+    host, _, port = address.strip().rpartition(':')
+    return host or '127.0.0.1', int(port)
+
+
+def farm_jobs(args):
+    """the jobs of 'ipug farm': those of '--pug:farm-jobs=<file>', a JSON list of {'workspace', 'argv', 'env'},
+    or one build per TARGET x TOOL_CHAIN_TAG combination of MATRIX in this workspace, for all its TARGET_ARCH values, with the args.
+    the jobs of a workspace share its Conf and Build folders: the farm runs them one at a time."""
+    if farm_jobs_path:
+        with open(farm_jobs_path, 'r') as fin:
+            jobs = json.load(fin)
+        base = os.path.dirname(os.path.abspath(farm_jobs_path))
+        return [dict(j, workspace=os.path.normpath(abs_path(j.get('workspace', '.'), base))) for j in jobs]
+    return [{
+        'workspace': os.path.abspath(config.WORKSPACE['path']),
+        'argv': ['build', '-b', c['TARGET'], '-t', c['TOOL_CHAIN_TAG']] + sum([['-a', a] for a in c['TARGET_ARCH'].split()], []) + list(args),
+        'env': {'BUILD_TARGET': c['TARGET'], 'TARGET_ARCH': c['TARGET_ARCH']},
+    } for c in matrix_combos(config.MATRIX)]
+
+
+def farm_build(jobs):
+    """hand the jobs over to the workers of DEFAULT_FARM_WORKERS, print their output and their results,
+    and save the results, including the artifact manifests, in Build/pug/farm.json."""
+    workers = [farm_address(w) for w in config.DEFAULT_FARM_WORKERS.split(',') if w.strip()]
+    try:
+        token = farm_token()
+    except (OSError, ValueError) as e:
+        bowwow('farm: %s. Please check DEFAULT_FARM_TOKEN.' % e, noise_pitch=2)
+        return 1
+    coordinator = farm.Coordinator(
+        workers, os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'farm', 'history.json'), token,
+        on_line=lambda job, line: bowwow('[%d] %s' % (job['id'], line), noise_pitch=1, no_clobber=True),
+        notify=lambda text: bowwow('farm: %s' % text, noise_pitch=1))
+    bowwow('farm: %d job(s), %d worker(s).' % (len(jobs), len(workers)), noise_pitch=1)
+    start_time = time.time()
+    results = coordinator.run(jobs)
+    wall_time = time.time() - start_time
+    write_file(os.path.join(config.WORKSPACE['pug_path'], 'farm.json'), json.dumps([dict(r, job=j) for j, r in zip(jobs, results)], indent=1))
+
+    ret = 0
+    bowwow('farm: summary', noise_pitch=1)
+    for job, r in zip(jobs, results):
+        ret = ret or r['rc']
+        bowwow('  [%d] rc=%-3d %8.1fs %-24s %d artifact(s)  ipug %s%s' % (
+            r['id'], r['rc'], r['elapsed'], r['worker'], len(r['artifacts']), ' '.join(job.get('argv', [])),
+            ('  (%s)' % r['error']) if r.get('error') else ''), noise_pitch=1)
+    bowwow('  total wall time: %.1fs' % wall_time, noise_pitch=1)
+    return ret
+
+
+def farm_token():
+    """the token of the build farm: DEFAULT_FARM_TOKEN, or the one generated in DEFAULT_PUG_CACHE_DIR/farm/token, for the workers on this host."""
+    return config.DEFAULT_FARM_TOKEN or farm.token_file(os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'farm', 'token'))
+
+
+def serve_worker():
+    """run a worker agent of the build farm on DEFAULT_FARM_LISTEN, for the workspaces of DEFAULT_FARM_WORKSPACES, until Ctrl-C."""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    workspaces = [abs_path(w, workspace) for w in config.DEFAULT_FARM_WORKSPACES.split(os.pathsep) if w.strip()] or [workspace]
+    try:
+        worker = farm.Worker(*farm_address(config.DEFAULT_FARM_LISTEN), slots=int(config.DEFAULT_FARM_SLOTS), token=farm_token(),
+                             workspaces=workspaces, notify=lambda text: bowwow('serve-worker: %s' % text, noise_pitch=1))
+    except (OSError, ValueError) as e:
+        bowwow('serve-worker: %s. Please check DEFAULT_FARM_LISTEN, DEFAULT_FARM_TOKEN and DEFAULT_FARM_WORKSPACES.' % e, noise_pitch=2)
+        return 1
+    bowwow('serve-worker: %s listening on %s:%d, %d slot(s), Ctrl-C to stop.' % (worker.name, worker.address[0], worker.address[1], worker.slots), noise_pitch=1)
+    try:
+        worker.serve_forever()
+    except KeyboardInterrupt:
+        bowwow('serve-worker: stopped.', noise_pitch=1)
+    finally:
+        worker.close()
+    return 0
+
+
+def format_seconds(seconds):
+    """a duration for the humans."""
+    if seconds is None:
+        return '?'
+    return '%dm%02ds' % divmod(int(round(seconds)), 60) if seconds >= 60 else '%.1fs' % seconds
+
+
+@git_queries
+def plan_steps(cmd_arg):
+    """evaluate the phases of build() against the on-disk state, without running a build step or writing a file.
+    returns [(the phase, the action: 'run'/'skip'/'restore', the reason)]."""
+    workspace = os.path.abspath(config.WORKSPACE['path'])
+    action = cmd_arg[0]
+    steps = []
+    if action in {'prefetch', 'watch', 'farm', 'serve-worker'}:
+        return [(action, 'run', 'not evaluated by the plan')]
+
+    # 1. the code trees and the patches.
+    if action in {'setup', 'init'}:
+        trees = {}
+        for name, node in config.CODETREE.items():
+            act, reason = trees[name] = codetree_plan(node)
+            steps.append(('setup_codetree:%s' % name, act, reason))
+        for name, node in config.CODETREE.items():
+            if not node.get('patch', None):
+                continue
+            # the patch runs on every setup; its state is known once the trees stay as they are.
+            state = patch_state(node['patch'], workspace) if all(t[0] == 'skip' for t in trees.values()) else ''
+            steps.append(('apply_patch:%s' % name, 'run', '%s: %s' % ({
+                'applicable': 'applicable, it applies cleanly',
+                'applied': 'already applied, it fails and the failure is ignored',
+                'conflicting': 'conflicting, it fails and the failure is ignored',
+            }.get(state, 'evaluated once the trees are set up' if any(t[0] != 'skip' for t in trees.values()) else 'its state is unknown, it runs'), node['patch'])))
+
+    # 2. Conf/: the templates' copies and target.txt.
+    tools_dir = os.environ.get('EDK_TOOLS_PATH', os.path.join(os.path.abspath(config.CODETREE['edk2']['path']), 'BaseTools'))
+    conf_dir = os.path.abspath(config.WORKSPACE['conf_path'])
+    manifest = load_manifest(os.path.join(config.WORKSPACE['pug_path'], 'manifest.json'))
+    if action in {'setup', 'init'}:
+        tags = set(config.MATRIX['TOOL_CHAIN_TAG']) | {config.TARGET_TXT['TOOL_CHAIN_TAG']}
+        overrides = compiler_cache_overrides(compiler_cache_path(), tags)
+        for f in ('build_rule', 'tools_def', 'target'):
+            src, dest = os.path.join(tools_dir, 'Conf', '%s.template' % f), os.path.join(conf_dir, '%s.txt' % f)
+            if not os.path.exists(src):
+                steps.append(('conf_files', 'run', '%s.txt: the template comes with the code tree' % f))
+            elif config.DEFAULT_CONF_COPY == 'always':
+                steps.append(('conf_files', 'run', '%s.txt: copied on every setup (CONF_COPY=always)' % f))
+            elif conf_file_status(src, dest, manifest, overrides.get(f, ('', None))[0])[0]:
+                steps.append(('conf_files', 'skip', '%s.txt: the template and the overrides are unchanged' % f))
+            else:
+                steps.append(('conf_files', 'run', '%s.txt: %s' % (f, 'changed or touched since the copy' if os.path.exists(dest) else 'missing')))
+    if is_generated_current(manifest, config.TARGET_TXT['path'], fingerprint(config.TARGET_TXT)):
+        steps.append(('gen_target_txt', 'skip', 'target.txt is current'))
+    else:
+        steps.append(('gen_target_txt', 'run', 'target.txt is %s' % ('stale or touched' if os.path.exists(config.TARGET_TXT['path']) else 'missing')))
+
+    # 3. BaseTools.
+    if action in pug_action_all:
+        store = os.path.join(config.DEFAULT_PUG_CACHE_DIR, 'basetools')
+        if cmd_arg[:2] == ['build', 'clean']:
+            steps.append(('build_basetools', 'skip', "'build clean' leaves BaseTools alone"))
+        elif action == 'clean-basetools' or cmd_arg[:2] == ['build', 'cleanall']:
+            steps.append(('build_basetools', 'run', 'make clean'))
+        elif not os.path.isdir(os.path.join(tools_dir, 'Source', 'C')):
+            steps.append(('build_basetools', 'run', 'make, once the code tree is fetched'))
+        elif int(config.DEFAULT_BASETOOLS_CACHE_SIZE) <= 0 or UDKBUILD_MAKETOOL != 'make':
+            steps.append(('build_basetools', 'run', 'make, without the BaseTools cache'))
+        else:
+            _, current, hit = basetools_status(tools_dir, store)
+            steps.append(('build_basetools', 'skip', 'the binaries are up-to-date') if current else
+                         ('build_basetools', 'restore', 'the binaries are in the cache %s' % hit) if hit else
+                         ('build_basetools', 'run', 'make: the sources or the compiler changed'))
+        if action in {'init-basetools', 'clean-basetools'}:
+            return steps
+
+    # 4. the DSC/INF files.
+    if action in {'setup', 'init'}:
+        cPlatform, cComponent = getattr(config, 'PLATFORM', None), getattr(config, 'COMPONENT', None)
+        if cPlatform and cComponent and cPlatform.get('update', False):
+            dsc_path = abs_path(cPlatform['path'], workspace)
+            current = is_generated_current(manifest, dsc_path, platform_fingerprint(cPlatform, cComponent))
+            steps.append(('platform_dsc', 'skip' if current else 'run', '%s is %s' % (cPlatform['path'], 'current' if current else 'stale, touched or missing')))
+        if cComponent:
+            stale, missing = 0, []
+            for comp in cComponent:
+                if comp.get('update', False) and not is_generated_current(manifest, abs_path(comp.get('path', ''), workspace), fingerprint(comp)):
+                    stale += 1
+                    if not comp.get('Defines', ''):
+                        missing.append(comp.get('path', ''))
+            steps.append(('component_inf', 'run' if stale else 'skip', '%d of %d INF file(s) to generate%s' % (
+                stale, len(cComponent), ('; no [Defines]: %s' % ', '.join(missing)) if missing else '')))
+        return steps
+
+    # 5. the EDK2 build.
+    args = sys.argv[1:]
+    if impact_changes is not None and action == 'build' and not cmd_arg[1] and '--pug:matrix' not in cmd_arg[2]:
+        steps.append(('build', 'run', 'the modules affected by %d changed file(s), or a full build' % len(impact_changes)))
+    elif '--pug:matrix' in cmd_arg[2]:
+        for combo in matrix_combos(config.MATRIX):
+            steps.append(('build_matrix', 'run', '%s: %s' % ('/'.join(combo[k] for k in matrix_keys), ' '.join(build_command(cmd_arg, 0, args)))))
+    else:
+        bcache = binary_cache(args) if action == 'build' and not cmd_arg[1] else None
+        if bcache:
+            consume = os.path.isdir(bcache.root) and bool(bincache.entries(bcache.root))
+            args = args + ['--hash', '--binary-%s=%s' % ('source' if consume else 'destination', bcache.root)]
+        steps.append(('build', 'run', ' '.join(build_command(cmd_arg, 0, args))))
+    return steps
+
+
+def plan(cmd_arg):
+    """'--pug:plan': print the action plan of build(), with the estimated costs from the previous runs' timings."""
+    steps = plan_steps(cmd_arg)
+    timings = trace.load_timings(os.path.join(config.WORKSPACE['pug_path'], 'timings.json'))
+    msg = ["The plan of 'ipug %s' (the estimates are the previous runs' averages):" % ' '.join([cmd_arg[0]] + sys.argv[1:])]
+    total, unknown, shown = 0.0, [], set()
+    width = max([16] + [len(st[0]) for st in steps])
+    for phase, act, reason in steps:
+        estimate = ''
+        if act == 'run' and phase not in shown:
+            shown.add(phase)
+            seconds = timings.get(phase, {}).get('average', None)
+            estimate = format_seconds(seconds)
+            if seconds is None:
+                unknown.append(phase)
+            else:
+                total += seconds
+        msg.append('  %-*s %-8s %8s  %s' % (width, phase, act, estimate, reason))
+    msg.append('The estimated work, some of which runs concurrently: %s%s' % (format_seconds(total), (', and %s unknown' % ', '.join(unknown)) if unknown else ''))
+    bowwow('\n'.join(msg), noise_pitch=3)
+    return 0
 
 
 def usage():
@@ -605,14 +2203,44 @@ def usage():
 
     defines
         e.g TARGET=RELEASE
+
+    ipug prefetch [edk2-tag ...]
+        -- refresh the local git mirrors of the code trees
+
+    ipug watch [edk2_build_argument]
+        -- build, then rebuild incrementally on the changes of the workspace, the components and project.py
+
+    ipug serve-worker
+        -- run a build farm's worker agent on DEFAULT_FARM_LISTEN (host:port), for the workspaces of DEFAULT_FARM_WORKSPACES
+
+    ipug farm [edk2_build_argument]
+        -- hand the builds of MATRIX, or of --pug:farm-jobs, over to the workers of DEFAULT_FARM_WORKERS
+
+    pug's options
+        --pug:matrix[=KEY=VALUE1,VALUE2,...]
+        -- build the TARGET x TOOL_CHAIN_TAG combinations of MATRIX concurrently, each for all the TARGET_ARCH values
+        --pug:changed=<file>[,<file>...] | --pug:diff[=<git-range>]
+        -- rebuild only the modules affected by the changed files, with EDK2's '-m'
+        --pug:farm-jobs=<file>
+        -- the jobs of 'ipug farm', a JSON list of {{"workspace": ..., "argv": [...], "env": {{...}}}}
+        --pug:plan
+        -- print what the action would run or skip, and why, with the estimates of the previous runs; nothing is run
+        --pug:trace=<file>
+        -- export the timing of the phases and the commands as a Chrome trace, and <file>.summary.json
+        --pug:log-json=<file>
+        -- append every message, with its time, level, phase and command id, to a JSON-lines file
 """
 
+    log.flush()
     print(msg)
 
 
 def main():
     """main"""
+    global impact_changes, farm_jobs_path
     cmd_arg = ['build', '', set()]
+    trace_path = ''
+    log_json = None
 
     if config.project is None:
         bowwow('Ignoring the missing project.py.', noise_pitch=0)
@@ -632,6 +2260,10 @@ def main():
             cmd_arg[2].add('--pug:dry-run')
             sys.argv.remove('--pug:dry-run')
 
+        if '--pug:plan' in sys.argv[1:]:
+            cmd_arg[2].add('--pug:plan')
+            sys.argv.remove('--pug:plan')
+
         if '--pug:config' in sys.argv[1:]:
             bowwow(config.dump_config(), 3, no_clobber=True)
             cmd_arg[2].add('--pug:config')
@@ -642,6 +2274,47 @@ def main():
             cmd_arg[2].add('--pug:environ')
             sys.argv.remove('--pug:environ')
 
+        for a in [a for a in sys.argv[1:] if a.startswith('--pug:trace=')]:
+            # --pug:trace=<file>: the Chrome trace, and <file-without-extension>.summary.json
+            trace_path = a[len('--pug:trace='):]
+            trace.enable()
+            cmd_arg[2].add('--pug:trace')
+            sys.argv.remove(a)
+
+        for a in [a for a in sys.argv[1:] if a.startswith('--pug:log-json=')]:
+            # --pug:log-json=<file>: the JSON-lines sink of the messages, instead of DEFAULT_LOG_JSON
+            log_json = a[len('--pug:log-json='):]
+            sys.argv.remove(a)
+
+        for a in [a for a in sys.argv[1:] if a.startswith('--pug:changed=') or a.startswith('--pug:diff')]:
+            # --pug:changed=<file>[,<file>...] or --pug:diff[=<git-range>]: rebuild the affected modules only.
+            if a.startswith('--pug:changed='):
+                impact_changes = (impact_changes or []) + [os.path.abspath(f) for f in a[len('--pug:changed='):].split(',') if f]
+            else:
+                changed = changed_files(a[len('--pug:diff='):] if a.startswith('--pug:diff=') else '')
+                if changed is None:
+                    bowwow('Unable to get the changed files of "%s". A full build.' % a, noise_pitch=2)
+                else:
+                    impact_changes = (impact_changes or []) + changed
+            sys.argv.remove(a)
+
+        for a in [a for a in sys.argv[1:] if a.startswith('--pug:farm-jobs=')]:
+            farm_jobs_path = a[len('--pug:farm-jobs='):]
+            sys.argv.remove(a)
+
+        for a in [a for a in sys.argv[1:] if a.startswith('--pug:matrix')]:
+            # --pug:matrix[=KEY=VALUE1,VALUE2,...], KEY: TARGET|TARGET_ARCH|TOOL_CHAIN_TAG
+            if a.startswith('--pug:matrix='):
+                k, _, v = a[len('--pug:matrix='):].partition('=')
+                values = [x.strip() for x in v.split(',') if x.strip()]
+                if k not in matrix_keys or not values:
+                    bowwow('Usage: --pug:matrix[=KEY=VALUE1,VALUE2,...], KEY: %s; not: %s' % ('|'.join(matrix_keys), a), noise_pitch=2)
+                    log.flush()
+                    return 1
+                config.MATRIX[k] = values
+            cmd_arg[2].add('--pug:matrix')
+            sys.argv.remove(a)
+
         if '--help' in sys.argv[1:]:
             cmd_arg[0] = '--help'
 
@@ -657,15 +2330,21 @@ def main():
     except IndexError:
         pass
 
+    log.configure(config.DEFAULT_LOG_FLUSH, config.DEFAULT_LOG_JSON if log_json is None else log_json)
     bowwow('sys.argv: %s' % str(sys.argv), 0)
     bowwow('cmd_arg: %s' % str(cmd_arg), 0)
     ret = build(cmd_arg)
+    if not dry_run and '--pug:plan' not in cmd_arg[2]:
+        trace.save_timings(os.path.join(config.WORKSPACE['pug_path'], 'timings.json'))
+    if trace_path:
+        bowwow('The trace: %s\nThe trace summary: %s' % (os.path.abspath(trace_path), trace.export(trace_path)), noise_pitch=1)
 
     elapsed_time = time.gmtime(int(round(time.time() - start_time)))
     elapsed_time_str = time.strftime('%H:%M:%S', elapsed_time)
     if elapsed_time.tm_yday > 1:
         elapsed_time_str += ', %d day(s)' % (elapsed_time.tm_yday - 1)
     bowwow("\nPug's running elapsed time: %s" % elapsed_time_str, noise_pitch=1)
+    log.flush()
     return ret
 
 
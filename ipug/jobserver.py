@@ -0,0 +1,117 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+A GNU make jobserver, so that pug, the BaseTools make and the EDK2 build share one concurrency limit.
+- pug joins the jobserver of its parent (MAKEFLAGS' --jobserver-auth), or creates its own token pipe.
+- the child makes join it via the exported MAKEFLAGS and the inherited pipe fds.
+- pug sizes EDK2 build's '-n' by the number of the tokens it acquires from the pool.
+Ref. https://www.gnu.org/software/make/manual/html_node/POSIX-Jobserver.html
+"""
+
+__all__ = ['JobServer']
+
+import os
+import re
+import select
+
+
+class JobServer(object):
+    """the client side and (when there is no jobserver to join) the server side of a GNU make jobserver."""
+
+    def __init__(self, jobs, makeflags=None):
+        self.jobs = max(int(jobs), 1)
+        self.rfd = self.wfd = -1
+        self.nbfd = -1
+        self.fifo = ''
+        self.owner = False
+        self.tokens = []
+        makeflags = os.environ.get('MAKEFLAGS', '') if makeflags is None else makeflags
+        if not self._join(makeflags):
+            self.rfd, self.wfd = os.pipe()
+            os.write(self.wfd, b'+' * self.jobs)
+            self.owner = True
+        for fd in (self.rfd, self.wfd):
+            os.set_inheritable(fd, True)
+        try:
+            # an open file description of its own, so that the non-blocking reads do not affect the others.
+            self.nbfd = os.open('/proc/self/fd/%d' % self.rfd, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            self.nbfd = -1
+
+    def _join(self, makeflags):
+        """join the jobserver in MAKEFLAGS. returns False when there is none usable."""
+        m = re.search(r'--jobserver-(?:auth|fds)=(fifo:(\S+)|(\d+),(\d+))', makeflags)
+        if not m:
+            return False
+        j = re.search(r'(?:^|\s)-j(\d+)', makeflags)
+        if j:
+            self.jobs = int(j.group(1))
+        try:
+            if m.group(2):
+                self.fifo = m.group(2)
+                self.rfd = os.open(self.fifo, os.O_RDWR)
+                self.wfd = self.rfd
+            else:
+                self.rfd, self.wfd = int(m.group(3)), int(m.group(4))
+                os.fstat(self.rfd)
+                os.fstat(self.wfd)
+        except OSError:
+            self.rfd = self.wfd = -1
+            self.fifo = ''
+            return False
+        return True
+
+    def makeflags(self):
+        """the MAKEFLAGS for the child makes."""
+        auth = ('fifo:%s' % self.fifo) if self.fifo else ('%d,%d' % (self.rfd, self.wfd))
+        return ' -j%d --jobserver-auth=%s' % (self.jobs, auth)
+
+    def pass_fds(self):
+        """the fds to be inherited by the child processes."""
+        return () if self.fifo else (self.rfd, self.wfd)
+
+    def _try_read(self):
+        if self.nbfd >= 0:
+            try:
+                return os.read(self.nbfd, 1)
+            except BlockingIOError:
+                return b''
+        if select.select([self.rfd], [], [], 0)[0]:
+            return os.read(self.rfd, 1)
+        return b''
+
+    def acquire(self, most=1):
+        """acquire at least one and at most 'most' tokens; only the first one may block.
+        returns the number of the acquired tokens."""
+        self.tokens += [os.read(self.rfd, 1)]
+        n = 1
+        while n < most:
+            t = self._try_read()
+            if not t:
+                break
+            self.tokens += [t]
+            n += 1
+        return n
+
+    def release(self, n):
+        """return n tokens to the pool."""
+        n = min(n, len(self.tokens))
+        if n > 0:
+            os.write(self.wfd, b''.join(self.tokens[-n:]))
+            del self.tokens[-n:]
+
+    def close(self):
+        """return the held tokens, and close the pipe when it is pug's own."""
+        self.release(len(self.tokens))
+        if self.nbfd >= 0:
+            os.close(self.nbfd)
+            self.nbfd = -1
+        if self.owner or self.fifo:
+            for fd in {self.rfd, self.wfd}:
+                os.close(fd)
+        self.rfd = self.wfd = -1
@@ -0,0 +1,161 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The messages of pug, i.e. bowwow()'s and the commands' output lines: queued by emit(), and written by a writer thread
+in batches, so that a chatty build doesn't wait for the console on every line.
+
+The writer writes the queued messages at once, and flushes the console once, every `latency` seconds
+(DEFAULT_LOG_FLUSH). With a latency of 0, each message is written and flushed as it comes, as before.
+The queue is bounded: once max_pending messages are waiting, emit() waits for the writer.
+
+The optional JSON-lines sink (DEFAULT_LOG_JSON, '--pug:log-json=<file>') records every message, shown or not:
+    {'ts', 'level', 'phase', 'cmd', 'msg'}
+- level: the noise pitch's name, ref. level_names.
+- phase: the innermost trace.phase() of the thread, or ''.
+- cmd: the id of the run() command whose output line it is, or whose launch it tells; 0 otherwise.
+"""
+
+__all__ = ['emit', 'flush', 'configure', 'close', 'level_names']
+
+import os
+import sys
+import json
+import time
+import atexit
+import threading
+
+from . import trace
+
+level_names = ('debug', 'info', 'warning', 'notice')     # bowwow()'s noise pitches 0, 1, 2 and 3
+max_pending = 65536         # the queued messages beyond which emit() waits for the writer
+tag = 'PUG: '
+
+latency = 0.1               # the seconds between the writer's batches, 0: write each message at once
+json_path = ''
+json_file = None
+pending = []                # [(the console text or None, the JSON record or None)]
+cond = threading.Condition()        # guards pending
+write_lock = threading.Lock()       # keeps the batches in order
+wake = threading.Event()
+writer = None
+
+
+def level_name(level):
+    """the name of a noise pitch."""
+    return level_names[min(max(level, 0), len(level_names) - 1)]
+
+
+def format_text(msg):
+    """a message as shown: each line tagged, and a leading newline as an empty line."""
+    head = ''
+    if msg.startswith('\n'):
+        head, msg = '\n\n', msg[1:]
+    return '%s%s%s\n' % (head, tag, msg.replace('\n', '\n' + tag))
+
+
+def emit(msg, level=1, show=True, raw=False, cmd=0):
+    """queue a message: shown on the console when show is set, and recorded by the JSON-lines sink when it's on.
+    raw: the message is shown as it is, e.g. a line of a command's output, instead of tagged."""
+    if not show and json_file is None:
+        return
+    text = (msg + '\n' if raw else format_text(msg)) if show else None
+    record = {'ts': round(time.time(), 3), 'level': level_name(level), 'phase': trace.current_phase(), 'cmd': cmd, 'msg': msg} if json_file else None
+    if latency <= 0:
+        with write_lock:
+            write([(text, record)])
+        return
+    with cond:
+        pending.append((text, record))
+        if len(pending) >= max_pending:
+            wake.set()
+            while len(pending) >= max_pending:
+                cond.wait()
+    if writer is None:
+        start()
+
+
+def write(batch):
+    """write a batch: the console text at once, then the JSON records."""
+    text = ''.join(t for t, _ in batch if t)
+    if text:
+        try:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        except (IOError, OSError, ValueError):     # e.g. a closed pipe
+            pass
+    records = [r for _, r in batch if r]
+    if records and json_file is not None:
+        json_file.write(''.join(json.dumps(r) + '\n' for r in records))
+        json_file.flush()
+
+
+def flush():
+    """write the queued messages now, e.g. before a child writes to the console directly."""
+    with write_lock:
+        with cond:
+            batch, pending[:] = list(pending), []
+            cond.notify_all()
+        if batch:
+            write(batch)
+
+
+def _run():
+    while True:
+        wake.wait(latency if latency > 0 else None)
+        wake.clear()
+        flush()
+
+
+def start():
+    """start the writer thread."""
+    global writer
+    with cond:
+        if writer is not None:
+            return
+        writer = threading.Thread(target=_run, name='pug-log-writer', daemon=True)
+        writer.start()
+    atexit.register(close)
+
+
+def configure(flush_latency=None, json_sink=None):
+    """set the flush latency in seconds, and/or the path of the JSON-lines sink ('' to close it)."""
+    global latency, json_path, json_file
+    flush()
+    if flush_latency is not None:
+        latency = max(float(flush_latency), 0.0)
+    if json_sink is not None and json_sink != json_path:
+        if json_file is not None:
+            json_file.close()
+            json_file = None
+        json_path = json_sink
+        if json_path:
+            path_dir = os.path.dirname(os.path.abspath(json_path))
+            if not os.path.exists(path_dir):
+                os.makedirs(path_dir)
+            json_file = open(json_path, 'a', encoding='utf-8')
+
+
+def close():
+    """write the queued messages, and close the JSON-lines sink."""
+    global json_file, json_path
+    flush()
+    if json_file is not None:
+        json_file.close()
+        json_file, json_path = None, ''
+
+
+def _after_fork():
+    """a forked child has no writer thread: it starts its own on demand."""
+    global writer, cond, write_lock
+    writer = None
+    cond, write_lock = threading.Condition(), threading.Lock()
+    del pending[:]
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork)
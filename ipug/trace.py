@@ -0,0 +1,185 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+Phase-level tracing of pug: the phases of build() and every command launched by run().
+The events are exported in the Chrome trace-event format (chrome://tracing, Perfetto) and as a JSON summary.
+The phases' durations are timed even when the tracing is off, and kept across the runs for '--pug:plan'.
+"""
+
+__all__ = ['enable', 'phase', 'current_phase', 'add_run', 'children_cpu', 'export', 'load_timings', 'save_timings']
+
+import os
+import json
+import time
+import threading
+import contextlib
+
+try:
+    import resource
+except ImportError:     # Windows
+    resource = None
+
+enabled = False
+events = []
+timings = {}        # {phase name: the seconds spent in this run}
+origin = time.time()
+lock = threading.Lock()
+local = threading.local()     # the phases entered by the thread, innermost last
+
+
+def enable():
+    """start recording."""
+    global enabled, origin
+    enabled = True
+    origin = time.time()
+    del events[:]
+
+
+def children_cpu():
+    """the CPU time (user + system) of the terminated child processes so far."""
+    if resource is None:
+        return 0.0
+    ru = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return ru.ru_utime + ru.ru_stime
+
+
+@contextlib.contextmanager
+def phase(name, **args):
+    """record a phase. The yielded dict takes the extra arguments of the phase, e.g. its 'rc'.
+    NOTE: child_cpu is the CPU time of the children terminated during the phase, including those of the concurrent phases."""
+    start = time.time()
+    stack = local.__dict__.setdefault('phases', [])
+    stack.append(name)
+    if not enabled:
+        try:
+            yield args
+        finally:
+            stack.pop()
+            with lock:
+                timings[name] = timings.get(name, 0.0) + time.time() - start
+        return
+    cpu0 = children_cpu()
+    try:
+        yield args
+    finally:
+        stack.pop()
+        args['child_cpu'] = round(children_cpu() - cpu0, 6)
+        end = time.time()
+        with lock:
+            timings[name] = timings.get(name, 0.0) + end - start
+            events.append({'cat': 'phase', 'name': name, 'start': start, 'end': end, 'args': args})
+
+
+def current_phase():
+    """the innermost phase of the calling thread, or ''."""
+    stack = local.__dict__.get('phases', None)
+    return stack[-1] if stack else ''
+
+
+def add_run(command, cwd, start, end, rc, rusage=None):
+    """record a command launched by run(). rusage: (user CPU, system CPU, max RSS in KiB) of the child, when known."""
+    if not enabled:
+        return
+    args = {'command': command, 'cwd': cwd, 'rc': rc}
+    if rusage:
+        args.update({'utime': round(rusage[0], 6), 'stime': round(rusage[1], 6), 'maxrss_kb': rusage[2]})
+    with lock:
+        events.append({'cat': 'run', 'name': os.path.basename(command.split(None, 1)[0]) if command.strip() else 'run', 'start': start, 'end': end, 'args': args})
+
+
+def _lanes(evs):
+    """assign each event a lane (Chrome's tid) so that the overlapping events are shown side by side."""
+    lanes, ret = [], []
+    for e in sorted(evs, key=lambda x: (x['start'], -x['end'])):
+        for i, end in enumerate(lanes):
+            if end <= e['start']:
+                lanes[i] = e['end']
+                break
+        else:
+            i = len(lanes)
+            lanes.append(e['end'])
+        ret.append((i, e))
+    return ret
+
+
+def chrome_trace():
+    """the events in the Chrome trace-event format."""
+    pid = os.getpid()
+    trace_events = [
+        {'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': 'pug'}},
+    ]
+    with lock:
+        evs = list(events)
+    # the phases occupy the lanes 1.., and the commands the lanes 1001..
+    for cat, base in (('phase', 1), ('run', 1001)):
+        for lane, e in _lanes([e for e in evs if e['cat'] == cat]):
+            trace_events.append({
+                'name': e['name'], 'cat': cat, 'ph': 'X', 'pid': pid, 'tid': base + lane,
+                'ts': int((e['start'] - origin) * 1e6), 'dur': int((e['end'] - e['start']) * 1e6),
+                'args': e['args'],
+            })
+    return {'traceEvents': trace_events, 'displayTimeUnit': 'ms'}
+
+
+def summary():
+    """the JSON summary: every phase and command, and the total time per phase name."""
+    with lock:
+        evs = sorted(events, key=lambda x: x['start'])
+    ret = {'start': origin, 'total': round(time.time() - origin, 6), 'phases': [], 'runs': [], 'by_phase': {}}
+    for e in evs:
+        item = dict(e['args'], name=e['name'], start=round(e['start'] - origin, 6), duration=round(e['end'] - e['start'], 6))
+        if e['cat'] == 'phase':
+            ret['phases'].append(item)
+            ret['by_phase'][e['name']] = round(ret['by_phase'].get(e['name'], 0.0) + item['duration'], 6)
+        else:
+            ret['runs'].append(item)
+    return ret
+
+
+def export(path):
+    """write the Chrome trace to path, and the JSON summary next to it as <path-without-extension>.summary.json.
+    returns the summary's path."""
+    path = os.path.abspath(path)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as fout:
+        json.dump(chrome_trace(), fout)
+    summary_path = os.path.splitext(path)[0] + '.summary.json'
+    with open(summary_path, 'w') as fout:
+        json.dump(summary(), fout, indent=1)
+    return summary_path
+
+
+def load_timings(path):
+    """the phases' durations of the previous runs: {phase name: {'last', 'average', 'runs'}}."""
+    try:
+        with open(path, 'r') as fin:
+            return json.load(fin)
+    except (IOError, OSError, ValueError):
+        return {}
+
+
+def save_timings(path):
+    """merge this run's phase durations into the previous ones. the average is an exponential moving one."""
+    with lock:
+        current = dict(timings)
+    if not current:
+        return
+    history = load_timings(path)
+    for name, seconds in current.items():
+        h = history.get(name, None)
+        if h is None:
+            history[name] = {'last': round(seconds, 3), 'average': round(seconds, 3), 'runs': 1}
+        else:
+            history[name] = {'last': round(seconds, 3), 'average': round(h.get('average', seconds) * 0.5 + seconds * 0.5, 3), 'runs': h.get('runs', 0) + 1}
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    tmp = '%s.%d.tmp' % (path, os.getpid())
+    with open(tmp, 'w') as fout:
+        json.dump(history, fout, indent=1, sort_keys=True)
+    os.replace(tmp, path)
@@ -0,0 +1,233 @@
+#
+# -*- coding: utf-8 -*-
+# pylint: disable=invalid-name, line-too-long
+#
+# (c) 2019-2021 Timothy Lin <timothy.gh.lin@gmail.com>, BSD 3-Clause License.
+#
+
+"""
+The file watchers of 'ipug watch': inotify on Linux, and a polling fallback elsewhere.
+
+A watcher watches (1) the folders recursively and (2) the individual files, e.g. project.py.
+A file is watched through its folder, so that the editors replacing the file by a rename are still seen.
+"""
+
+__all__ = ['Poller', 'Inotify', 'watcher', 'collect']
+
+import os
+import time
+import errno
+import struct
+import ctypes
+import ctypes.util
+import selectors
+
+# the editors' temporary files.
+ignored_prefixes = ('.#',)
+ignored_suffixes = ('~', '.swp', '.swx', '.tmp', '.pyc')
+
+
+def is_ignored(name):
+    """True for the editors' temporary files."""
+    return name.startswith(ignored_prefixes) or name.endswith(ignored_suffixes) or name == '4913'
+
+
+class Poller(object):
+    """watch by comparing the (mtime_ns, size) snapshots of the files, every interval seconds."""
+
+    def __init__(self, roots, files=(), exclude=(), interval=1.0):
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.files = {os.path.abspath(f) for f in files}
+        self.exclude = {os.path.abspath(e) for e in exclude}
+        self.interval = interval
+        self.snapshot = self.scan()
+
+    def is_excluded(self, path):
+        """True for an excluded folder, or a folder under it."""
+        return any(path == e or path.startswith(e + os.sep) for e in self.exclude)
+
+    def scan(self):
+        """the {path: (mtime_ns, size)} of all the watched files."""
+        snap = {}
+        todo = [r for r in self.roots if not self.is_excluded(r)]
+        while todo:
+            d = todo.pop()
+            try:
+                entries = list(os.scandir(d))
+            except OSError:
+                continue
+            for e in entries:
+                if e.is_dir(follow_symlinks=False):
+                    if e.name != '.git' and not self.is_excluded(e.path):
+                        todo.append(e.path)
+                elif not is_ignored(e.name):
+                    try:
+                        st = e.stat()
+                        snap[e.path] = (st.st_mtime_ns, st.st_size)
+                    except OSError:
+                        pass
+        for f in self.files:
+            try:
+                st = os.stat(f)
+                snap[f] = (st.st_mtime_ns, st.st_size)
+            except OSError:
+                pass
+        return snap
+
+    def changes(self, timeout=None):
+        """the paths changed (created, modified or removed) within timeout seconds. None waits forever."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            snap = self.scan()
+            changed = {p for p in set(snap) | set(self.snapshot) if snap.get(p) != self.snapshot.get(p)}
+            self.snapshot = snap
+            if changed:
+                return changed
+            if deadline is not None and time.time() >= deadline:
+                return set()
+            time.sleep(self.interval if deadline is None else max(0, min(self.interval, deadline - time.time())))
+
+    def close(self):
+        """nothing to release."""
+
+
+class Inotify(object):
+    """watch with Linux's inotify. raises OSError when inotify is unavailable or the watches run out."""
+
+    IN_ATTRIB, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x4, 0x8, 0x40, 0x80
+    IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_MOVE_SELF = 0x100, 0x200, 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ISDIR = 0x4000, 0x8000, 0x40000000
+    mask = IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF
+    event = struct.Struct('iIII')
+
+    def __init__(self, roots, files=(), exclude=()):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(self.libc, 'inotify_init1'):
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1')
+        self.roots = [os.path.abspath(r) for r in roots]
+        self.files = {os.path.abspath(f) for f in files}
+        self.exclude = {os.path.abspath(e) for e in exclude}
+        self.wds = {}           # {wd: (folder, recursive)}
+        self.selector = selectors.DefaultSelector()
+        self.selector.register(self.fd, selectors.EVENT_READ)
+        try:
+            for r in self.roots:
+                self.add_tree(r)
+            for f in self.files:
+                self.add_dir(os.path.dirname(f), False)
+        except OSError:
+            self.close()
+            raise
+
+    def is_excluded(self, path):
+        """True for an excluded folder, or a folder under it."""
+        return any(path == e or path.startswith(e + os.sep) for e in self.exclude)
+
+    def add_dir(self, path, recursive):
+        """watch a folder. a folder already watched recursively stays so."""
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), self.mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in {errno.ENOENT, errno.ENOTDIR, errno.EACCES}:
+                return
+            raise OSError(err, 'inotify_add_watch: %s' % path)
+        self.wds[wd] = (path, recursive or self.wds.get(wd, ('', False))[1])
+
+    def add_tree(self, root):
+        """watch a folder and its sub-folders. returns the files found, for the folders created after a watch."""
+        found = []
+        todo = [root]
+        while todo:
+            d = todo.pop()
+            if self.is_excluded(d):
+                continue
+            self.add_dir(d, True)
+            try:
+                for e in os.scandir(d):
+                    if e.is_dir(follow_symlinks=False):
+                        if e.name != '.git':
+                            todo.append(e.path)
+                    elif not is_ignored(e.name):
+                        found.append(e.path)
+            except OSError:
+                pass
+        return found
+
+    def read_events(self):
+        """drain the pending events into the changed paths."""
+        changed = set()
+        while True:
+            try:
+                buf = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changed
+            if not buf:
+                return changed
+            pos = 0
+            while pos < len(buf):
+                wd, mask, _, length = self.event.unpack_from(buf, pos)
+                name = os.fsdecode(buf[pos + self.event.size:pos + self.event.size + length].rstrip(b'\0'))
+                pos += self.event.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    # the events are lost: report every watched root.
+                    changed |= set(self.roots) | self.files
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.wds.pop(wd, None)
+                    continue
+                folder, recursive = self.wds.get(wd, ('', False))
+                if not folder or not name or is_ignored(name):
+                    continue
+                path = os.path.join(folder, name)
+                if not recursive and path not in self.files:
+                    continue
+                if mask & self.IN_ISDIR:
+                    if recursive and mask & (self.IN_CREATE | self.IN_MOVED_TO) and name != '.git':
+                        changed |= set(self.add_tree(path))
+                    continue
+                changed.add(path)
+
+    def changes(self, timeout=None):
+        """the paths changed (created, modified or removed) within timeout seconds. None waits forever."""
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            left = None if deadline is None else max(0, deadline - time.time())
+            if self.selector.select(left):
+                changed = self.read_events()
+                if changed:
+                    return changed
+            elif deadline is not None:
+                return set()
+
+    def close(self):
+        """release the inotify instance."""
+        if self.fd >= 0:
+            self.selector.close()
+            os.close(self.fd)
+            self.fd = -1
+
+
+def watcher(roots, files=(), exclude=(), poll=0):
+    """inotify when it's available and poll is 0; otherwise a Poller polling every poll (or 1) second(s)."""
+    if not poll and hasattr(os, 'O_CLOEXEC') and os.path.exists('/proc/sys/fs/inotify'):
+        try:
+            return Inotify(roots, files, exclude)
+        except OSError:
+            pass
+    return Poller(roots, files, exclude, poll or 1.0)
+
+
+def collect(w, debounce=0.3, timeout=None):
+    """wait for the changes, then keep collecting them until debounce seconds pass quietly.
+    returns (the changed paths, the time of the first change)."""
+    changed = w.changes(timeout)
+    first = time.time()
+    while changed:
+        more = w.changes(debounce)
+        if not more:
+            break
+        changed |= more
+    return changed, first
@@ -4,21 +4,52 @@
 """Tests for `ipug` package."""
 
 
+import os
+import sys
+import itertools
+import json
+import time
+import hashlib
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
+import subprocess
 from click.testing import CliRunner
 
 from ipug import ipug
 from ipug import cli
 
 
+def make_repo(root, name, files=None, tag='v1'):
+    """create a bare git repo with one commit and one tag. returns its file:// url."""
+    src = os.path.join(root, '%s.src' % name)
+    bare = os.path.join(root, '%s.git' % name)
+    os.makedirs(src)
+    for f, content in (files or {'README': name}).items():
+        fpath = os.path.join(src, f)
+        if not os.path.exists(os.path.dirname(fpath)):
+            os.makedirs(os.path.dirname(fpath))
+        with open(fpath, 'w') as fout:
+            fout.write(content)
+    git = ['git', '-c', 'user.name=pug', '-c', 'user.email=pug@localhost', '-c', 'init.defaultBranch=master']
+    for cmd in (['init', '-q'], ['add', '-A'], ['commit', '-q', '-m', 'init'], ['tag', tag]):
+        subprocess.check_call(git + cmd, cwd=src)
+    subprocess.check_call(git + ['clone', '-q', '--bare', src, bare])
+    return 'file://' + bare
+
+
 class TestIpug(unittest.TestCase):
     """Tests for `ipug` package."""
 
     def setUp(self):
         """Set up test fixtures, if any."""
+        self.tmp = tempfile.mkdtemp(prefix='pug-test-')
 
     def tearDown(self):
         """Tear down test fixtures, if any."""
+        shutil.rmtree(self.tmp, ignore_errors=True)
 
     def test_000_something(self):
         """Test something."""
@@ -33,5 +64,998 @@ class TestIpug(unittest.TestCase):
         #assert help_result.exit_code == 0
         #assert '--help  Show this message and exit.' in help_result.output
 
+    def test_setup_codetree_concurrent(self):
+        """independent nodes are cloned concurrently, a nested node waits for its parent."""
+        codetree = {
+            'edk2': {'source': {'url': make_repo(self.tmp, 'edk2'), 'signature': 'v1'}, 'path': os.path.join(self.tmp, 'ws', 'edk2')},
+            'other': {'source': {'url': make_repo(self.tmp, 'other'), 'signature': 'v1'}, 'path': os.path.relpath(os.path.join(self.tmp, 'ws', 'other'))},
+            'nested': {'source': {'url': make_repo(self.tmp, 'nested'), 'signature': 'v1'}, 'path': os.path.join(self.tmp, 'ws', 'edk2', 'nested')},
+        }
+        self.assertEqual(ipug.setup_codetree(codetree, jobs=3), 0)
+        self.assertFalse(os.path.isabs(codetree['other']['path']))     # the config is left as it is
+        for c in codetree:
+            self.assertTrue(os.path.exists(os.path.join(codetree[c]['path'], 'README')))
+
+    def test_setup_codetree_sparse(self):
+        """a blobless clone checks out only the sparse folders, with the referenced packages, and the submodules inside them."""
+        git = ['git', '-c', 'user.name=pug', '-c', 'user.email=pug@localhost', '-c', 'protocol.file.allow=always', '-c', 'init.defaultBranch=master']
+        sub_urls = [make_repo(self.tmp, name) for name in ('subA', 'subB')]
+        src = os.path.join(self.tmp, 'edk2.src')
+        for f in ('MdePkg/MdePkg.dec', 'MdeModulePkg/MdeModulePkg.dec', 'BaseTools/Makefile', 'README'):
+            os.makedirs(os.path.dirname(os.path.join(src, f)) or src, exist_ok=True)
+            with open(os.path.join(src, f), 'w') as fout:
+                fout.write(f)
+        subprocess.check_call(git + ['init', '-q', src])
+        subprocess.check_call(git + ['add', '-A'], cwd=src)
+        subprocess.check_call(git + ['submodule', '-q', 'add', sub_urls[0], 'MdePkg/subA'], cwd=src)
+        subprocess.check_call(git + ['submodule', '-q', 'add', sub_urls[1], 'MdeModulePkg/subB'], cwd=src)
+        subprocess.check_call(git + ['commit', '-q', '-m', 'init'], cwd=src)
+        subprocess.check_call(git + ['tag', 'v1'], cwd=src)
+        subprocess.check_call(git + ['config', 'uploadpack.allowFilter', 'true'], cwd=src)
+        edk2 = os.path.join(self.tmp, 'ws', 'edk2')
+        codetree = {'edk2': {'source': {'url': 'file://' + src, 'signature': 'v1'}, 'path': edk2, 'recursive': True,
+                             'git.filter': 'blobless', 'git.sparse': ['BaseTools'], 'git.submodule.jobs': 2}}
+        environ, component = dict(os.environ), ipug.config.COMPONENT
+        os.environ.update(GIT_CONFIG_COUNT='1', GIT_CONFIG_KEY_0='protocol.file.allow', GIT_CONFIG_VALUE_0='always')
+        try:
+            ipug.config.COMPONENT = [{'path': 'Pkg/A.inf', 'Packages': ['MdePkg/MdePkg.dec']}]
+            self.assertEqual(ipug.codetree_sparse(codetree['edk2']), ['BaseTools', 'MdePkg', 'Pkg'])
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            present = lambda f: os.path.exists(os.path.join(edk2, f))
+            self.assertEqual([present(f) for f in ('README', 'BaseTools/Makefile', 'MdePkg/MdePkg.dec', 'MdePkg/subA/README', 'MdeModulePkg')],
+                             [True, True, True, True, False])
+            self.assertEqual(subprocess.check_output(['git', 'config', 'remote.origin.partialclonefilter'], cwd=edk2).decode().strip(), 'blob:none')
+            # a change of the sparse folders is a change of the tree.
+            codetree['edk2']['git.sparse'] = ['BaseTools', 'MdeModulePkg']
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            self.assertTrue(present('MdeModulePkg/subB/README'))
+            del codetree['edk2']['git.sparse']
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            self.assertFalse(ipug.is_sparse_checkout(edk2))
+            # the submodules outside the sparse folders are initialized once the sparse checkout is disabled.
+            codetree = {'edk2': {'source': {'url': 'file://' + src, 'signature': 'v1'}, 'path': edk2 + '-b', 'recursive': True, 'git.sparse': ['BaseTools']}}
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            self.assertEqual(subprocess.check_output(['git', 'config', 'core.sparseCheckoutCone'], cwd=edk2 + '-b').decode().strip(), 'true')
+            self.assertFalse(os.path.exists(os.path.join(edk2 + '-b', 'MdeModulePkg', 'subB', 'README')))
+            del codetree['edk2']['git.sparse']
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            self.assertTrue(os.path.exists(os.path.join(edk2 + '-b', 'MdeModulePkg', 'subB', 'README')))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            ipug.config.COMPONENT = component
+
+    def test_prefetch_mirror(self):
+        """the code tree is cloned with the local mirrors of itself and its submodules."""
+        sub_url = make_repo(self.tmp, 'sub')
+        src = os.path.join(self.tmp, 'edk2.src')
+        git = ['git', '-c', 'user.name=pug', '-c', 'user.email=pug@localhost', '-c', 'protocol.file.allow=always']
+        subprocess.check_call(git + ['init', '-q', src])
+        subprocess.check_call(git + ['submodule', '-q', 'add', sub_url, 'sub'], cwd=src)
+        subprocess.check_call(git + ['commit', '-q', '-m', 'init'], cwd=src)
+        subprocess.check_call(git + ['tag', 'edk2-stable'], cwd=src)
+        codetree = {'edk2': {
+            'source': {'url': 'file://' + src, 'signature': 'edk2-stable'},
+            'path': os.path.join(self.tmp, 'ws', 'edk2'),
+            'recursive': True,
+        }}
+        cache_dir = ipug.config.DEFAULT_PUG_CACHE_DIR
+        ipug.config.DEFAULT_PUG_CACHE_DIR = os.path.join(self.tmp, 'cache')
+        try:
+            self.assertEqual(ipug.prefetch(codetree, ['edk2-stable']), 0)
+            self.assertNotEqual(ipug.prefetch(codetree, ['no-such-tag']), 0)
+            self.assertTrue(os.path.exists(os.path.join(ipug.mirror_path(sub_url), 'HEAD')))
+            # the upstream of the submodule is gone: it must come from the mirror.
+            shutil.rmtree(sub_url[len('file://'):])
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+        finally:
+            ipug.config.DEFAULT_PUG_CACHE_DIR = cache_dir
+        edk2 = codetree['edk2']['path']
+        # dissociated from the mirror: the clone has its own objects.
+        self.assertFalse(os.path.exists(os.path.join(edk2, '.git', 'objects', 'info', 'alternates')))
+        self.assertTrue(os.path.exists(os.path.join(edk2, 'sub', 'README')))
+        self.assertEqual(ipug.prefetch_signatures(['edk2-stable', 'v1']), ['edk2-stable', 'v1'])
+        self.assertIsNone(ipug.prefetch_signatures(['-a', 'X64']))
+        self.assertIsNone(ipug.prefetch_signatures(['TARGET=RELEASE']))
+
+    def test_setup_codetree_current(self):
+        """an already-synced tree skips the git sequence, a new tag fetches only that tag."""
+        url = make_repo(self.tmp, 'edk2')
+        codetree = {'edk2': {'source': {'url': url, 'signature': 'v1'}, 'path': os.path.join(self.tmp, 'ws', 'edk2')}}
+        self.assertEqual(ipug.setup_codetree(codetree), 0)
+        commands = []
+        run0 = ipug.run
+
+        def run(Command, WorkingDir='.', verbose=False):
+            commands.append(' '.join(Command) if isinstance(Command, (list, tuple)) else Command)
+            return run0(Command, WorkingDir, verbose)
+        ipug.run = run
+        try:
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+            self.assertFalse([c for c in commands if ' fetch ' in c or ' checkout ' in c])
+            src = os.path.join(self.tmp, 'edk2.src')
+            git = ['git', '-c', 'user.name=pug', '-c', 'user.email=pug@localhost']
+            subprocess.check_call(git + ['commit', '-q', '--allow-empty', '-m', 'v2'], cwd=src)
+            subprocess.check_call(git + ['tag', 'v2'], cwd=src)
+            subprocess.check_call(git + ['push', '-q', url, 'v2'], cwd=src)
+            codetree['edk2']['source']['signature'] = 'v2'
+            self.assertEqual(ipug.setup_codetree(codetree), 0)
+        finally:
+            ipug.run = run0
+        self.assertTrue([c for c in commands if ' fetch ' in c and c.endswith('origin v2')])
+        self.assertEqual(ipug.git_rev(codetree['edk2']['path'], 'HEAD'), ipug.git_rev(codetree['edk2']['path'], 'v2'))
+        self.assertTrue(ipug.is_codetree_current(codetree['edk2']))
+
+    def test_basetools_cache(self):
+        """identical BaseTools sources are built once, and then restored from the cache."""
+        tools = os.path.join(self.tmp, 'BaseTools')
+        os.makedirs(os.path.join(tools, 'Source', 'C'))
+        with open(os.path.join(tools, 'Source', 'C', 'Tool.c'), 'w') as fout:
+            fout.write('int main(void) { return 0; }\n')
+        with open(os.path.join(tools, 'GNUmakefile'), 'w') as fout:
+            fout.write('all:\n\tmkdir -p Source/C/bin && echo tool > Source/C/bin/Tool && echo x >> ../make.count\n')
+        environ, cache_dir = dict(os.environ), ipug.config.DEFAULT_PUG_CACHE_DIR
+        os.environ['EDK_TOOLS_PATH'] = tools
+        ipug.config.DEFAULT_PUG_CACHE_DIR = os.path.join(self.tmp, 'cache')
+        try:
+            for _ in range(3):
+                self.assertEqual(ipug.build_basetools(['build', '', set()]), 0)
+                shutil.rmtree(os.path.join(tools, 'Source', 'C', 'bin'))
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            ipug.config.DEFAULT_PUG_CACHE_DIR = cache_dir
+        with open(os.path.join(self.tmp, 'make.count')) as fin:
+            self.assertEqual(len(fin.readlines()), 1)
+
+    def test_generated_manifest(self):
+        """only the components whose inputs changed are regenerated, the others keep their mtime."""
+        components = [{
+            'path': 'Drv%d/Drv%d.inf' % (i, i),
+            'update': True,
+            'Defines': {'BASE_NAME': 'Drv%d' % i, 'MODULE_TYPE': 'UEFI_DRIVER'},
+            'Sources': ['Drv%d.c' % i],
+        } for i in range(3)]
+        manifest = {}
+        ipug.component_inf(components, self.tmp, manifest)
+        paths = [os.path.join(self.tmp, c['path']) for c in components]
+        mtimes = [os.stat(p).st_mtime_ns for p in paths]
+        self.assertTrue(all(ipug.is_generated_current(manifest, p, ipug.fingerprint(c)) for p, c in zip(paths, components)))
+        components[1]['Sources'] += ['Extra.c']
+        with open(paths[2], 'a') as fout:
+            fout.write('# local edit\n')
+        ipug.component_inf(components, self.tmp, manifest)
+        self.assertEqual(os.stat(paths[0]).st_mtime_ns, mtimes[0])
+        with open(paths[1]) as fin:
+            self.assertIn('Extra.c', fin.read())
+        with open(paths[2]) as fin:
+            self.assertNotIn('local edit', fin.read())
+
+    def test_run_bounded_output(self):
+        """run() keeps only the tail in memory, spills the whole output to a log and reports each line."""
+        lines = []
+        pug_path, tail = ipug.config.WORKSPACE['pug_path'], ipug.config.DEFAULT_RUN_TAIL_LINES
+        ipug.config.WORKSPACE['pug_path'] = self.tmp
+        ipug.config.DEFAULT_RUN_TAIL_LINES = 100
+        try:
+            r = ipug.run([sys.executable, '-c', '"import sys; [print(i) for i in range(500)]; print(-1, file=sys.stderr)"'], self.tmp,
+                         verbose=False, on_line=lambda stream, line: lines.append((stream, line)))
+        finally:
+            ipug.config.WORKSPACE['pug_path'], ipug.config.DEFAULT_RUN_TAIL_LINES = pug_path, tail
+        self.assertEqual(r[0], 0)
+        self.assertEqual(r[1], [str(i) for i in range(400, 500)])
+        self.assertEqual(r[2][0], '-1')
+        self.assertEqual(len(lines), 501)
+        self.assertIn(('stderr', '-1'), lines)
+        log_path = r[2][-1].split(': ', 1)[1].rstrip(']')
+        with open(log_path) as fin:
+            self.assertEqual(len(fin.readlines()), 501)
+
+    def test_run_many(self):
+        """concurrent commands get their own cwd and env, a failure cancels the group with fail_fast."""
+        os.makedirs(os.path.join(self.tmp, 'a'))
+        os.makedirs(os.path.join(self.tmp, 'b'))
+        cwd = os.getcwd()
+        tasks = [{
+            'Command': [sys.executable, '-c', '"import os; print(os.getcwd(), os.environ[\'PUG_TASK\'])"'],
+            'WorkingDir': os.path.join(self.tmp, d),
+            'env': dict(os.environ, PUG_TASK=d),
+        } for d in ('a', 'b')]
+        results = ipug.run_many(tasks, jobs=2)
+        self.assertEqual([r[1] for r in results], [['%s %s' % (os.path.join(self.tmp, d), d)] for d in ('a', 'b')])
+        self.assertEqual(os.getcwd(), cwd)
+        self.assertNotIn('PUG_TASK', os.environ)
+
+        pid_file = os.path.join(self.tmp, 'sleep.pid')
+        tasks = [
+            {'Command': 'sleep 30 & echo $! > %s; wait' % pid_file, 'WorkingDir': self.tmp},
+            {'Command': 'sleep 0.5; exit 3', 'WorkingDir': self.tmp},
+        ]
+        results = ipug.run_many(tasks, fail_fast=True)
+        self.assertEqual(results[0], None)
+        self.assertEqual(results[1][0], 3)
+        with open(pid_file) as fin:
+            pid = int(fin.read())
+        try:
+            with open('/proc/%d/stat' % pid) as fin:
+                self.assertEqual(fin.read().split()[2], 'Z')
+        except IOError:
+            pass
+
+        # a line longer than the stream limit is fed in pieces, and nothing is lost.
+        lines = []
+        r = ipug.run_many([{'Command': [sys.executable, '-c', '"print(\'x\' * 3000000); print(\'tail\')"'], 'WorkingDir': self.tmp,
+                            'on_line': lambda stream, line: lines.append(line)}])[0]
+        self.assertEqual(r[0], 0)
+        self.assertEqual(sum(len(l) for l in lines[:-1]), 3000000)
+        self.assertEqual(lines[-1], 'tail')
+
+    def test_build_matrix(self):
+        """each TARGET x TOOL_CHAIN_TAG combination is built with its own Conf folder, for all the arches."""
+        conf = os.path.join(self.tmp, 'Conf')
+        os.makedirs(conf)
+        for f in ('build_rule.txt', 'tools_def.txt'):
+            with open(os.path.join(conf, f), 'w') as fout:
+                fout.write(f)
+        saved = dict(os.environ), list(sys.argv), ipug.config.DEFAULT_BUILD_COMMAND, dict(ipug.config.WORKSPACE)
+        os.environ['WORKSPACE'] = self.tmp
+        sys.argv[1:] = ['-n', '4']
+        ipug.config.WORKSPACE['conf_path'] = conf
+        ipug.config.DEFAULT_BUILD_COMMAND = 'grep -h TARGET "$CONF_PATH/target.txt" > "$CONF_PATH/built.txt"; echo'
+        try:
+            matrix = {'TARGET': ['RELEASE', 'DEBUG'], 'TARGET_ARCH': ['IA32', 'X64'], 'TOOL_CHAIN_TAG': ['GCC5']}
+            self.assertEqual(ipug.build_matrix(['build', '', set()], matrix), 0)
+        finally:
+            os.environ.clear()
+            os.environ.update(saved[0])
+            sys.argv[:], ipug.config.DEFAULT_BUILD_COMMAND = saved[1], saved[2]
+            ipug.config.WORKSPACE.update(saved[3])
+        # the arches of a TARGET and a TOOL_CHAIN_TAG, sharing an output folder, are built at once.
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'Conf.DEBUG_X64_GCC5')))
+        with open(os.path.join(self.tmp, 'Conf.DEBUG_IA32-X64_GCC5', 'built.txt')) as fin:
+            self.assertEqual(fin.read().split(), ['TARGET', '=', 'DEBUG', 'TARGET_ARCH', '=', 'IA32', 'X64'])
+
+    @unittest.skipIf(os.name == 'nt', 'the make jobserver is Posix only')
+    def test_jobserver(self):
+        """the child make shares pug's token pool."""
+        from ipug.jobserver import JobServer
+        with open(os.path.join(self.tmp, 'Makefile'), 'w') as fout:
+            fout.write('all: t1 t2 t3 t4\nt%:\n\t@echo start >> log; sleep 0.3; echo end >> log\n')
+        js = JobServer(2, makeflags='')
+        environ = dict(os.environ)
+        ipug.jobserver, os.environ['MAKEFLAGS'] = js, js.makeflags()
+        try:
+            self.assertEqual(js.acquire(1), 1)
+            r = ipug.run('make', self.tmp, verbose=False)
+            js.release(1)
+            self.assertEqual(js.acquire(5), 2)
+            js.release(2)
+        finally:
+            ipug.jobserver = None
+            os.environ.clear()
+            os.environ.update(environ)
+            js.close()
+        self.assertEqual(r[0], 0)
+        self.assertFalse([l for l in r[2] if 'jobserver' in l])
+        running = peak = 0
+        with open(os.path.join(self.tmp, 'log')) as fin:
+            for l in fin:
+                running += 1 if l.strip() == 'start' else -1
+                peak = max(peak, running)
+        self.assertEqual(peak, 2)
+
+    def test_trace(self):
+        """the phases and the commands are exported as a Chrome trace and a JSON summary."""
+        from ipug import trace
+        codetree = {'edk2': {'source': {'url': make_repo(self.tmp, 'edk2'), 'signature': 'v1'}, 'path': os.path.join(self.tmp, 'ws', 'edk2')}}
+        trace.enable()
+        try:
+            with trace.phase('setup_codetree') as ev:
+                ev['rc'] = ipug.setup_codetree(codetree)
+            ipug.run('exit 3', self.tmp, verbose=False)
+            summary_path = trace.export(os.path.join(self.tmp, 'trace.json'))
+        finally:
+            trace.enabled = False
+        with open(os.path.join(self.tmp, 'trace.json')) as fin:
+            events = json.load(fin)['traceEvents']
+        self.assertTrue([e for e in events if e['name'] == 'setup_codetree:edk2' and e['ph'] == 'X'])
+        with open(summary_path) as fin:
+            summary = json.load(fin)
+        self.assertIn('setup_codetree', summary['by_phase'])
+        self.assertTrue([r for r in summary['runs'] if r['command'].startswith('git clone') and 'utime' in r])
+        self.assertEqual(summary['runs'][-1]['rc'], 3)
+
+    def test_build_report(self):
+        """the EDK2 build output is attributed to the phases and the modules."""
+        from ipug.buildreport import BuildAnalyzer
+        clock = [0.0]
+        analyzer = BuildAnalyzer(clock=lambda: clock[0])
+        output = [
+            (1, 'Processing meta-data .... done!'),
+            (5, 'Building ... /ws/MdePkg/Library/BaseLib/BaseLib.inf [X64]'),
+            (6, 'Building ... /ws/Pkg/Slow/Slow.inf [X64]'),
+            (7, '"gcc" -c -o /ws/Build/P/RELEASE_GCC5/X64/MdePkg/Library/BaseLib/BaseLib/OUTPUT/a.obj a.c'),
+            (20, '"gcc" -c -o /ws/Build/P/RELEASE_GCC5/X64/Pkg/Slow/Slow/OUTPUT/b.obj b.c'),
+            (30, 'GenFds -f /ws/Pkg/P.fdf'),
+            (32, '- Done -'),
+        ]
+        for t, line in output:
+            clock[0] = t
+            analyzer.feed('stdout', line)
+        analyzer.finish()
+        msg = analyzer.write_report(os.path.join(self.tmp, 'report.txt'))
+        with open(os.path.join(self.tmp, 'report.json')) as fin:
+            rpt = json.load(fin)
+        self.assertEqual(rpt['phases'], {'init': 1, 'AutoGen': 4, 'make': 25, 'GenFds': 2, 'done': 0})
+        self.assertEqual([(m['inf'], m['seconds']) for m in rpt['modules']], [('/ws/Pkg/Slow/Slow.inf', 14), ('/ws/MdePkg/Library/BaseLib/BaseLib.inf', 2)])
+        self.assertIn('The slowest modules:', msg)
+
+    @unittest.skipIf(os.name == 'nt', 'the wrapper scripts are posix shell scripts')
+    def test_compiler_cache(self):
+        """route tools_def.txt's compilers through a fake compiler cache."""
+        from ipug import compilercache
+        fake = os.path.join(self.tmp, 'fakecache')
+        with open(fake, 'w') as fout:
+            fout.write('#!/bin/sh\nif [ "$1" = "--print-stats" ]; then printf "direct_cache_hit\\t3\\npreprocessed_cache_hit\\t1\\ncache_miss\\t2\\n"; exit 0; fi\necho "$#" "$@"\n')
+        os.chmod(fake, 0o755)
+        self.assertEqual(compilercache.find_wrapper(fake), fake)
+        self.assertEqual(compilercache.find_wrapper(''), '')
+        tools_def = os.path.join(self.tmp, 'tools_def.txt')
+        with open(tools_def, 'w') as fout:
+            fout.write('DEFINE GCC5_BIN = /usr/bin/\n'
+                       '*_GCC5_X64_CC_PATH = DEF(GCC5_BIN)gcc\n'
+                       '*_GCC5_X64_DLINK_PATH = ENV(PUG_TEST_PREFIX)ld -m elf_x86_64\n'
+                       '*_GCC5_X64_OBJCOPY_PATH = DEF(GCC5_BIN)objcopy\n'
+                       '*_CLANG38_X64_CC_PATH = clang\n')
+        wrap_dir = os.path.join(self.tmp, 'ccache-bin')
+        self.assertEqual(compilercache.wrap_tools_def(tools_def, {'GCC5'}, fake, wrap_dir), 2)
+        self.assertEqual(compilercache.wrap_tools_def(tools_def, {'GCC5'}, fake, wrap_dir), 0)
+        with open(tools_def) as fin:
+            lines = fin.read().split('\n')
+        cc = lines[1].split('=', 1)[1].strip()
+        self.assertTrue(cc.startswith(wrap_dir))
+        self.assertIn('objcopy', lines[3])
+        self.assertIn('= clang', lines[4])
+        out = subprocess.run([cc, '-c', 'x.c'], stdout=subprocess.PIPE, check=True).stdout.decode()
+        self.assertEqual(out.strip(), '3 /usr/bin/gcc -c x.c')
+        # the ENV() macros are resolved as the wrapper runs, and the tool's arguments are kept apart.
+        dlink = lines[2].split('=', 1)[1].strip()
+        for prefix in ('/opt/a/', '/opt/b/'):
+            out = subprocess.run([dlink, 'x.o'], stdout=subprocess.PIPE, check=True, env=dict(os.environ, PUG_TEST_PREFIX=prefix)).stdout.decode()
+            self.assertEqual(out.strip(), '4 %sld -m elf_x86_64 x.o' % prefix)
+        s = compilercache.stats(fake)
+        self.assertEqual(compilercache.stats_delta({}, s), (3, 1, 2))
+        self.assertEqual(compilercache.stats(os.path.join(self.tmp, 'missing')), {})
+
+    def test_watch(self):
+        """the watchers see the changes of the folders and the files, but not the excluded folders."""
+        from ipug import watch
+        src = os.path.join(self.tmp, 'src')
+        build_dir = os.path.join(src, 'Build')
+        os.makedirs(os.path.join(src, 'Sub'))
+        os.makedirs(build_dir)
+        project_py = os.path.join(self.tmp, 'project.py')
+        other_py = os.path.join(self.tmp, 'other.py')
+        for p in [project_py, other_py]:
+            with open(p, 'w') as fout:
+                fout.write('#\n')
+        for poll in [0.05, 0]:
+            w = watch.watcher([src], [project_py], [build_dir], poll)
+            try:
+                self.assertEqual(w.changes(0.1), set())
+                time.sleep(0.02)
+                for p in [os.path.join(src, 'Sub', 'a.c'), os.path.join(build_dir, 'a.obj'), other_py, os.path.join(src, 'a.c~')]:
+                    with open(p, 'w') as fout:
+                        fout.write('x')
+                changed, _ = watch.collect(w, 0.2, timeout=5)
+                self.assertEqual(changed, {os.path.join(src, 'Sub', 'a.c')})
+                # a new folder, and the file replaced by a rename.
+                os.makedirs(os.path.join(src, 'New'))
+                with open(os.path.join(src, 'New', 'b.c'), 'w') as fout:
+                    fout.write('y')
+                with open(project_py + '.new', 'w') as fout:
+                    fout.write('#\n#\n')
+                os.replace(project_py + '.new', project_py)
+                changed, _ = watch.collect(w, 0.2, timeout=5)
+                self.assertIn(project_py, changed)
+                self.assertIn(os.path.join(src, 'New', 'b.c'), changed)
+            finally:
+                w.close()
+                shutil.rmtree(os.path.join(src, 'New'))
+
+    def test_impact_index(self):
+        """the changed files are mapped to the affected modules, and the index updates incrementally."""
+        from ipug.impact import ImpactIndex
+        ws = self.tmp
+        bin_dir = os.path.join(ws, 'Build', 'P', 'RELEASE_GCC5', 'X64')
+        files = {
+            'P.dsc': '[Components]\n  Pkg/Drv/Drv.inf {\n    <LibraryClasses>\n      L|Pkg/Lib/Lib.inf\n  }\n',
+            'Pkg/Drv/Drv.inf': '[Defines]\n  BASE_NAME = Drv\n[Sources]\n  Drv.c\n  Drv.h | GCC\n',
+            'Pkg/Lib/Lib.inf': '[Defines]\n  LIBRARY_CLASS = L\n[Sources.X64]\n  Lib.c # comment\n',
+            'Pkg/Inc/X.h': '',
+            'Build/P/RELEASE_GCC5/X64/Pkg/Drv/Drv/GNUmakefile': (
+                'BUILD_DIR = %s\nBIN_DIR = $(BUILD_DIR)/X64\nMODULE_FILE = Drv.inf\nMODULE_DIR = %s/Pkg/Drv\n'
+                'MODULE_BUILD_DIR = $(BIN_DIR)/Pkg/Drv/Drv\nSTATIC_LIBRARY_FILES =  \\\n    $(BIN_DIR)/Pkg/Lib/Lib/OUTPUT/Lib.lib \\\n\n'
+                'all: x\n' % (os.path.dirname(bin_dir), ws)),
+            'Build/P/RELEASE_GCC5/X64/Pkg/Lib/Lib/GNUmakefile': 'MODULE_FILE = Lib.inf\nMODULE_DIR = %s/Pkg/Lib\nMODULE_BUILD_DIR = %s/Pkg/Lib/Lib\n' % (ws, bin_dir),
+            'Build/P/RELEASE_GCC5/X64/Pkg/Drv/Drv/OUTPUT/Drv.obj.deps': '%s/Pkg/Drv/Drv.obj: %s/Pkg/Drv/Drv.c \\\n  %s/Pkg/Inc/X.h\n%s/Pkg/Inc/X.h:\n' % (bin_dir, ws, ws, ws),
+        }
+        for f, content in files.items():
+            f = os.path.join(ws, f)
+            if not os.path.exists(os.path.dirname(f)):
+                os.makedirs(os.path.dirname(f))
+            with open(f, 'w') as fout:
+                fout.write(content)
+        drv, lib = os.path.join(ws, 'Pkg', 'Drv', 'Drv.inf'), os.path.join(ws, 'Pkg', 'Lib', 'Lib.inf')
+        comp = [{'path': os.path.join(ws, 'Pkg', 'New', 'New.inf'), 'Sources': ['New.c', ('New.h', '')]}]
+
+        def index():
+            idx = ImpactIndex(os.path.join(ws, 'Build', 'pug', 'impact.json'))
+            idx.update(os.path.join(ws, 'P.dsc'), [ws], [os.path.join(ws, 'Build')], comp)
+            idx.save()
+            return idx
+        idx = index()
+        self.assertEqual(idx.platform, [drv])
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'Inc', 'X.h')]), ({drv}, set()))
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'Drv', 'Drv.h')]), ({drv}, set()))
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'Lib', 'Lib.c')]), ({lib, drv}, set()))
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'New', 'New.h')]), ({comp[0]['path']}, set()))
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'Pkg.dec'), os.path.join(ws, 'README.md')]), (set(), {os.path.join(ws, 'Pkg', 'Pkg.dec')}))
+        self.assertTrue(idx.is_library(lib))
+        self.assertEqual(idx.consumers(), {lib: {drv}})
+        # nothing is re-parsed, then only the changed input.
+        self.assertEqual(index().parsed, 0)
+        time.sleep(0.01)
+        with open(os.path.join(ws, 'Pkg', 'Drv', 'Drv.inf'), 'a') as fout:
+            fout.write('  Other.c\n')
+        idx = index()
+        self.assertEqual(idx.parsed, 1)
+        self.assertEqual(idx.affected([os.path.join(ws, 'Pkg', 'Drv', 'Other.c')]), ({drv}, set()))
+
+    def test_lazy_config(self):
+        """the CLI starts without the config, and the evaluated project.py is cached on request."""
+        env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.dirname(os.path.abspath(__file__))), PUG_CONFIG_CACHE='1', PUG_CACHE_DIR=os.path.join(self.tmp, 'cache'))
+        project_py = os.path.join(self.tmp, 'project.py')
+        marker = os.path.join(self.tmp, 'evaluated')
+        with open(project_py, 'w') as fout:
+            fout.write('open(%r, "a").write("x")\nDEFAULT_BUILD_TARGET = "DEBUG"\nCOMPONENT = [{"path": "A/A.inf"}]\n' % marker)
+        probe = ('import sys, time\nt = time.time()\nimport ipug.cli\nt = time.time() - t\n'
+                 'print(t, "ipug.config" in sys.modules, "project" in sys.modules)\n'
+                 'from ipug import config\nprint(config.WORKSPACE["target"], config.COMPONENT[0]["path"])\n')
+
+        def probe_run():
+            out = subprocess.run([sys.executable, '-c', probe], cwd=self.tmp, env=env, stdout=subprocess.PIPE, check=True).stdout.decode().split()
+            with open(marker) as fin:
+                return out, len(fin.read())
+        out, evaluated = probe_run()
+        # the import-time budget of the CLI.
+        self.assertLess(float(out[0]), 0.5)
+        self.assertEqual(out[1:], ['False', 'False', 'DEBUG', 'A/A.inf'])
+        self.assertEqual(evaluated, 1)
+        # restored from the cache, then re-evaluated after project.py changes.
+        out, evaluated = probe_run()
+        self.assertEqual((out[1:], evaluated), (['False', 'False', 'DEBUG', 'A/A.inf'], 1))
+        with open(project_py, 'a') as fout:
+            fout.write('DEFAULT_BUILD_TARGET = "NOOPT"\n')
+        out, evaluated = probe_run()
+        self.assertEqual((out[1:], evaluated), (['False', 'False', 'NOOPT', 'A/A.inf'], 2))
+
+    def test_benchmark_orchestration(self):
+        """the orchestration benchmark runs setup and build end to end with the fake tool chain."""
+        report_path = os.path.join(self.tmp, 'report.json')
+        bench = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'benchmarks', 'bench_orchestration.py')
+        subprocess.run([sys.executable, bench, '--components', '3', '--codetrees', '1', '--build-lines', '100', '--repeat', '1',
+                        '--make-latency', '0', '--build-latency', '0', '--json', report_path], stdout=subprocess.PIPE, check=True)
+        with open(report_path) as fin:
+            results = json.load(fin)['results']
+        self.assertEqual(sorted(results), ['build', 'setup-cold', 'setup-warm'])
+        self.assertEqual({r['rc'] for r in results.values()}, {0})
+        self.assertIn('component_inf', results['setup-cold']['phases'])
+        self.assertEqual(results['build']['throughput']['lines'], 100)
+        self.assertGreater(results['build']['maxrss_kb'], 0)
+
+    def test_emitter(self):
+        """a generated file is replaced atomically, left untouched when identical, and kept on a failure."""
+        from ipug.emitter import Emitter
+        path = os.path.join(self.tmp, 'Pkg', 'X.dsc')
+        with Emitter(path, '# sig\n') as out:
+            out.section({'B': 2, 'A': 1}, section='Defines')
+            out.lines(['  x.inf'])
+        with open(path) as fin:
+            self.assertEqual(fin.read(), '# sig\n\n[Defines]\n  A = 1\n  B = 2\n  x.inf\n')
+        self.assertEqual(ipug.write_file(path, ['', '[Defines]', '  A = 1', '  B = 2', '  x.inf'], '# sig\n'), out.digest)
+        mtime = os.stat(path).st_mtime_ns
+        with Emitter(path, '# sig\n') as again:
+            again.section({'A': 1, 'B': 2}, section='Defines')
+            again.line('  x.inf')
+        self.assertFalse(again.changed)
+        self.assertEqual(os.stat(path).st_mtime_ns, mtime)
+        with self.assertRaises(ValueError):
+            with Emitter(path) as out:
+                out.line('partial')
+                raise ValueError('a failure')
+        with open(path) as fin:
+            self.assertTrue(fin.read().startswith('# sig'))
+        self.assertEqual(os.listdir(os.path.dirname(path)), ['X.dsc'])
+
+    def test_component_inf_parallel(self):
+        """the pooled INF generation matches the serial one, and every component without [Defines] is reported at once."""
+        comps = [{
+            'path': 'Pkg/C%d/C%d.inf' % (i, i), 'update': True,
+            'Defines': {'BASE_NAME': 'C%d' % i, 'MODULE_TYPE': 'UEFI_DRIVER'},
+            'Sources': ['C%d.c' % i], 'LibraryClasses': [['NULL', 'x.inf'], ['UefiLib', 'y.inf']],
+        } for i in range(ipug.inf_pool_min * 2)]
+        results = []
+        for jobs, pool in ((1, 'process'), (4, 'process'), (4, 'thread')):
+            ws = os.path.join(self.tmp, '%s%d' % (pool, jobs))
+            manifest = {}
+            ipug.component_inf(comps, ws, manifest, jobs, pool)
+            with open(os.path.join(ws, 'Pkg', 'C7', 'C7.inf')) as fin:
+                text = fin.read()
+            results.append((text, sorted(e['digest'] for e in manifest.values())))
+            self.assertEqual(len(manifest), len(comps))
+            self.assertNotIn('NULL', text)
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0], results[2])
+        broken = [dict(c) for c in comps]
+        for i in (3, 40):
+            broken[i].pop('Defines')
+        ws = os.path.join(self.tmp, 'broken')
+        with self.assertRaises(Exception) as cm:
+            ipug.component_inf(broken, ws, {}, 4, 'thread')
+        self.assertIn('C3.inf, ', str(cm.exception))
+        self.assertIn('C40.inf', str(cm.exception))
+        self.assertFalse(os.path.exists(ws))
+
+    def test_conf_files(self):
+        """the Conf files are copied only on a change, keep the templates' mtimes, and take the overrides once."""
+        tools = os.path.join(self.tmp, 'BaseTools')
+        os.makedirs(os.path.join(tools, 'Conf'))
+        for f in ('build_rule', 'tools_def'):
+            with open(os.path.join(tools, 'Conf', '%s.template' % f), 'w') as fout:
+                fout.write('%s\n' % f)
+        conf = os.path.join(self.tmp, 'Conf')
+        environ, mode = dict(os.environ), ipug.config.DEFAULT_CONF_COPY
+        os.environ['EDK_TOOLS_PATH'], os.environ['WORKSPACE'] = tools, self.tmp
+        applied = []
+
+        def override(path):
+            applied.append(path)
+            with open(path, 'a') as fout:
+                fout.write('overridden\n')
+
+        def setup(key='k1', mode='auto'):
+            ipug.config.DEFAULT_CONF_COPY = mode
+            ipug.conf_files(['build_rule', 'tools_def'], conf, ['setup'], manifest=manifest, overrides={'tools_def': (key, override)})
+            return {f: os.stat(os.path.join(conf, '%s.txt' % f)) for f in ('build_rule', 'tools_def')}
+
+        try:
+            manifest = {}
+            st1 = setup()
+            self.assertEqual(st1['build_rule'].st_mtime_ns, os.stat(os.path.join(tools, 'Conf', 'build_rule.template')).st_mtime_ns)
+            st2 = setup()
+            self.assertEqual(len(applied), 1)
+            self.assertEqual([st2[f].st_ino for f in st2], [st1[f].st_ino for f in st1])
+            st3 = setup('k2')
+            self.assertEqual(len(applied), 2)
+            self.assertEqual(st3['build_rule'].st_ino, st1['build_rule'].st_ino)
+            with open(os.path.join(conf, 'tools_def.txt')) as fin:
+                self.assertEqual(fin.read(), 'tools_def\noverridden\n')
+            with open(os.path.join(tools, 'Conf', 'build_rule.template'), 'a') as fout:
+                fout.write('changed\n')
+            manifest = {}
+            st4 = setup('k2', 'hardlink')
+            self.assertEqual(st4['build_rule'].st_ino, os.stat(os.path.join(tools, 'Conf', 'build_rule.template')).st_ino)
+            self.assertNotEqual(st4['tools_def'].st_ino, os.stat(os.path.join(tools, 'Conf', 'tools_def.template')).st_ino)
+            with open(os.path.join(tools, 'Conf', 'tools_def.template')) as fin:
+                self.assertEqual(fin.read(), 'tools_def\n')
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            ipug.config.DEFAULT_CONF_COPY = mode
+
+    def test_farm(self):
+        """the farm's jobs are balanced over the workers on localhost, longest first, and survive a lost worker."""
+        from ipug import farm
+
+        def fake(job, on_line, cancel=None):
+            os.makedirs(os.path.join(job['workspace'], 'Build', 'OUT'), exist_ok=True)
+            with open(os.path.join(job['workspace'], 'Build', 'OUT', 'X.efi'), 'w') as fout:
+                fout.write(job['env']['N'])
+            on_line('building %s' % job['env']['N'])
+            time.sleep(0.05)
+            return int(job['env']['N']) % 3 == 2
+
+        def lost():
+            # a worker that says hello, then drops its first job.
+            conn, _ = dropper.accept()
+            msgs = farm.messages(conn)
+            next(msgs)
+            farm.send(conn, threading.Lock(), {'op': 'hello', 'name': 'lost', 'slots': 1})
+            next(msgs)
+            conn.close()
+
+        workers = [farm.Worker(slots=2, token='t', workspaces=[self.tmp], run_job=fake), farm.Worker(slots=1, token='t', workspaces=[self.tmp], run_job=fake)]
+        for w in workers:
+            threading.Thread(target=w.serve_forever, daemon=True).start()
+        dropper = socket.socket()
+        dropper.bind(('127.0.0.1', 0))
+        dropper.listen(1)
+        dropped = dropper.getsockname()
+        threading.Thread(target=lost, daemon=True).start()
+        jobs = [{'workspace': os.path.join(self.tmp, 'ws%d' % i), 'argv': ['build'], 'env': {'N': str(i)}} for i in range(6)]
+        history = os.path.join(self.tmp, 'history.json')
+        with open(history, 'w') as fout:
+            json.dump({farm.job_key(jobs[4]): 100.0, farm.job_key(jobs[0]): 1.0}, fout)
+        lines, notes = [], []
+        try:
+            coordinator = farm.Coordinator([dropped] + [w.address for w in workers], history, 't',
+                                           on_line=lambda job, line: lines.append((job['id'], line)), notify=notes.append)
+            results = coordinator.run(jobs)
+        finally:
+            for w in workers:
+                w.close()
+            dropper.close()
+        self.assertEqual([r['rc'] for r in results], [0, 0, 1, 0, 0, 1])
+        self.assertEqual(sorted(lines), [(i, 'building %d' % i) for i in range(6)])
+        self.assertEqual([len(r['artifacts']) for r in results], [1, 1, 0, 1, 1, 0])
+        self.assertEqual(results[1]['artifacts'][0]['path'], os.path.join('Build', 'OUT', 'X.efi'))
+        # the known short job goes last: the new jobs are expected to be as long as the longest known one.
+        dispatched = [int(n.split()[1]) for n in notes if n.startswith('job ')]
+        self.assertNotIn(0, dispatched[:4])
+        self.assertEqual(len(dispatched), 7)
+        self.assertTrue(any(n.startswith('worker lost is lost') for n in notes))
+        with open(history) as fin:
+            self.assertEqual(len(json.load(fin)), 4)
+        # no worker at all: the jobs fail, and nothing hangs.
+        self.assertEqual([r['rc'] for r in farm.Coordinator([dropped], timeout=1).run(jobs[:2])], [-1, -1])
+        # the default executor runs ipug itself.
+        out = []
+        self.assertEqual(farm.execute({'workspace': self.tmp, 'argv': ['help']}, out.append), 0)
+        self.assertTrue(any('serve-worker' in l for l in out))
+        # but not with an env key other than job_env's.
+        out = []
+        self.assertEqual(farm.execute({'workspace': self.tmp, 'argv': ['help'], 'env': {'TARGET_ARCH': 'X64', 'LD_PRELOAD': 'x.so'}}, out.append), -1)
+        self.assertEqual(out, ['the job is rejected, its env keys are not allowed: LD_PRELOAD'])
+
+    def test_farm_safety(self):
+        """the jobs of a workspace run one at a time, the worker's slots are kept, the jobs of a lost coordinator are killed,
+        and a worker needs a token, and runs the jobs of its workspaces only."""
+        from ipug import farm
+        spans, cancelled, started = [], [], threading.Event()
+
+        def fake(job, on_line, cancel):
+            start = time.time()
+            if job['env'].get('HANG'):
+                started.set()
+                cancelled.append(cancel.wait(10))
+                return -1
+            time.sleep(0.1)
+            spans.append((job['workspace'], start, time.time()))
+            return 0
+
+        worker = farm.Worker(slots=4, token='t', workspaces=[self.tmp], run_job=fake)
+        threading.Thread(target=worker.serve_forever, daemon=True).start()
+        try:
+            jobs = [{'workspace': os.path.join(self.tmp, 'ws%d' % (i % 2)), 'argv': ['build'], 'env': {}} for i in range(4)]
+            self.assertEqual([r['rc'] for r in farm.Coordinator([worker.address], token='t').run(jobs)], [0, 0, 0, 0])
+            for ws in ('ws0', 'ws1'):
+                mine = sorted((a, b) for w, a, b in spans if w.endswith(ws))
+                self.assertEqual(len(mine), 2)
+                self.assertLessEqual(mine[0][1], mine[1][0])
+            # the coordinator drops the connection: its job is killed.
+            sock = socket.create_connection(worker.address)
+            lock = threading.Lock()
+            farm.send(sock, lock, {'op': 'hello', 'token': 't'})
+            farm.send(sock, lock, {'op': 'job', 'id': 0, 'workspace': self.tmp, 'argv': [], 'env': {'HANG': '1'}})
+            self.assertTrue(started.wait(5))
+            sock.close()
+            for _ in range(50):
+                if cancelled:
+                    break
+                time.sleep(0.1)
+            self.assertEqual(cancelled, [True])
+        finally:
+            worker.close()
+        # a wrong token is rejected, and so is a workspace other than the worker's.
+        w = farm.Worker(token='t', workspaces=[os.path.join(self.tmp, 'ws0'), os.path.join(self.tmp, 'ws1')], run_job=fake)
+        threading.Thread(target=w.serve_forever, daemon=True).start()
+        try:
+            # beyond its slots, the worker queues the jobs it's sent.
+            del spans[:]
+            sock = socket.create_connection(w.address)
+            msgs = farm.messages(sock)
+            farm.send(sock, lock, {'op': 'hello', 'token': 't'})
+            next(msgs)
+            for i in range(2):
+                farm.send(sock, lock, {'op': 'job', 'id': i, 'workspace': os.path.join(self.tmp, 'ws%d' % i), 'argv': [], 'env': {}})
+            done = list(itertools.islice((m for m in msgs if m['op'] == 'done'), 2))
+            farm.send(sock, lock, {'op': 'bye'})
+            sock.close()
+            self.assertEqual(sorted(m['id'] for m in done), [0, 1])
+            spans.sort(key=lambda x: x[1])
+            self.assertLessEqual(spans[0][2], spans[1][1])
+            self.assertEqual([r['rc'] for r in farm.Coordinator([w.address], token='x', timeout=1).run(jobs[:1])], [-1])
+            lines = []
+            outside = [{'workspace': os.path.join(self.tmp, 'ws0', '..', 'other'), 'argv': ['build'], 'env': {}}]
+            self.assertEqual([r['rc'] for r in farm.Coordinator([w.address], token='t', on_line=lambda job, line: lines.append(line)).run(outside)], [-1])
+            self.assertIn('is not one of this worker\'s', lines[0])
+        finally:
+            w.close()
+        self.assertRaises(ValueError, farm.Worker, token='', workspaces=[self.tmp])
+        self.assertRaises(ValueError, farm.Worker, token='t')
+        farm.Worker('0.0.0.0', token='t', workspaces=[self.tmp]).close()
+        # the generated token is kept, readable by its owner only.
+        path = os.path.join(self.tmp, 'farm', 'token')
+        token = farm.token_file(path)
+        self.assertEqual((len(token), farm.token_file(path)), (64, token))
+        if os.name != 'nt':
+            self.assertEqual(os.stat(path).st_mode & 0o777, 0o600)
+            os.chmod(path, 0o644)
+            self.assertRaises(ValueError, farm.token_file, path)
+
+    def test_binary_cache(self):
+        """the module binary cache: EDK2's options, the hits and the misses, the LRU eviction, and the shared stores."""
+        from ipug import bincache
+        import http.server
+
+        def make_entry(root, key, size):
+            path = os.path.join(root, key)
+            os.makedirs(path)
+            with open(os.path.join(path, '%s.ModuleHashPair' % os.path.basename(key)), 'w') as fout:
+                fout.write('[]')
+            with open(os.path.join(path, 'bin.efi'), 'wb') as fout:
+                fout.write(b'x' * size)
+
+        self.assertEqual(bincache.parse_line('[cache hit]: MakeCache: /ws/MdePkg/Foo/Foo.inf[X64]'), (True, '/ws/MdePkg/Foo/Foo.inf', 'X64'))
+        self.assertEqual(bincache.parse_line('[cache miss]: /ws/Bar.inf'), (False, '/ws/Bar.inf', ''))
+        self.assertIsNone(bincache.parse_line('Building ... Foo.inf [X64]'))
+        root = os.path.join(self.tmp, 'bincache')
+        bc = bincache.BinaryCache(root)
+        self.assertEqual(bc.build_args(), ['--hash', '--binary-destination=%s' % root])
+        keys = ['Build/P/RELEASE_GCC5/X64/MdePkg/Foo/Foo', 'Build/P/RELEASE_GCC5/X64/MdePkg/Bar/Bar', 'Build/P/RELEASE_GCC5/IA32/MdePkg/Foo/Foo']
+        for i, k in enumerate(keys):
+            make_entry(root, k, 1000)
+            os.utime(os.path.join(root, k), (1000 + i, 1000 + i))
+        self.assertEqual(bc.build_args(), ['--hash', '--binary-source=%s' % root])
+        for line in ['[cache hit]: MakeCache: /ws/MdePkg/Foo/Foo.inf[X64]', '[cache miss]: PreMakeCache: /ws/MdePkg/Baz/Baz.inf[X64]',
+                     '[cache miss]: PreMakeCache: /ws/MdePkg/Foo/Foo.inf[X64]', 'Building ...']:
+            bc.feed('stdout', line)
+        self.assertEqual(bc.result(), (1, 1))
+        bc.touch_hits()
+        self.assertEqual(bc.evict(2500), [keys[1]])
+        self.assertEqual(bincache.entries(root), {keys[0], keys[2]})
+
+        # the shared stores: an upload by one cache is a download of another.
+        class Handler(http.server.BaseHTTPRequestHandler):
+            """a stand-in of a GET/PUT server, with the ETags and the conditional PUTs."""
+            def etag(self, path):
+                if not os.path.isfile(path):
+                    return None
+                with open(path, 'rb') as fin:
+                    return '"%s"' % hashlib.sha1(fin.read()).hexdigest()
+
+            def do_GET(self):
+                path = os.path.join(served, self.path.lstrip('/'))
+                if not os.path.isfile(path):
+                    self.send_error(404)
+                    return
+                with open(path, 'rb') as fin:
+                    data = fin.read()
+                self.send_response(200)
+                self.send_header('Content-Length', str(len(data)))
+                self.send_header('ETag', self.etag(path))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_PUT(self):
+                path = os.path.join(served, self.path.lstrip('/'))
+                data = self.rfile.read(int(self.headers['Content-Length']))
+                if (self.headers['If-Match'] and self.headers['If-Match'] != self.etag(path)) or \
+                   (self.headers['If-None-Match'] == '*' and os.path.exists(path)):
+                    self.send_error(412)
+                    return
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as fout:
+                    fout.write(data)
+                self.send_response(201)
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        served = os.path.join(self.tmp, 'served')
+        server = http.server.HTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            for location in ('http://127.0.0.1:%d/cache' % server.server_address[1], os.path.join(self.tmp, 'shared')):
+                a = bincache.BinaryCache(root, bincache.store(location, 'edk2-stable202008/GCC5'))
+                self.assertEqual(a.push(), 2)
+                self.assertEqual(a.push(), 0)
+                b_root = os.path.join(self.tmp, 'b-%d' % len(location))
+                b = bincache.BinaryCache(b_root, bincache.store(location, 'edk2-stable202008/GCC5'))
+                self.assertEqual(b.pull(), 2)
+                self.assertEqual(bincache.entries(b_root), {keys[0], keys[2]})
+                with open(os.path.join(b_root, keys[0], 'bin.efi'), 'rb') as fin:
+                    self.assertEqual(len(fin.read()), 1000)
+                self.assertEqual(b.pull(), 0)
+                if location.startswith('http'):
+                    # an index update racing with another's is read and merged again: neither is lost.
+                    shared = bincache.store(location, 'edk2-stable202008/GCC5')
+                    reads = [shared.index_etag()]
+                    bincache.store(location, 'edk2-stable202008/GCC5').add(['other'])
+                    shared.index_etag = lambda: reads.pop() if reads else bincache.HttpStore.index_etag(shared)
+                    shared.add(['mine'])
+                    self.assertEqual(set(shared.index()), {keys[0], keys[2], 'other', 'mine'})
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        # a malicious index: its keys outside the layout of the entries are neither downloaded nor extracted.
+        class Evil(object):
+            def index(self):
+                return dict.fromkeys(['../evil/RELEASE_GCC5/X64/M/M', '/tmp/evil/RELEASE_GCC5/X64/M/M', 'Build/P/RELEASE_GCC5/X64/../../../evil',
+                                      'Build\\P\\RELEASE_GCC5\\X64\\M\\M', 'Build/P/RELEASE_GCC5/X64/M', 'etc/passwd', keys[0]], 0)
+
+            def get(self, key, path):
+                fetched.append(key)
+                bincache.pack(root, keys[0], path)
+
+        fetched = []
+        c_root = os.path.join(self.tmp, 'c')
+        self.assertEqual(bincache.BinaryCache(c_root, Evil()).pull(), 1)
+        self.assertEqual(fetched, [keys[0]])
+        self.assertEqual(bincache.entries(c_root), {keys[0]})
+        archive = os.path.join(self.tmp, 'entry.tar.gz')
+        bincache.pack(root, keys[0], archive)
+        for key in Evil().index():
+            if key != keys[0]:
+                self.assertRaises(ValueError, bincache.unpack, archive, c_root, key)
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, 'evil')))
+
+    def test_plan(self):
+        """'--pug:plan' predicts the phases which run and which skip, without writing a file; the timings persist."""
+        from ipug import trace
+        ws = os.path.join(self.tmp, 'ws')
+        saved = (dict(ipug.config.WORKSPACE), ipug.config.CODETREE, dict(ipug.config.TARGET_TXT), ipug.config.DEFAULT_PUG_CACHE_DIR, ipug.config.DEFAULT_COMPILER_CACHE)
+        environ = dict(os.environ)
+        try:
+            ipug.config.WORKSPACE.update(path=ws, pug_path=os.path.join(ws, 'Build', 'pug'), conf_path=os.path.join(ws, 'Conf'))
+            ipug.config.CODETREE = {'edk2': {'path': os.path.join(ws, 'edk2'), 'source': {'url': 'file:///nowhere/edk2.git', 'tag': 'v1'}}}
+            ipug.config.TARGET_TXT['path'] = os.path.join(ws, 'Conf', 'target.txt')
+            ipug.config.DEFAULT_PUG_CACHE_DIR = os.path.join(self.tmp, 'cache')
+            ipug.config.DEFAULT_COMPILER_CACHE = 'sh'     # any command found in PATH
+            os.environ.pop('EDK_TOOLS_PATH', None)
+            before = dict(os.environ)
+            steps = ipug.plan_steps(['setup', '', set()])
+            self.assertEqual(dict(os.environ), before)      # neither GIT_OPTIONAL_LOCKS nor the compiler cache's CCACHE_* is left behind
+            self.assertEqual(steps[0][:2], ('setup_codetree:edk2', 'run'))
+            self.assertIn('clone', steps[0][2])
+            self.assertIn(('gen_target_txt', 'run', 'target.txt is missing'), steps)
+            self.assertIn(('build_basetools', 'run', 'make, once the code tree is fetched'), steps)
+            self.assertEqual(os.listdir(self.tmp), [])
+        finally:
+            os.environ.clear()
+            os.environ.update(environ)
+            ipug.config.WORKSPACE.clear()
+            ipug.config.WORKSPACE.update(saved[0])
+            ipug.config.CODETREE = saved[1]
+            ipug.config.TARGET_TXT.clear()
+            ipug.config.TARGET_TXT.update(saved[2])
+            ipug.config.DEFAULT_PUG_CACHE_DIR = saved[3]
+            ipug.config.DEFAULT_COMPILER_CACHE = saved[4]
+        # the plan's git takes no optional lock, by its own commands' environment.
+        if os.name != 'nt':
+            echo = lambda: ipug.run(['echo', '"$GIT_OPTIONAL_LOCKS"'], self.tmp, verbose=False)[1]
+            self.assertEqual((ipug.git_queries(echo)(), echo()), (['0'], ['']))
+
+        # a patch's state, evaluated by 'git apply --check' without touching the tree.
+        pws = os.path.join(self.tmp, 'pws')
+        os.makedirs(os.path.join(pws, 'a'))
+        with open(os.path.join(pws, 'a', 'f.txt'), 'w') as fout:
+            fout.write('one\n')
+        with open(os.path.join(pws, 'fix.patch'), 'w') as fout:
+            fout.write('--- a/a/f.txt\n+++ b/a/f.txt\n@@ -1 +1 @@\n-one\n+two\n')
+        for cmd in ('git apply fix.patch', 'patch -p1 -i fix.patch', ['patch', '-p1', '<', 'fix.patch']):
+            self.assertEqual(ipug.patch_state(cmd, pws), 'applicable')
+        self.assertEqual(ipug.patch_state('git apply -R fix.patch', pws), 'applied')       # reverted already
+        self.assertEqual(ipug.patch_state('./apply-all.sh', pws), '')
+        self.assertEqual(ipug.patch_state('git apply fix.patch && git commit -a', pws), '')
+        with open(os.path.join(pws, 'a', 'f.txt')) as fin:
+            self.assertEqual(fin.read(), 'one\n')
+        with open(os.path.join(pws, 'a', 'f.txt'), 'w') as fout:
+            fout.write('two\n')
+        self.assertEqual(ipug.patch_state('git apply fix.patch', pws), 'applied')
+        with open(os.path.join(pws, 'a', 'f.txt'), 'w') as fout:
+            fout.write('three\n')
+        self.assertEqual(ipug.patch_state('git apply fix.patch', pws), 'conflicting')
+
+        path = os.path.join(self.tmp, 'timings.json')
+        trace.timings.clear()
+        trace.timings['build'] = 4.0
+        trace.save_timings(path)
+        trace.timings['build'] = 2.0
+        trace.save_timings(path)
+        trace.timings.clear()
+        self.assertEqual(trace.load_timings(path)['build'], {'last': 2.0, 'average': 3.0, 'runs': 2})
+
+    def test_dag(self):
+        """the ready tasks run concurrently, a failure skips only its dependents, and jobs=1 keeps the declared order."""
+        from ipug import dag
+        started, lock = [], threading.Lock()
+
+        def task(name, rc=0, seconds=0.0):
+            def _run():
+                with lock:
+                    started.append(name)
+                time.sleep(seconds)
+                return rc
+            return _run
+
+        def graph():
+            return [dag.Task('fetch:edk2', task('fetch:edk2')),
+                    dag.Task('fetch:other', task('fetch:other', seconds=0.3), group='fetch'),
+                    dag.Task('basetools', task('basetools', 1, 0.3), ['fetch:edk2'], soft=True),
+                    dag.Task('conf', task('conf', 2), ['fetch:edk2']),
+                    dag.Task('target', task('target'), ['conf']),
+                    dag.Task('dsc', task('dsc'), [])]
+        tasks = graph()
+        t0 = time.time()
+        self.assertEqual(dag.run(tasks, 0, {'fetch': 1}), 2)
+        self.assertLess(time.time() - t0, 0.55)
+        self.assertEqual({t.name: t.state for t in tasks}, {'fetch:edk2': 'done', 'fetch:other': 'done', 'basetools': 'failed',
+                                                            'conf': 'failed', 'target': 'skipped', 'dsc': 'done'})
+        self.assertEqual(tasks[4].reason, 'conf failed')
+        del started[:]
+        self.assertEqual(dag.run(graph(), 1), 2)
+        self.assertEqual(started, ['fetch:edk2', 'fetch:other', 'basetools', 'conf', 'dsc'])
+        with self.assertRaises(ValueError):
+            dag.run([dag.Task('a', task('a'), ['b']), dag.Task('b', task('b'), ['a'])])
+        with self.assertRaises(RuntimeError):
+            dag.run([dag.Task('a', lambda: (_ for _ in ()).throw(RuntimeError('a'))), dag.Task('b', task('b'))])
+
+        # build()'s tasks: BaseTools takes edk2's tree only, the DSC/INF files the trees they're inside.
+        saved = ipug.config.CODETREE, getattr(ipug.config, 'COMPONENT', None)
+        try:
+            ipug.config.CODETREE = {'edk2': {'path': os.path.join(self.tmp, 'edk2')}, 'other': {'path': os.path.join(self.tmp, 'other')}}
+            ipug.config.COMPONENT = [{'path': os.path.join(self.tmp, 'other', 'A', 'A.inf')}]
+            deps = {t.name: t.deps for t in ipug.pipeline_tasks(['setup', '', set()], self.tmp, {}, '', set())}
+        finally:
+            ipug.config.CODETREE, ipug.config.COMPONENT = saved
+        self.assertEqual(deps['build_basetools'], ['setup_codetree:edk2'])
+        self.assertEqual(deps['gen_target_txt'], ['conf_files'])
+        self.assertEqual(deps['gen_dsc_inf'], ['setup_codetree:other'])
+
+    def test_log(self):
+        """the messages are written in batches, and the JSON-lines sink records them with their phase and command id."""
+        from ipug import log, trace
+        path = os.path.join(self.tmp, 'log', 'pug.jsonl')
+        latency = log.latency
+        try:
+            log.configure(60, path)
+            with trace.phase('log-test'):
+                ipug.bowwow('hello\nworld', noise_pitch=1)
+                ipug.bowwow('quiet', noise_pitch=-1)
+                self.assertEqual(len(log.pending), 2)
+                ipug.run('echo out-line', self.tmp, verbose=True, on_line=lambda stream, line: None)
+                self.assertEqual(len(log.pending), 4)
+                # a captured command's output isn't shown, only its launch.
+                self.assertEqual(ipug.captured(lambda: ipug.run('echo cap-line', self.tmp, verbose=True)[1])(), ['cap-line'])
+            self.assertEqual(len(log.pending), 5)
+            self.assertEqual(log.format_text('\na\nb'), '\n\nPUG: a\nPUG: b\n')
+            log.flush()
+            self.assertEqual(log.pending, [])
+        finally:
+            log.close()
+            log.configure(latency)
+        with open(path) as fin:
+            records = [json.loads(line) for line in fin]
+        self.assertEqual([r['msg'] for r in records if r['cmd'] == 0], ['hello\nworld', 'quiet'])
+        self.assertEqual(records[0]['level'], 'info')
+        self.assertEqual({r['phase'] for r in records}, {'log-test'})
+        run_records = [r for r in records if r['cmd']]
+        self.assertEqual(len({r['cmd'] for r in run_records}), 2)
+        self.assertEqual([r['msg'] for r in run_records if not r['msg'].startswith('Run: ')], ['out-line'])
+
     #def test_ipug(self):
     #    pass